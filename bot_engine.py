@@ -0,0 +1,86 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import route_file
+from bot_table import BotTable
+
+# Bots or pace partners with their routes in contiguous NumPy arrays (from the route_file columns):
+# a tick advances every position with one vector operation and a proximity query checks all of them
+# at once. The BotTable (or the BotVariables of the pace partners) stays the reference for the rest of
+# the server, positions are read from it before each tick (.group moves bots) and written back after it.
+class BotEngine:
+    def __init__(self, bots):
+        self.population = bots.population if isinstance(bots, BotTable) else None # replaced by /reloadbots, the engine is built again
+        if self.population is not None:
+            routes = self.population.routes
+            route_numbers = np.frombuffer(self.population.route_numbers, np.uint32).astype(np.int64)
+            ids = np.frombuffer(self.population.ids, np.int64).copy()
+        else:
+            self.bots = list(bots.items())
+            routes = []
+            numbers = {} # id(route) -> route number
+            for bot_id, bot in self.bots:
+                if not id(bot.route) in numbers:
+                    numbers[id(bot.route)] = len(routes)
+                    routes.append(bot.route)
+            route_numbers = np.array([numbers[id(bot.route)] for bot_id, bot in self.bots], np.int64)
+            ids = np.array([bot_id for bot_id, bot in self.bots], np.int64)
+        columns = {name: [np.asarray(route_file.column(route, name)) for route in routes] for name in ('x', 'y_altitude', 'z', 'f19', 'aux3')}
+        columns = {name: np.concatenate(values) if values else np.zeros(0) for name, values in columns.items()}
+        route_lengths = np.array([len(route.states) for route in routes], np.int64)
+        route_offsets = np.cumsum(route_lengths) - route_lengths
+        self.x = columns['x'].astype(np.float64)
+        self.y = columns['y_altitude'].astype(np.float64)
+        self.z = columns['z'].astype(np.float64)
+        self.course = ((columns['f19'].astype(np.int64) & 0xff0000) >> 16).astype(np.int32)
+        self.road = ((columns['aux3'].astype(np.int64) & 0xff00) >> 8).astype(np.int32)
+        self.ids = ids
+        self.offsets = route_offsets[route_numbers]
+        self.lengths = np.maximum(route_lengths[route_numbers], 1)
+        self.read_positions()
+        self.update_rows()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def read_positions(self):
+        if self.population is not None:
+            self.positions = np.frombuffer(self.population.positions, np.int64) % self.lengths
+        else:
+            self.positions = np.fromiter((bot.position for bot_id, bot in self.bots), np.int64, len(self.bots)) % self.lengths
+
+    def update_rows(self):
+        # current state of every bot, gathered once per tick for the queries
+        rows = self.offsets + self.positions
+        self.current = (self.x[rows], self.y[rows], self.z[rows], self.course[rows], self.road[rows])
+
+    def tick(self, steps=1):
+        self.read_positions()
+        self.positions += steps
+        self.positions %= self.lengths
+        self.update_rows()
+        if self.population is not None:
+            np.frombuffer(self.population.positions, np.int64)[:] = self.positions
+        else:
+            for (bot_id, bot), position in zip(self.bots, self.positions.tolist()):
+                bot.position = position
+
+    def query(self, course, road, x, y, z, radius=100000, steps=0):
+        # (bot id, distance) of the bots on the course within radius or on the same road, like nearby_distance,
+        # steps states after the last tick (TickClock.offset, the caller holds the clock lock)
+        if steps:
+            states = self.offsets + (self.positions + steps) % self.lengths
+            rows = np.flatnonzero(self.course[states] == course)
+            states = states[rows]
+            cx, cy, cz, croad = self.x[states], self.y[states], self.z[states], self.road[states]
+        else:
+            cx, cy, cz, ccourse, croad = self.current
+            rows = np.flatnonzero(ccourse == course)
+            cx, cy, cz, croad = cx[rows], cy[rows], cz[rows], croad[rows]
+        if not len(rows):
+            return []
+        distance = np.sqrt((cx - x) ** 2 + (cz - z) ** 2 + (cy - y) ** 2)
+        nearby = (distance <= radius) | (croad == road)
+        return list(zip(self.ids[rows[nearby]].tolist(), distance[nearby].tolist()))
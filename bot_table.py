@@ -0,0 +1,250 @@
+import hashlib
+import json
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+
+import profile_pb2
+import route_file
+
+# The bots of enable_bots.txt in flat arrays: the routes are loaded once, never modified and shared by
+# the bots of a multiplier, each bot is a slot with its id, route number, position and serialized
+# profile. The states sent to the players are built from the route data with the bot id as an override,
+# so no thread writes to a shared state. global_bots[bot_id] returns a Bot view of the slot, used like
+# the BotVariables of the pace partners and ghosts.
+class Bot:
+    __slots__ = ('population', 'slot')
+    date = 0
+
+    def __init__(self, population, slot):
+        self.population = population
+        self.slot = slot
+
+    @property
+    def route(self):
+        return self.population.routes[self.population.route_numbers[self.slot]]
+
+    @property
+    def position(self):
+        return self.population.positions[self.slot]
+
+    @position.setter
+    def position(self, position):
+        self.population.positions[self.slot] = position
+
+    @property
+    def profile(self):
+        return profile_pb2.PlayerProfile.FromString(self.population.profiles[self.slot])
+
+    @property
+    def encoded(self):
+        return self.population.encoded[self.slot]
+
+    @encoded.setter
+    def encoded(self, encoded):
+        self.population.encoded[self.slot] = encoded
+
+class BotPopulation:
+    def __init__(self):
+        self.routes = [] # shared routes
+        self.paths = [] # Ghost .bin path of each route, for the snapshot
+        self.lengths = array('q') # number of states of each route
+        self.columns = [] # (course, road, x, z) columns of each route for the SpatialIndex, built when first used
+        self.numbers = {} # id(route) -> route number
+        self.ids = array('q')
+        self.route_numbers = array('I')
+        self.positions = array('q')
+        self.profiles = [] # serialized PlayerProfile
+        self.encoded = [] # (position, serialized state) cached by encoded_bot_state
+        self.slots = {} # bot id -> slot
+
+    def add_route(self, route, path=None):
+        number = self.numbers.get(id(route))
+        if number is None:
+            number = self.numbers[id(route)] = len(self.routes)
+            self.routes.append(route)
+            self.paths.append(path)
+            self.lengths.append(len(route.states))
+            self.columns.append(None)
+        return number
+
+    def add(self, bot_id, route, position, profile, path=None):
+        self.slots[bot_id] = len(self.ids)
+        self.ids.append(bot_id)
+        self.route_numbers.append(self.add_route(route, path))
+        self.positions.append(position)
+        self.profiles.append(profile.SerializeToString())
+        self.encoded.append(None)
+
+    def route_columns(self, number):
+        columns = self.columns[number]
+        if columns is None:
+            route = self.routes[number]
+            f19, aux3, x, z = (route_file.column(route, name) for name in ('f19', 'aux3', 'x', 'z'))
+            columns = self.columns[number] = (bytes((v & 0xff0000) >> 16 for v in f19), bytes((v & 0xff00) >> 8 for v in aux3), x, z)
+        return columns
+
+    def tick(self, steps=1):
+        # moves every bot steps states forward, back to the start at the end of its route
+        lengths = self.lengths
+        route_numbers = self.route_numbers
+        positions = self.positions
+        for slot in range(len(positions)):
+            positions[slot] = (positions[slot] + steps) % (lengths[route_numbers[slot]] or 1)
+
+    def index_items(self):
+        # (bot id, course, road, x, z) of every bot for SpatialIndex.update_many
+        columns = [self.route_columns(number) for number in range(len(self.routes))]
+        for bot_id, number, position in zip(self.ids, self.route_numbers, self.positions):
+            course, road, x, z = columns[number]
+            yield bot_id, course[position], road[position], x[position], z[position]
+
+# global_bots: the current BotPopulation, replaced at once by /reloadbots while the
+# other threads keep using the population they got
+class BotTable:
+    def __init__(self):
+        self.population = BotPopulation()
+
+    def replace(self, population):
+        self.population = population
+
+    def __len__(self):
+        return len(self.population.ids)
+
+    def __contains__(self, bot_id):
+        return bot_id in self.population.slots
+
+    def __iter__(self):
+        return iter(self.population.slots)
+
+    def __getitem__(self, bot_id):
+        population = self.population
+        return Bot(population, population.slots[bot_id])
+
+    def get(self, bot_id, default=None):
+        population = self.population
+        slot = population.slots.get(bot_id)
+        return default if slot is None else Bot(population, slot)
+
+    def keys(self):
+        return self.population.slots.keys()
+
+    def items(self):
+        population = self.population
+        return [(bot_id, Bot(population, slot)) for bot_id, slot in population.slots.items()]
+
+    def clear(self):
+        self.replace(BotPopulation())
+
+    def tick(self, steps=1):
+        self.population.tick(steps)
+
+    def index_items(self):
+        return self.population.index_items()
+
+# Time of the positions of the bots or pace partners. A tick moves the positions and tick_time together
+# under lock, the states sent are the ones of the tick moved by the time passed since (offset), so a
+# position must be read or set with the clock to not be a tick ahead or behind.
+class TickClock:
+    def __init__(self, interval):
+        self.interval = interval # seconds between two recorded states
+        self.tick_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def offset(self):
+        # recorded states passed since tick_time, and how far the bots are from the last one to the next one
+        steps, fraction = divmod(max(time.monotonic() - self.tick_time, 0) / self.interval, 1)
+        return int(steps), fraction
+
+    def position(self, bot):
+        # (position, fraction of the way to the next one) of the bot now
+        with self.lock:
+            steps, fraction = self.offset()
+            return (bot.position + steps) % max(len(bot.route.states), 1), fraction
+
+    def place(self, bot, position):
+        # moves the bot to position now
+        with self.lock:
+            bot.position = (position - self.offset()[0]) % max(len(bot.route.states), 1)
+
+# Snapshot of a BotPopulation, to start the bots without drawing their profiles again:
+#   SNAPSHOT_MAGIC, SNAPSHOT_HEADER (size of the JSON header, number of bots n), JSON header (key, route paths),
+#   then the columns ids (int64), route numbers (uint32), positions (int64), profile offsets (uint32, n + 1
+#   values) in network byte order and the serialized profiles
+# The key describes what the population was made from (ghosts, bot.txt...), a snapshot made from
+# anything else is not used.
+SNAPSHOT_MAGIC = b'ZOBOTS1\n'
+SNAPSHOT_HEADER = struct.Struct('!II')
+SNAPSHOT_COLUMNS = (('ids', 'q'), ('route_numbers', 'I'), ('positions', 'q'))
+
+def snapshot_key(sources):
+    return hashlib.sha1(json.dumps(sources, sort_keys=True).encode()).hexdigest()
+
+def network_order(values):
+    if sys.byteorder == 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+def save_snapshot(path, key, population):
+    header = json.dumps({'key': key, 'routes': population.paths}).encode()
+    offsets = array('I', [0])
+    for profile in population.profiles:
+        offsets.append(offsets[-1] + len(profile))
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC + SNAPSHOT_HEADER.pack(len(header), len(population.ids)) + header)
+            for name, code in SNAPSHOT_COLUMNS:
+                f.write(network_order(getattr(population, name)).tobytes())
+            f.write(network_order(offsets).tobytes())
+            f.write(b''.join(population.profiles))
+        os.replace(tmp, path)
+    except OSError as exc:
+        print('save_snapshot %s: %s' % (path, repr(exc)))
+
+def load_snapshot(path, key, get_route):
+    # BotPopulation of the snapshot if it was made with key, routes loaded with get_route(path)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    try:
+        if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            return None
+        size, count = SNAPSHOT_HEADER.unpack_from(data, len(SNAPSHOT_MAGIC))
+        start = len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size
+        header = json.loads(data[start:start + size])
+        if header['key'] != key:
+            return None
+        start += size
+        population = BotPopulation()
+        for path in header['routes']:
+            population.add_route(get_route(path), path)
+        columns = SNAPSHOT_COLUMNS + (('offsets', 'I'),)
+        values = {}
+        for name, code in columns:
+            values[name] = array(code)
+            end = start + values[name].itemsize * (count + (name == 'offsets'))
+            values[name].frombytes(data[start:end])
+            values[name] = network_order(values[name])
+            start = end
+        offsets = values.pop('offsets')
+        if len(offsets) != count + 1 or start + offsets[-1] != len(data):
+            return None
+        for name, code in SNAPSHOT_COLUMNS:
+            setattr(population, name, values[name])
+        if any(number >= len(population.routes) or position >= population.lengths[number]
+               for number, position in zip(population.route_numbers, population.positions)):
+            return None
+        population.slots = dict(zip(population.ids, range(count)))
+        population.profiles = [data[start + offsets[i]:start + offsets[i + 1]] for i in range(count)]
+        population.encoded = [None] * count
+        return population
+    except Exception as exc:
+        print('load_snapshot %s: %s' % (path, repr(exc)))
+        return None
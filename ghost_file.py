@@ -0,0 +1,213 @@
+import os
+import struct
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+
+import relay_codec
+import udp_node_msgs_pb2
+
+# Compact ghost file, the loaders accept it and the Ghost protobuf (read_ghost). After MAGIC, zlib
+# compressed columns of the kept states (records), little-endian:
+#   HEADER (player id, number of states, number of records)
+#   number of states dropped after each record (uint8), rebuilt by interpolation up to the next record
+#   for each DELTAS field, the differences with the previous record (int64, x, y_altitude and z in 1/100 cm)
+#   size of the PlayerState with the other fields of each record * 2 (uint32, + 1 if it replaces the
+#   previous record's, else it holds the fields that changed), then these PlayerState
+# The DELTAS are the columns of a route file, so decode() gives them and the serialized states
+# without building a PlayerState for every state.
+MAGIC = b'ZOGHOST2'
+HEADER = struct.Struct('<qII')
+DELTAS = ('worldTime', 'roadTime', 'distance', 'x', 'y_altitude', 'z', 'heading', 'f19', 'aux3')
+SCALE = {'x': 100, 'y_altitude': 100, 'z': 100}
+HEADING_TURN = 6283185 # heading of a full turn (radians * 1000000)
+MAX_DROPPED = 20
+
+def little_endian(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+def deltas(state):
+    return [round(getattr(state, name) * SCALE[name]) if name in SCALE else getattr(state, name) for name in DELTAS]
+
+def others(state):
+    # the fields of the state that are not in DELTAS
+    other = udp_node_msgs_pb2.PlayerState()
+    other.CopyFrom(state)
+    for name in DELTAS:
+        other.ClearField(name)
+    return other
+
+def straight(points, first, last, tolerance):
+    # True if the points (x, y_altitude, z, f19, aux3) between first and last are on the same road
+    # and direction and within tolerance (cm) of the line between them
+    a, b = points[first], points[last]
+    if a[3:] != b[3:]:
+        return False
+    for k in range(first + 1, last):
+        p = points[k]
+        if p[3:] != a[3:]:
+            return False
+        f = (k - first) / (last - first)
+        if sum((a[n] + (b[n] - a[n]) * f - p[n]) ** 2 for n in range(3)) > tolerance * tolerance:
+            return False
+    return True
+
+def compact(ghost, tolerance=0):
+    # Compact file of a Ghost. With tolerance (cm), states on straight sections are dropped, they are
+    # rebuilt on load from the previous kept state moved along the line to the next one
+    states = ghost.states
+    points = [(s.x, s.y_altitude, s.z, s.f19, s.aux3) for s in states] if tolerance > 0 else None
+    kept = []
+    i = 0
+    while i < len(states):
+        kept.append(i)
+        j = i + 1
+        if tolerance > 0:
+            while j + 1 < len(states) and j + 1 - i <= MAX_DROPPED + 1 and straight(points, i, j + 1, tolerance):
+                j += 1
+        i = j
+    dropped = array('B')
+    columns = [array('q') for name in DELTAS]
+    sizes = array('I')
+    data = []
+    previous_deltas = [0] * len(DELTAS)
+    previous = udp_node_msgs_pb2.PlayerState()
+    for n, i in enumerate(kept):
+        dropped.append((kept[n + 1] if n + 1 < len(kept) else len(states)) - i - 1)
+        values = deltas(states[i])
+        for column, value, previous_value in zip(columns, values, previous_deltas):
+            column.append(value - previous_value)
+        previous_deltas = values
+        other = others(states[i])
+        changed = udp_node_msgs_pb2.PlayerState()
+        replace = False
+        fields = dict(other.ListFields())
+        for field, value in previous.ListFields():
+            if not field in fields:
+                replace = True # a field was cleared, it can't be merged
+        if replace:
+            changed = other
+        else:
+            for field, value in fields.items():
+                if not previous.HasField(field.name) or getattr(previous, field.name) != value:
+                    setattr(changed, field.name, value)
+        data.append(changed.SerializeToString())
+        sizes.append(len(data[-1]) << 1 | replace)
+        previous = other
+    body = [HEADER.pack(ghost.player_id, len(states), len(kept)), dropped.tobytes()]
+    body += [little_endian(column).tobytes() for column in columns]
+    body += [little_endian(sizes).tobytes()] + data
+    return MAGIC + zlib.compress(b''.join(body), 9)
+
+def interpolate(start, end, f):
+    # DELTAS values at f (0 to 1) of the way from start to end, the heading turns the shorter way
+    values = []
+    for name, a, b in zip(DELTAS, start, end):
+        if name == 'heading':
+            turn = (b - a) % HEADING_TURN
+            if turn > HEADING_TURN // 2:
+                turn -= HEADING_TURN
+            value = round(a + turn * f)
+            if 0 <= a < HEADING_TURN:
+                value %= HEADING_TURN
+        elif name in SCALE:
+            value = a + (b - a) * f
+        else:
+            value = round(a + (b - a) * f)
+        values.append(value)
+    return values
+
+def decode(data):
+    # (player id, DELTAS columns, serialized states) of a compact file, the x, y_altitude and z columns in cm
+    body = zlib.decompress(data[len(MAGIC):])
+    player_id, count, records = HEADER.unpack_from(body)
+    position = HEADER.size
+    def column(code):
+        nonlocal position
+        values = array(code)
+        end = position + values.itemsize * records
+        values.frombytes(body[position:end])
+        position = end
+        return little_endian(values)
+    dropped = column('B')
+    rows = list(zip(*[accumulate(column('q')) for name in DELTAS]))
+    sizes = column('I')
+    steps = []
+    for k, row in enumerate(rows):
+        steps.append(row)
+        if dropped[k]:
+            if k + 1 >= records:
+                raise ValueError('compact ghost has states dropped after its last record')
+            steps += [interpolate(row, rows[k + 1], n / (dropped[k] + 1)) for n in range(1, dropped[k] + 1)]
+    if len(steps) != count:
+        raise ValueError('compact ghost has %s states instead of %s' % (len(steps), count))
+    columns = {}
+    for name, values in zip(DELTAS, zip(*steps)):
+        columns[name] = [value / SCALE[name] for value in values] if name in SCALE else list(values)
+    named = list(columns.items())
+    state = udp_node_msgs_pb2.PlayerState()
+    encoded = []
+    n = 0
+    for k in range(records):
+        size = sizes[k] >> 1
+        if sizes[k] & 1:
+            state.Clear()
+        state.MergeFromString(body[position:position + size])
+        position += size
+        for i in range(n, n + dropped[k] + 1):
+            for name, values in named:
+                setattr(state, name, values[i])
+            encoded.append(state.SerializeToString())
+        n += dropped[k] + 1
+    return player_id, columns, encoded
+
+def expand(data):
+    # Ghost of a compact file
+    player_id, columns, encoded = decode(data)
+    ghost = udp_node_msgs_pb2.Ghost()
+    ghost.player_id = player_id
+    ghost.MergeFromString(b''.join(relay_codec.encode_field(2, state) for state in encoded)) # Ghost.states
+    return ghost
+
+def is_compact(data):
+    return data[:len(MAGIC)] == MAGIC
+
+def parse_ghost(data):
+    if is_compact(data):
+        return expand(data)
+    return udp_node_msgs_pb2.Ghost.FromString(data)
+
+def read_ghost(path):
+    # Ghost of a ghost file in either format
+    with open(path, 'rb') as f:
+        return parse_ghost(f.read())
+
+def write_file(path, data):
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def compact_file(path, tolerance=0):
+    # Rewrites a ghost file in the compact format, returns its sizes before and after
+    with open(path, 'rb') as f:
+        data = f.read()
+    if is_compact(data):
+        return len(data), len(data)
+    compacted = compact(udp_node_msgs_pb2.Ghost.FromString(data), tolerance)
+    write_file(path, compacted)
+    return len(data), len(compacted)
+
+def expand_file(path):
+    # Rewrites a compact ghost file as a Ghost protobuf, for the tools that only read this format
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not is_compact(data):
+        return len(data), len(data)
+    expanded = expand(data).SerializeToString()
+    write_file(path, expanded)
+    return len(data), len(expanded)
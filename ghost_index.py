@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+
+# Index of the recorded ghosts of each player, saved in storage/<player id>/ghosts/index.json:
+# for each ghosts folder (course/road[/reverse] or course/route) its mtime and the ghosts in it
+# (file name, course, road, forward, route, recorded date, number of states, size and mtime).
+# save_ghost adds the ghosts it writes, a folder is scanned again only if its mtime changed
+# (ghosts copied or deleted by hand), so loading the ghosts of a ride is a lookup.
+class GhostIndex:
+    def __init__(self, storage_dir, route_cache):
+        self.storage_dir = storage_dir
+        self.route_cache = route_cache
+        self.players = {} # player id (str, the storage folder name) -> {folder: {'mtime': ..., 'ghosts': [...]}}
+        self.lock = threading.Lock()
+
+    def ghosts_dir(self, player_id):
+        return '%s/%s/ghosts' % (self.storage_dir, player_id)
+
+    def _player(self, player_id):
+        folders = self.players.get(player_id)
+        if folders is None:
+            folders = {}
+            try:
+                with open('%s/index.json' % self.ghosts_dir(player_id)) as f:
+                    folders = json.load(f)['folders']
+            except (OSError, ValueError, KeyError):
+                pass
+            self.players[player_id] = folders
+        return folders
+
+    def _save(self, player_id):
+        path = '%s/index.json' % self.ghosts_dir(player_id)
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': 1, 'folders': self.players[player_id]}, f)
+            os.replace(tmp, path)
+        except OSError as exc:
+            print('GhostIndex save %s: %s' % (path, repr(exc)))
+
+    def entry(self, name, route, size, mtime):
+        state = route.states[0]
+        return {'file': name, 'course': (state.f19 & 0xff0000) >> 16, 'road': (state.aux3 & 0xff00) >> 8,
+                'forward': (state.f19 & 4) != 0, 'route': state.route, 'date': state.worldTime,
+                'states': len(route.states), 'size': size, 'mtime': mtime}
+
+    def _scan(self, player_id, folder, old):
+        # ghosts of a folder, only the new or modified files are read
+        path = '%s/%s' % (self.ghosts_dir(player_id), folder)
+        known = {g['file']: g for g in old['ghosts']} if old else {}
+        ghosts = []
+        for name in sorted(os.listdir(path)):
+            if not name.endswith('.bin'):
+                continue
+            st = os.stat('%s/%s' % (path, name))
+            g = known.get(name)
+            if g is None or g['size'] != st.st_size or g['mtime'] != st.st_mtime_ns:
+                try:
+                    route = self.route_cache.get('%s/%s' % (path, name))
+                    if not len(route.states):
+                        continue
+                    g = self.entry(name, route, st.st_size, st.st_mtime_ns)
+                except Exception as exc:
+                    print('GhostIndex %s/%s: %s' % (path, name, repr(exc)))
+                    continue
+            ghosts.append(g)
+        return {'mtime': os.stat(path).st_mtime_ns, 'ghosts': ghosts} # after the .route files were written
+
+    def folder(self, player_id, folder):
+        # ghosts of a folder relative to the player's ghosts folder, with their path
+        player_id = str(player_id)
+        path = '%s/%s' % (self.ghosts_dir(player_id), folder)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return []
+        with self.lock:
+            folders = self._player(player_id)
+            cached = folders.get(folder)
+            if cached is None or cached['mtime'] != mtime:
+                try:
+                    cached = folders[folder] = self._scan(player_id, folder, cached)
+                except OSError as exc:
+                    print('GhostIndex %s: %s' % (path, repr(exc)))
+                    return []
+                self._save(player_id)
+            return [dict(g, path='%s/%s' % (path, g['file'])) for g in cached['ghosts']]
+
+    def all(self, player_id):
+        # every ghost of the player
+        player_id = str(player_id)
+        ghosts = []
+        root = self.ghosts_dir(player_id)
+        for (path, dirs, files) in os.walk(root):
+            dirs.sort()
+            if any(f.endswith('.bin') for f in files):
+                ghosts += self.folder(player_id, os.path.relpath(path, root).replace(os.sep, '/'))
+        return ghosts
+
+    def add(self, player_id, path, ghost):
+        # called after save_ghost wrote ghost to path
+        player_id = str(player_id)
+        root = self.ghosts_dir(player_id)
+        folder = os.path.relpath(os.path.dirname(path), root).replace(os.sep, '/')
+        st = os.stat(path)
+        with self.lock:
+            folders = self._player(player_id)
+            cached = folders.get(folder)
+            if cached is None:
+                return # scanned on first use
+            name = os.path.basename(path)
+            cached['ghosts'] = [g for g in cached['ghosts'] if g['file'] != name]
+            cached['ghosts'].append(self.entry(name, ghost, st.st_size, st.st_mtime_ns))
+            cached['mtime'] = os.stat(os.path.dirname(path)).st_mtime_ns
+            self._save(player_id)
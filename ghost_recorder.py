@@ -0,0 +1,129 @@
+import os
+import threading
+
+import relay_codec
+import udp_node_msgs_pb2
+
+# Ghost recorded to a file as the ride goes instead of a Ghost kept in memory: the player id (Ghost
+# field 1) is written first, then every state as a Ghost field 2, so the file is a serialized Ghost
+# as long as its last state was written completely. save_ghost renames it to the ghosts folder,
+# the recording of a session that ended without it (server stopped or crashed) is recovered at the
+# next login of the player.
+PART = '.part'
+active = set() # paths of the recordings open in this process, they are not orphans
+
+class GhostRecorder:
+    def __init__(self, folder, player_id):
+        self.folder = folder # storage/<player id>/recording
+        self.player_id = player_id
+        self.file = None
+        self.path = None
+        self.first = None # first state recorded, it gives the ghosts folder
+        self.count = 0
+        self.closed = False # discarded by logout_player, states still received are not recorded
+        self.lock = threading.Lock()
+
+    def append(self, state):
+        data = relay_codec.encode_field(2, state.SerializeToString())
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                if self.file is None:
+                    os.makedirs(self.folder, exist_ok=True)
+                    self.path = '%s/%s-%s%s' % (self.folder, state.worldTime, os.getpid(), PART)
+                    active.add(self.path)
+                    self.file = open(self.path, 'wb')
+                    self.file.write(relay_codec.encode_int_field(1, self.player_id))
+                    self.first = udp_node_msgs_pb2.PlayerState()
+                    self.first.CopyFrom(state)
+                self.file.write(data)
+                self.file.flush() # the states recorded are kept if the server is killed
+                self.count += 1
+            except OSError as exc:
+                print('GhostRecorder %s: %s' % (self.path, repr(exc)))
+                self.closed = True
+                if self.file is not None:
+                    try:
+                        self.file.close()
+                    except OSError:
+                        pass
+                self._reset() # what was written is left to recover_ghosts
+
+    def _reset(self):
+        active.discard(self.path)
+        self.file = None
+        self.path = None
+        self.first = None
+        self.count = 0
+
+    def finish(self, path):
+        # Moves the recording to path, the next state starts a new recording. Returns False if nothing was recorded
+        with self.lock:
+            if self.file is None:
+                return False
+            try:
+                self.file.close()
+                os.replace(self.path, path)
+            finally:
+                self._reset() # if the move failed, the recording is left to recover_ghosts
+            return True
+
+    def discard(self):
+        with self.lock:
+            self.closed = True
+            if self.file is not None:
+                self.file.close()
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+                self._reset()
+
+def complete_size(data):
+    # size of the complete fields at the start of a recording, the last state may have been cut by a crash
+    position = 0
+    while position < len(data):
+        start = position
+        key = data[position]
+        position += 1
+        value = 0
+        shift = 0
+        while True:
+            if position >= len(data):
+                return start
+            byte = data[position]
+            position += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        if key == 0x12: # state: value is its size
+            position += value
+            if position > len(data):
+                return start
+        elif key != 0x08: # only the player id is a varint field
+            return start
+    return position
+
+def orphans(folder):
+    # recordings left in folder by a session that didn't save them
+    try:
+        names = sorted(os.listdir(folder))
+    except OSError:
+        return []
+    paths = ['%s/%s' % (folder, name) for name in names if name.endswith(PART)]
+    return [path for path in paths if not path in active]
+
+def recover(path):
+    # Ghost of a recording cut by a crash (its incomplete last state dropped), None if it has no state
+    with open(path, 'rb') as f:
+        data = f.read()
+    ghost = udp_node_msgs_pb2.Ghost()
+    try:
+        ghost.ParseFromString(data[:complete_size(data)])
+    except Exception:
+        return None
+    if not ghost.states or not ghost.HasField('player_id'):
+        return None
+    return ghost
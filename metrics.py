@@ -0,0 +1,101 @@
+import bisect
+import threading
+
+# Metrics in the Prometheus text format. Updates are plain += on attributes (no lock, the GIL keeps
+# them consistent enough for monitoring), so they can be used in the relay hot paths.
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def inc(self, n=1):
+        self.value += n
+
+    def set_function(self, function):
+        # value read from function() when rendered, e.g. a counter kept by another object
+        self.function = function
+
+    def samples(self, name, labels):
+        yield name, labels, self.function() if self.function else self.value
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, n=1):
+        self.value -= n
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        count = 0
+        for le, n in zip(self.buckets + ['+Inf'], self.counts):
+            count += n
+            yield name + '_bucket', labels + (('le', le),), count
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, count
+
+class Family:
+    def __init__(self, name, help, factory, labelnames):
+        self.name = name
+        self.help = help
+        self.factory = factory
+        self.labelnames = labelnames
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def render(self, lines):
+        children = list(self.children.items())
+        if not children:
+            return
+        lines.append('# HELP %s %s' % (self.name, self.help))
+        lines.append('# TYPE %s %s' % (self.name, children[0][1].kind))
+        for values, child in children:
+            for name, labels, value in child.samples(self.name, tuple(zip(self.labelnames, values))):
+                if labels:
+                    name += '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+                lines.append('%s %s' % (name, value))
+
+families = []
+
+def _register(name, help, factory, labels):
+    family = Family(name, help, factory, labels)
+    families.append(family)
+    return family if labels else family.labels()
+
+def counter(name, help, labels=()):
+    return _register(name, help, Counter, labels)
+
+def gauge(name, help, labels=()):
+    return _register(name, help, Gauge, labels)
+
+def histogram(name, help, buckets, labels=()):
+    return _register(name, help, lambda: Histogram(list(buckets)), labels)
+
+def render():
+    lines = []
+    for family in list(families):
+        family.render(lines)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,48 @@
+import socket
+import threading
+
+# Wake-up signal that can be waited on with select() or an event loop reader next to a socket.
+# set() may be called from any thread, fileno() stays readable until clear().
+# With a callback (e.g. a call_soon_threadsafe of the event loop), set() calls it instead and there
+# is no socket to wait on, for the event loops without readers (ProactorEventLoop on Windows).
+class Notifier:
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.r = self.w = None
+        if callback is None:
+            self.r, self.w = socket.socketpair()
+            self.r.setblocking(False)
+            self.w.setblocking(False)
+        self.pending = False
+        self.lock = threading.Lock()
+
+    def fileno(self):
+        return self.r.fileno()
+
+    def set(self):
+        with self.lock:
+            if self.pending:
+                return
+            self.pending = True
+            if self.callback is not None:
+                self.callback()
+                return
+            try:
+                self.w.send(b'\0')
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            self.pending = False
+            if self.r is None:
+                return
+            try:
+                self.r.recv(64)
+            except OSError:
+                pass
+
+    def close(self):
+        if self.r is not None:
+            self.r.close()
+            self.w.close()
@@ -0,0 +1,65 @@
+import struct
+import threading
+import time
+
+# Capture of the packets received by the relay, replayed by scripts/relay_replay.py.
+# A capture file is MAGIC followed by records: RECORD header, client host, payload.
+#   KEY: payload is the relay id (4 bytes) and the encryption key, written before the first packet using it
+#   UDP: payload is a datagram
+#   TCP: payload is a frame without its 2 bytes length
+#   TCP_CLOSE: the TCP connection was closed, no payload
+MAGIC = b'ZOCAP1\n'
+RECORD = struct.Struct('!BdqBHI') # kind, time, world_time, host length, port, payload length
+KEY, UDP, TCP, TCP_CLOSE = range(4)
+
+class RelayCapture:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        if not self.file.tell():
+            self.file.write(MAGIC)
+            self.file.flush() # nothing buffered when the UDP workers are forked
+        self.keys = {} # relay id -> key already written
+        self.lock = threading.Lock()
+        self.records = 0
+        self.flushed = time.time()
+
+    def write(self, kind, world_time, address, payload=b''):
+        t = time.time()
+        host = address[0].encode()
+        header = RECORD.pack(kind, t, world_time, len(host), address[1], len(payload))
+        with self.lock:
+            self.file.write(header + host + payload)
+            self.records += 1
+            if t > self.flushed + 1: # at most 1 second lost if the server is killed
+                self.file.flush()
+                self.flushed = t
+
+    def key(self, world_time, relay_id, key):
+        if self.keys.get(relay_id) != key:
+            self.keys[relay_id] = key
+            self.write(KEY, world_time, ('', 0), relay_id.to_bytes(4, 'big') + key)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_capture(path):
+    # Yields the records of a capture file as (kind, time, world_time, (host, port), payload)
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a relay capture' % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            kind, t, world_time, host_len, port, size = RECORD.unpack(header)
+            host = f.read(host_len).decode()
+            payload = f.read(size)
+            if len(payload) < size:
+                return # truncated by a crash, the records before are fine
+            yield kind, t, world_time, (host, port), payload
@@ -0,0 +1,220 @@
+import struct
+import threading
+from Crypto.Cipher import AES
+from google.protobuf.descriptor import FieldDescriptor
+
+MAX_PAYLOAD = 1400
+FRAME_SIZE = struct.Struct('!H')
+COUNTERS = [struct.pack('!I', i + 2) for i in range(4096)] # GCM encryption starts at counter 2 (J0 + 1)
+
+class DeviceType:
+    Relay = 1
+    Zc = 2
+
+class ChannelType:
+    UdpClient = 1
+    UdpServer = 2
+    TcpClient = 3
+    TcpServer = 4
+
+class Packet:
+    flags = None
+    ri = None
+    ci = None
+    sn = None
+    payload = None
+
+class CryptoSession:
+    # AES-GCM state of a relay: the expanded key is kept for the whole session and the 12 bytes
+    # IV (2 zero bytes, device type, channel type, connection id, sequence number) is updated in place
+    def __init__(self, key, dt=DeviceType.Relay):
+        self.key = key
+        self.ecb = AES.new(key, AES.MODE_ECB) if key else None
+        self.iv = bytearray(12)
+        struct.pack_into('!h', self.iv, 2, dt)
+        self.lock = threading.Lock()
+
+    def _set_iv(self, ct, ci, sn):
+        struct.pack_into('!hhi', self.iv, 4, ct, ci, sn)
+
+    def _decrypt(self, data):
+        # Same as AES.new(key, AES.MODE_GCM, iv).decrypt(data), the tag is not verified (as before),
+        # so the CTR keystream can be produced by the cached ECB cipher
+        n = (len(data) + 15) // 16
+        if n == 0:
+            return b''
+        iv = bytes(self.iv)
+        keystream = self.ecb.encrypt(iv + iv.join(COUNTERS[:n]))
+        return (int.from_bytes(data, 'big') ^ int.from_bytes(keystream[:len(data)], 'big')).to_bytes(len(data), 'big')
+
+    def open(self, data, ct, ci, sn):
+        p = Packet()
+        s = 1
+        p.flags = data[0]
+        if p.flags & 4:
+            p.ri = int.from_bytes(data[s:s+4], "big")
+            s += 4
+        if p.flags & 2:
+            p.ci = ci = int.from_bytes(data[s:s+2], "big")
+            s += 2
+        if p.flags & 1:
+            p.sn = sn = int.from_bytes(data[s:s+4], "big")
+            s += 4
+        with self.lock:
+            self._set_iv(ct, ci, sn)
+            p.payload = self._decrypt(data[s:])
+        return p
+
+    def open_many(self, datagrams, ct, ci, sn):
+        # Consecutive packets of a stream, sequence numbers increase unless given in the header
+        packets = []
+        for data in datagrams:
+            p = self.open(data, ct, ci, sn)
+            if p.ci is not None:
+                ci = p.ci
+            sn = (p.sn if p.sn is not None else sn) + 1
+            packets.append(p)
+        return packets
+
+    def seal(self, payload, ct, ci, sn, header_ri=None, header_ci=None, header_sn=None):
+        flags = 0
+        header = b''
+        if header_ri is not None:
+            flags = flags | 4
+            header += struct.pack('!i', header_ri)
+        if header_ci is not None:
+            flags = flags | 2
+            header += struct.pack('!h', header_ci)
+        if header_sn is not None:
+            flags = flags | 1
+            header += struct.pack('!i', header_sn)
+        header = struct.pack('b', flags) + header
+        with self.lock:
+            self._set_iv(ct, ci, sn)
+            aesgcm = AES.new(self.key, AES.MODE_GCM, self.iv)
+        aesgcm.update(header)
+        ep, tag = aesgcm.encrypt_and_digest(payload)
+        return header + ep + tag[:4]
+
+    def seal_many(self, payloads, ct, ci, sn, with_sn=False):
+        # Encrypts payloads with consecutive sequence numbers starting at sn (also put in the header if with_sn)
+        return [self.seal(payload, ct, ci, sn + i, header_sn=sn + i if with_sn else None) for i, payload in enumerate(payloads)]
+
+class FrameDecoder:
+    # Splits the TCP stream into [2 bytes length][payload] frames, whatever the size of each read.
+    # Data is received straight into a preallocated buffer, which grows if a frame doesn't fit.
+    def __init__(self, size=4096):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # first byte not returned by frames() yet
+        self.end = 0 # end of the received data
+
+    def _make_room(self, n):
+        pending = self.end - self.start
+        if self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        if len(self.buffer) - self.end < n:
+            buffer = bytearray(max(len(self.buffer) * 2, pending + n))
+            buffer[:pending] = self.buffer[:pending]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+
+    def recv_into(self, sock):
+        # Returns the number of bytes received, 0 when the connection was closed
+        if self.end == len(self.buffer):
+            self._make_room(len(self.buffer) // 2)
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data):
+        if len(self.buffer) - self.end < len(data):
+            self._make_room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self):
+        # Payloads of the complete frames received so far
+        frames = []
+        start = self.start
+        while self.end - start >= 2:
+            size = FRAME_SIZE.unpack_from(self.buffer, start)[0]
+            if self.end - start - 2 < size:
+                break
+            frames.append(bytes(self.view[start + 2:start + 2 + size]))
+            start += size + 2
+        self.start = start
+        if self.start == self.end:
+            self.start = self.end = 0
+        return frames
+
+def varint_size(value):
+    size = 1
+    while value > 0x7f:
+        value >>= 7
+        size += 1
+    return size
+
+def encode_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def encode_field(field_number, data):
+    # length-delimited field (wire type 2), e.g. an already serialized sub-message
+    return encode_varint(field_number << 3 | 2) + encode_varint(len(data)) + data
+
+def encode_int_field(field_number, value):
+    # varint field (wire type 0), negative values as 64-bit two's complement
+    return encode_varint(field_number << 3) + encode_varint(value & 0xffffffffffffffff)
+
+FLOAT = struct.Struct('<f')
+override_fields = {} # (message class, field name) -> (key of the field, is float)
+
+def encode_overrides(message_class, **fields):
+    # Appended to a serialized message, these integer or float fields replace the serialized ones when parsed (last one wins)
+    out = []
+    for name, value in fields.items():
+        field = override_fields.get((message_class, name))
+        if field is None:
+            descriptor = message_class.DESCRIPTOR.fields_by_name[name]
+            is_float = descriptor.type == FieldDescriptor.TYPE_FLOAT
+            field = override_fields[(message_class, name)] = (encode_varint(descriptor.number << 3 | (5 if is_float else 0)), is_float)
+        out.append(field[0])
+        out.append(FLOAT.pack(value) if field[1] else encode_varint(value & 0xffffffffffffffff))
+    return b''.join(out)
+
+def pack_messages(message, field, items, limit=MAX_PAYLOAD, numbered=False):
+    # Splits serialized sub-messages (items) for the repeated field over as many copies of message
+    # as needed to keep each payload under limit. Sizes are added up once, nothing is serialized twice.
+    # message must not contain any item of field yet. Returns the list of serialized payloads.
+    field_number = message.DESCRIPTOR.fields_by_name[field].number
+    base_size = message.ByteSize()
+    if numbered:
+        num_msgs_size = varint_size(message.DESCRIPTOR.fields_by_name['num_msgs'].number << 3) + varint_size(len(items) + 1)
+        msgnum_size = varint_size(message.DESCRIPTOR.fields_by_name['msgnum'].number << 3) + varint_size(len(items) + 1)
+        base_size += num_msgs_size + msgnum_size
+    groups = []
+    group = []
+    size = base_size
+    for item in items:
+        encoded = encode_field(field_number, item)
+        if group and size + len(encoded) > limit:
+            groups.append(group)
+            group = []
+            size = base_size
+        group.append(encoded)
+        size += len(encoded)
+    groups.append(group)
+    payloads = []
+    for i, group in enumerate(groups):
+        if numbered:
+            message.num_msgs = len(groups)
+            message.msgnum = i + 1
+        payloads.append(message.SerializeToString() + b''.join(group))
+    return payloads
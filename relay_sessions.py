@@ -0,0 +1,84 @@
+import sys
+import time
+import threading
+
+class ClientSession:
+    # A client address (UDP or TCP) and the Relay of the player using it
+    __slots__ = ('relay', 'last_seen')
+
+    def __init__(self, relay):
+        self.relay = relay
+        self.last_seen = time.monotonic()
+
+class PlayerSession:
+    # Relay state of a player: when the pace partners, bots, bookmarks and far riders were last sent,
+    # packets received and the worldTime of each online peer state already sent (news)
+    __slots__ = ('last_pp_update', 'last_bot_update', 'last_bookmark_update', 'last_far_update', 'packets', 'news', 'last_seen')
+
+    def __init__(self):
+        self.last_pp_update = 0
+        self.last_bot_update = 0
+        self.last_bookmark_update = 0
+        self.last_far_update = 0
+        self.packets = 0
+        self.news = {}
+        self.last_seen = time.monotonic()
+
+# Per-connection and per-player relay state, entries not used for ttl seconds are dropped by evict()
+class RelaySessions:
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.clients = {} # (ip, port) -> ClientSession
+        self.players = {} # player id -> PlayerSession
+        self.lock = threading.Lock()
+
+    def client(self, address):
+        session = self.clients.get(address)
+        if session is not None:
+            session.last_seen = time.monotonic()
+        return session
+
+    def add_client(self, address, relay):
+        session = self.clients[address] = ClientSession(relay)
+        return session
+
+    def remove_client(self, address):
+        self.clients.pop(address, None)
+
+    def player(self, player_id):
+        session = self.players.get(player_id)
+        if session is None:
+            with self.lock:
+                session = self.players.setdefault(player_id, PlayerSession())
+        session.last_seen = time.monotonic()
+        return session
+
+    def is_state_new(self, player_id, state):
+        # True the first time the state (peer id, worldTime) is checked for player_id
+        news = self.player(player_id).news
+        if news.get(state.id) == state.worldTime:
+            return False #already sent
+        news[state.id] = state.worldTime
+        return True
+
+    def evict(self, world_time):
+        # Drops expired sessions and the news about states older than 30 seconds
+        expired = time.monotonic() - self.ttl
+        with self.lock:
+            for address, session in list(self.clients.items()):
+                if session.last_seen < expired:
+                    self.clients.pop(address, None)
+            for player_id, session in list(self.players.items()):
+                if session.last_seen < expired:
+                    self.players.pop(player_id, None)
+                elif session.news:
+                    for p_id, t in list(session.news.items()):
+                        if t < world_time - 30000:
+                            session.news.pop(p_id, None)
+
+    def counters(self):
+        news = sum(len(session.news) for session in list(self.players.values()))
+        size = sys.getsizeof(self.clients) + sys.getsizeof(self.players)
+        size += len(self.clients) * sys.getsizeof(ClientSession(None))
+        size += sum(sys.getsizeof(session) + sys.getsizeof(session.news) for session in list(self.players.values()))
+        return {'clients': len(self.clients), 'players': len(self.players), 'news': news, 'bytes': size}
@@ -0,0 +1,262 @@
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+import udp_node_msgs_pb2
+import ghost_file
+
+# Columnar route file converted from a ghost .bin, Ghost protobuf or compact (ghost_file), of the bots,
+# pace partners and played ghosts. Opened with mmap, the processes and the bots sharing a route share its
+# read-only pages, and a PlayerState is only built when a state is needed as an object: the serialized
+# states are sent as they are.
+#   MAGIC, HEADER (byte order, player id, number of states n, size of the serialized states)
+#   columns x, y_altitude, z (float), f19, aux3 (uint32), roadTime, distance (int32), heading (int64): n values each
+#   offsets of the serialized states (uint32): n + 1 values, then the serialized states
+MAGIC = b'ZOROUTE2'
+HEADER = struct.Struct('=BxxxqII')
+COLUMNS = (('x', 'f'), ('y_altitude', 'f'), ('z', 'f'), ('f19', 'I'), ('aux3', 'I'), ('roadTime', 'i'), ('distance', 'i'), ('heading', 'q'))
+BYTE_ORDER = 1 if sys.byteorder == 'little' else 2 # files are in the native byte order, converted again if moved
+
+def route_path(ghost_path):
+    return os.path.splitext(ghost_path)[0] + '.route'
+
+def convert(ghost_path, path=None):
+    # Writes the route file of a Ghost .bin file, returns its path
+    if path is None:
+        path = route_path(ghost_path)
+    with open(ghost_path, 'rb') as f:
+        data = f.read()
+    if ghost_file.is_compact(data):
+        player_id, values, encoded = ghost_file.decode(data) # no Ghost to build, the columns are in the file
+        columns = [array(code, values[name]) for name, code in COLUMNS]
+    else:
+        ghost = udp_node_msgs_pb2.Ghost.FromString(data)
+        player_id = ghost.player_id
+        columns = [array(code, (getattr(s, name) for s in ghost.states)) for name, code in COLUMNS]
+        encoded = [s.SerializeToString() for s in ghost.states]
+    offsets = array('I', [0])
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + HEADER.pack(BYTE_ORDER, player_id, len(encoded), offsets[-1]))
+        for column in columns:
+            f.write(column.tobytes())
+        f.write(offsets.tobytes())
+        f.write(b''.join(encoded))
+    os.replace(tmp, path)
+    return path
+
+class MappedStates:
+    # Read-only sequence of the PlayerState of a MappedRoute, built on access
+    def __init__(self, route):
+        self.route = route
+
+    def __len__(self):
+        return self.route.count
+
+    def __getitem__(self, i):
+        return udp_node_msgs_pb2.PlayerState.FromString(self.route.encoded(i))
+
+    def __iter__(self):
+        for i in range(self.route.count):
+            yield self[i]
+
+class MappedRoute:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a route file' % path)
+        start = len(MAGIC) + HEADER.size
+        if len(self.map) < start:
+            raise ValueError('%s is truncated' % path)
+        byte_order, self.player_id, self.count, data_size = HEADER.unpack_from(self.map, len(MAGIC))
+        if byte_order != BYTE_ORDER:
+            raise ValueError('%s has another byte order' % path)
+        sizes = [array(code).itemsize * self.count for name, code in COLUMNS]
+        self.data = start + sum(sizes) + 4 * (self.count + 1)
+        # the columns, offsets and serialized states must all be in the file before they are cast
+        if len(self.map) < self.data + data_size:
+            raise ValueError('%s is truncated' % path)
+        view = memoryview(self.map)
+        self.columns = {}
+        for (name, code), size in zip(COLUMNS, sizes):
+            self.columns[name] = view[start:start + size].cast(code)
+            start += size
+        self.offsets = view[start:self.data].cast('I')
+        if self.offsets[self.count] != data_size:
+            raise ValueError('%s has wrong offsets' % path)
+        self.states = MappedStates(self)
+        self.timeline = None
+
+    def encoded(self, i):
+        # serialized PlayerState i
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('route state index out of range')
+        return self.map[self.data + self.offsets[i]:self.data + self.offsets[i + 1]]
+
+def load_route(ghost_path):
+    # MappedRoute of a Ghost .bin file, converted on first load, or the parsed Ghost if it can't be
+    path = route_path(ghost_path)
+    try:
+        if not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(ghost_path):
+            convert(ghost_path, path)
+        try:
+            return MappedRoute(path)
+        except ValueError:
+            return MappedRoute(convert(ghost_path, path))
+    except OSError as exc:
+        print('load_route %s: %s' % (ghost_path, repr(exc)))
+    return ghost_file.read_ghost(ghost_path)
+
+def route_size(route):
+    if isinstance(route, MappedRoute):
+        return len(route.map)
+    return route.ByteSize()
+
+class RouteCache:
+    # Routes by Ghost .bin path, least recently used first, dropped beyond budget bytes of routes.
+    # A route still used by a bot or a ghost stays alive and is shared with the next get()
+    def __init__(self, budget=256 << 20):
+        self.budget = budget
+        self.routes = OrderedDict() # path -> (mtime_ns, route, size)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        with self.lock:
+            item = self.routes.get(path)
+            if item is not None and item[0] == mtime:
+                self.routes.move_to_end(path)
+                self.hits += 1
+                return item[1]
+        route = load_route(path)
+        size = route_size(route)
+        with self.lock:
+            self.misses += 1
+            old = self.routes.pop(path, None)
+            if old is not None:
+                self.size -= old[2]
+            self.routes[path] = (mtime, route, size)
+            self.size += size
+            while self.size > self.budget and len(self.routes) > 1:
+                self.size -= self.routes.popitem(last=False)[1][2]
+        return route
+
+    def counters(self):
+        with self.lock:
+            return {'routes': len(self.routes), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+def encoded_state(route, i):
+    if isinstance(route, MappedRoute):
+        return route.encoded(i)
+    return route.states[i].SerializeToString()
+
+def column(route, name):
+    # values of a field (one of COLUMNS) for every state of the route
+    if isinstance(route, MappedRoute):
+        return route.columns[name]
+    return [getattr(s, name) for s in route.states]
+
+def route_state(route, i, player_id):
+    # PlayerState i of the route with the id of the bot, pace partner or ghost replaying it, a new
+    # object: the states of a parsed Ghost are shared by every bot using the route
+    if isinstance(route, MappedRoute):
+        state = route.states[i]
+    else:
+        state = udp_node_msgs_pb2.PlayerState()
+        state.CopyFrom(route.states[i])
+    state.id = player_id
+    return state
+
+class RoadTimeline:
+    # States of a route by (road id, forward) sorted by roadTime, so the state nearest to a position
+    # is found with a bisect instead of a scan of the route
+    def __init__(self, route):
+        f19, aux3, road_time, distance = (column(route, name) for name in ('f19', 'aux3', 'roadTime', 'distance'))
+        roads = {}
+        for i in range(len(f19)):
+            roads.setdefault(((aux3[i] & 0xff00) >> 8, (f19[i] & 4) != 0), []).append(i)
+        self.roads = {}
+        for key, states in roads.items():
+            states.sort(key=lambda i: road_time[i])
+            self.roads[key] = ([road_time[i] for i in states], [distance[i] for i in states], states)
+
+    def nearest(self, road, forward, road_time, distance):
+        # index of the state minimizing |roadTime difference| + |distance difference| (the lowest index
+        # if several do), the states are visited by increasing roadTime difference until it alone is
+        # larger than the best found
+        timeline = self.roads.get((road, forward))
+        if timeline is None:
+            return None
+        times, distances, states = timeline
+        hi = bisect_left(times, road_time)
+        lo = hi - 1
+        best = None
+        best_cost = 0
+        while lo >= 0 or hi < len(times):
+            if hi >= len(times) or (lo >= 0 and road_time - times[lo] <= times[hi] - road_time):
+                j = lo
+                lo -= 1
+                cost = road_time - times[j]
+            else:
+                j = hi
+                hi += 1
+                cost = times[j] - road_time
+            if best is not None and cost > best_cost:
+                break
+            cost += abs(distance - distances[j])
+            if best is None or cost < best_cost or (cost == best_cost and states[j] < best):
+                best = states[j]
+                best_cost = cost
+        return best
+
+def road_timeline(route):
+    # RoadTimeline of a route, built once for a MappedRoute
+    if not isinstance(route, MappedRoute):
+        return RoadTimeline(route)
+    if route.timeline is None:
+        route.timeline = RoadTimeline(route)
+    return route.timeline
+
+HEADING_TURN = 6283185 # heading of a full turn (radians * 1000000)
+
+def interpolation(route, i, fraction):
+    # Fields of a state at fraction (0 to 1) of the way from state i to state i + 1 of the route, to append
+    # to state i with relay_codec.encode_overrides. Nothing is interpolated at the end of the route or
+    # when the next state is on another road or direction, or on the other side of the end of a looped road.
+    if fraction <= 0 or i + 1 >= len(route.states):
+        return {}
+    if isinstance(route, MappedRoute):
+        columns = route.columns
+    else:
+        columns = {name: [getattr(route.states[i], name), getattr(route.states[i + 1], name)] for name, code in COLUMNS}
+        i = 0
+    f19, aux3, road_time = columns['f19'], columns['aux3'], columns['roadTime']
+    if (f19[i] ^ f19[i + 1]) & 0xff0004 or (aux3[i] ^ aux3[i + 1]) & 0xff00 or abs(road_time[i + 1] - road_time[i]) > 500000:
+        return {}
+    fields = {}
+    for name in ('x', 'y_altitude', 'z'):
+        fields[name] = columns[name][i] + (columns[name][i + 1] - columns[name][i]) * fraction
+    for name in ('roadTime', 'distance'):
+        fields[name] = round(columns[name][i] + (columns[name][i + 1] - columns[name][i]) * fraction)
+    heading = columns['heading'][i]
+    turn = (columns['heading'][i + 1] - heading) % HEADING_TURN
+    if turn > HEADING_TURN // 2:
+        turn -= HEADING_TURN # the shorter way
+    fields['heading'] = round(heading + turn * fraction)
+    if 0 <= heading < HEADING_TURN:
+        fields['heading'] %= HEADING_TURN
+    return fields
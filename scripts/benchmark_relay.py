@@ -0,0 +1,714 @@
+#!/usr/bin/env python
+
+# Micro-benchmarks for the relay hot paths
+#
+# Usage: python benchmark_relay.py [benchmark ...]
+
+import os
+import sys
+import math
+import time
+import random
+import struct
+import select
+import socket
+import tempfile
+import threading
+import multiprocessing
+sys.path.insert(0, '../protobuf')
+sys.path.insert(0, '..')
+import udp_node_msgs_pb2
+import relay_codec
+from notifier import Notifier
+from world_updates import WorldUpdates, ALL
+from spatial_index import SpatialIndex
+import bot_engine
+from bot_table import BotTable, BotPopulation
+import bot_table
+import profile_pb2
+import route_file
+from ghost_index import GhostIndex
+from ghost_recorder import GhostRecorder
+import ghost_file
+from Crypto.Cipher import AES
+
+def random_state(i):
+    s = udp_node_msgs_pb2.PlayerState()
+    s.id = 1000000 + i
+    s.worldTime = random.randrange(1 << 40)
+    s.distance = random.randrange(100000)
+    s.roadTime = random.randrange(1000000)
+    s.speed = random.randrange(50000000)
+    s.power = random.randrange(500)
+    s.heading = random.randrange(6283184)
+    s.f19 = 0x60004
+    s.aux3 = 0x500
+    s.x = random.uniform(-100000, 100000)
+    s.y_altitude = random.uniform(0, 10000)
+    s.z = random.uniform(-100000, 100000)
+    return s
+
+def base_message():
+    message = udp_node_msgs_pb2.ServerToClient()
+    message.server_realm = udp_node_msgs_pb2.ZofflineConstants.RealmID
+    message.player_id = 1
+    message.world_time = 1 << 40
+    message.cts_latency = 50
+    return message
+
+def pack_reserialize(states):
+    # what UDPHandler used to do: serialize the whole message again for every appended state
+    messages = []
+    message = base_message()
+    for player in states:
+        if len(message.SerializeToString()) + len(player.SerializeToString()) > 1400:
+            new_msg = udp_node_msgs_pb2.ServerToClient()
+            new_msg.CopyFrom(message)
+            messages.append(new_msg)
+            del message.states[:]
+        message.states.append(player)
+    messages.append(message)
+    payloads = []
+    for i, msg in enumerate(messages):
+        msg.num_msgs = len(messages)
+        msg.msgnum = i + 1
+        payloads.append(msg.SerializeToString())
+    return payloads
+
+def pack_linear(states):
+    return relay_codec.pack_messages(base_message(), 'states', [s.SerializeToString() for s in states], numbered=True)
+
+def check_payloads(payloads, n):
+    count = 0
+    for i, payload in enumerate(payloads):
+        assert len(payload) <= relay_codec.MAX_PAYLOAD
+        msg = udp_node_msgs_pb2.ServerToClient()
+        msg.ParseFromString(payload)
+        assert msg.num_msgs == len(payloads) and msg.msgnum == i + 1
+        count += len(msg.states)
+    assert count == n
+
+def timeit(f, *args, duration=1):
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        f(*args)
+        n += 1
+    return (time.perf_counter() - start) / n
+
+def bench_packer():
+    print('ServerToClient packing')
+    print('%8s %14s %14s %8s' % ('states', 'reserialize', 'packer', 'speedup'))
+    for n in (10, 50, 100, 300, 1000):
+        states = [random_state(i) for i in range(n)]
+        check_payloads(pack_linear(states), n)
+        old = timeit(pack_reserialize, states)
+        new = timeit(pack_linear, states)
+        print('%8d %12.1fus %12.1fus %7.1fx' % (n, old * 1e6, new * 1e6, old / new))
+
+def gcm_iv(ct, ci, sn):
+    # what InitializationVector.data used to build for every packet
+    return bytearray(2) + struct.pack('!h', relay_codec.DeviceType.Relay) + struct.pack('!h', ct) + struct.pack('!h', ci) + struct.pack('!i', sn)
+
+def open_per_packet(key, data):
+    aesgcm = AES.new(key, AES.MODE_GCM, gcm_iv(relay_codec.ChannelType.UdpClient, 0, int.from_bytes(data[1:5], 'big')))
+    return aesgcm.decrypt(data[5:])
+
+def seal_per_packet(key, payloads, sn):
+    packets = []
+    for payload in payloads:
+        header = struct.pack('b', 1) + struct.pack('!i', sn)
+        aesgcm = AES.new(key, AES.MODE_GCM, gcm_iv(relay_codec.ChannelType.UdpServer, 0, sn))
+        aesgcm.update(header)
+        ep, tag = aesgcm.encrypt_and_digest(payload)
+        packets.append(header + ep + tag[:4])
+        sn += 1
+    return packets
+
+def bench_crypto():
+    key = os.urandom(16)
+    session = relay_codec.CryptoSession(key)
+    print('Relay crypto (packets/sec per core)')
+    print('%24s %12s %12s %8s' % ('', 'per packet', 'session', 'speedup'))
+    for size in (100, 300, 1400):
+        payload = os.urandom(size)
+        data = session.seal(payload, relay_codec.ChannelType.UdpClient, 0, 7, header_sn=7)
+        assert open_per_packet(key, data) == session.open(data, relay_codec.ChannelType.UdpClient, 0, 0).payload
+        old = timeit(open_per_packet, key, data)
+        new = timeit(session.open, data, relay_codec.ChannelType.UdpClient, 0, 0)
+        print('%24s %12d %12d %7.1fx' % ('open %d bytes' % size, 1 / old, 1 / new, old / new))
+    for n in (1, 3, 10):
+        payloads = [os.urandom(1400) for _ in range(n)]
+        assert seal_per_packet(key, payloads, 7) == session.seal_many(payloads, relay_codec.ChannelType.UdpServer, 0, 7, with_sn=True)
+        old = timeit(seal_per_packet, key, payloads, 7)
+        new = timeit(session.seal_many, payloads, relay_codec.ChannelType.UdpServer, 0, 7, True)
+        print('%24s %12d %12d %7.1fx' % ('seal %d x 1400 bytes' % n, n / old, n / new, old / new))
+
+def push_loop(sock, queue, notifier, stop):
+    # TCPHandler writer: 1 second recv timeout (old) or select on the player's notifier
+    sock.settimeout(1)
+    while not stop.is_set():
+        if notifier:
+            readable = select.select([sock, notifier], [], [], 1)[0]
+            if notifier in readable:
+                notifier.clear()
+        else:
+            try:
+                sock.recv(1024)
+            except socket.timeout:
+                pass
+        if queue:
+            items = list(queue)
+            del queue[:len(items)]
+            sock.sendall(b''.join(items))
+
+def bench_push():
+    print('Player update enqueue to socket latency')
+    print('%10s %10s %10s %10s' % ('', 'median', 'max', 'samples'))
+    for name, samples in (('polling', 10), ('notifier', 20)):
+        server, client = socket.socketpair()
+        queue = []
+        notifier = Notifier() if name == 'notifier' else None
+        stop = threading.Event()
+        thread = threading.Thread(target=push_loop, args=(server, queue, notifier, stop))
+        thread.start()
+        latencies = []
+        for _ in range(samples):
+            time.sleep(random.uniform(0, 1)) # anywhere in the 1 second keepalive period
+            start = time.perf_counter()
+            queue.append(b'x')
+            if notifier:
+                notifier.set()
+            client.recv(1)
+            latencies.append(time.perf_counter() - start)
+        stop.set()
+        if notifier:
+            notifier.set()
+        thread.join()
+        server.close()
+        client.close()
+        latencies.sort()
+        print('%10s %8.2fms %8.2fms %10d' % (name, latencies[len(latencies) // 2] * 1e3, latencies[-1] * 1e3, samples))
+
+def random_frames(n):
+    return [os.urandom(random.choice((0, 1, 20, 300, 1400, 5000))) for _ in range(n)]
+
+def check_frame_decoder(rounds=200):
+    # random split points: frames must come out whole and in order whatever the size of each read
+    for _ in range(rounds):
+        frames = random_frames(random.randrange(1, 30))
+        stream = b''.join(struct.pack('!H', len(f)) + f for f in frames)
+        cuts = sorted(random.sample(range(1, len(stream)), min(len(stream) - 1, random.randrange(0, 40))))
+        decoder = relay_codec.FrameDecoder(size=random.choice((16, 256, 4096)))
+        out = []
+        for a, b in zip([0] + cuts, cuts + [len(stream)]):
+            decoder.feed(stream[a:b])
+            out += decoder.frames()
+        assert out == frames
+        server, client = socket.socketpair()
+        decoder = relay_codec.FrameDecoder(size=random.choice((16, 256, 4096)))
+        out = []
+        received = 0
+        for a, b in zip([0] + cuts, cuts + [len(stream)]):
+            client.sendall(stream[a:b])
+            while received < b:
+                received += decoder.recv_into(server)
+            out += decoder.frames()
+        server.close()
+        client.close()
+        assert out == frames
+
+def recv_concat(sock, n):
+    # what TCPHandler did: recv(1024) and a bytes buffer concatenated on every read
+    buffer = b''
+    frames = []
+    while len(frames) < n:
+        buffer += sock.recv(1024)
+        i = 0
+        while len(buffer) - i >= 2:
+            size = int.from_bytes(buffer[i:i+2], 'big')
+            if len(buffer) - i < size + 2:
+                break
+            frames.append(buffer[i+2:i+2+size])
+            i += size + 2
+        buffer = buffer[i:]
+    return frames
+
+def recv_decoder(sock, n):
+    decoder = relay_codec.FrameDecoder()
+    frames = []
+    while len(frames) < n:
+        decoder.recv_into(sock)
+        frames += decoder.frames()
+    return frames
+
+def recv_stream(recv, stream, n):
+    server, client = socket.socketpair()
+    writer = threading.Thread(target=client.sendall, args=(stream,))
+    writer.start()
+    frames = recv(server, n)
+    writer.join()
+    server.close()
+    client.close()
+    return frames
+
+def bench_frames():
+    check_frame_decoder()
+    print('TCP frame decoding from a socket (random split points checked)')
+    print('%8s %14s %14s %8s' % ('frames', 'recv+concat', 'recv_into', 'speedup'))
+    for size in (20, 300, 1400, 5000):
+        frames = [os.urandom(size) for _ in range(200)]
+        stream = b''.join(struct.pack('!H', len(f)) + f for f in frames)
+        assert recv_stream(recv_concat, stream, len(frames)) == recv_stream(recv_decoder, stream, len(frames)) == frames
+        old = timeit(recv_stream, recv_concat, stream, len(frames))
+        new = timeit(recv_stream, recv_decoder, stream, len(frames))
+        print('%8s %12.1fus %12.1fus %7.1fx' % ('200x%d' % size, old * 1e6, new * 1e6, old / new))
+
+def chat_update():
+    wa = udp_node_msgs_pb2.WorldAttribute()
+    wa.server_realm = udp_node_msgs_pb2.ZofflineConstants.RealmID
+    wa.wa_type = udp_node_msgs_pb2.WA_TYPE.WAT_SPA
+    wa.world_time_expire = 1 << 40
+    wa.payload = os.urandom(100)
+    return wa
+
+def fanout_loop(updates, online, wa):
+    # previous relay_worlds_attributes: serialized again for every recipient
+    for player_id in online:
+        updates.enqueue(player_id, wa.SerializeToString(), wa.world_time_expire)
+
+def fanout_publish(updates, online, wa):
+    updates.publish(wa, (ALL,))
+
+def bench_fanout():
+    print('WorldAttribute sent to all players')
+    print('%8s %12s %12s %8s' % ('players', 'loop', 'publish', 'speedup'))
+    wa = chat_update()
+    for n in (10, 100, 1000):
+        updates = WorldUpdates(maxlen=10)
+        online = list(range(1, n + 1))
+        for player_id in online:
+            updates.track(player_id, 6)
+        fanout_publish(updates, online, wa)
+        assert updates.depth() == n and updates.members(ALL) == set(online)
+        old = timeit(fanout_loop, updates, online, wa)
+        new = timeit(fanout_publish, updates, online, wa)
+        print('%8d %10.1fus %10.1fus %7.1fx' % (n, old * 1e6, new * 1e6, old / new))
+
+class Bot:
+    position = 0
+    encoded = None
+
+def bot_routes(n, length=1000):
+    routes = []
+    for r in range(n):
+        route = udp_node_msgs_pb2.Ghost()
+        x, z = random.uniform(-500000, 500000), random.uniform(-500000, 500000)
+        for i in range(length):
+            s = route.states.add()
+            s.f19 = 0x60004
+            s.aux3 = (r % 50) << 8
+            s.x, s.y_altitude, s.z = x + i * 1000, random.uniform(0, 10000), z + i * 300
+            s.roadTime = i
+        routes.append(route)
+    return routes
+
+def bots_python_tick(bots, index):
+    # previous play_bots: every bot serialized and indexed at every tick
+    for bot_id, bot in bots.items():
+        bot.position = bot.position + 1 if bot.position < len(bot.route.states) - 1 else 0
+        state = bot.route.states[bot.position]
+        state.id = bot_id
+        bot.encoded = state.SerializeToString() + relay_codec.encode_overrides(udp_node_msgs_pb2.PlayerState, id=bot_id, groupId=0)
+    index.update_many((bot_id, (s.f19 & 0xff0000) >> 16, (s.aux3 & 0xff00) >> 8, s.x, s.z)
+                      for bot_id, s in ((bot_id, bot.route.states[bot.position]) for bot_id, bot in bots.items()))
+
+def bots_python_query(bots, index, s):
+    found = []
+    for p_id in index.query((s.f19 & 0xff0000) >> 16, (s.aux3 & 0xff00) >> 8, s.x, s.z):
+        b = bots[p_id].route.states[bots[p_id].position]
+        if (b.f19 & 0xff0000) >> 16 == (s.f19 & 0xff0000) >> 16:
+            dist = math.sqrt((b.x - s.x)**2 + (b.z - s.z)**2 + (b.y_altitude - s.y_altitude)**2)
+            if dist <= 100000 or (b.aux3 & 0xff00) == (s.aux3 & 0xff00):
+                found.append((p_id, dist))
+    return found
+
+def bots_engine_query(engine, s):
+    return engine.query((s.f19 & 0xff0000) >> 16, (s.aux3 & 0xff00) >> 8, s.x, s.y_altitude, s.z)
+
+def bench_bots():
+    if not bot_engine.np:
+        print('bots: NumPy is not installed')
+        return
+    print('Bots tick and 100 nearby queries')
+    print('%8s %12s %12s %8s %12s %12s %8s' % ('bots', 'python tick', 'engine tick', 'speedup', 'python query', 'engine query', 'speedup'))
+    routes = bot_routes(100)
+    for n in (1000, 10000, 30000):
+        bots = {}
+        for i in range(n):
+            bot = bots[1000000 + i] = Bot()
+            bot.route = routes[i % len(routes)]
+            bot.position = random.randrange(len(bot.route.states))
+        index = SpatialIndex()
+        bots_python_tick(bots, index)
+        engine = bot_engine.BotEngine(bots)
+        players = [routes[random.randrange(len(routes))].states[random.randrange(1000)] for _ in range(100)]
+        for s in players:
+            old, new = sorted(bots_python_query(bots, index, s)), sorted(bots_engine_query(engine, s))
+            assert [p_id for p_id, d in old] == [p_id for p_id, d in new]
+            assert all(math.isclose(d1, d2) for (i1, d1), (i2, d2) in zip(old, new))
+        old_tick = timeit(bots_python_tick, bots, index)
+        new_tick = timeit(engine.tick)
+        index = SpatialIndex()
+        bots_python_tick(bots, index)
+        engine.tick()
+        engine.read_positions()
+        engine.update_rows()
+        old_query = timeit(lambda: [bots_python_query(bots, index, s) for s in players])
+        new_query = timeit(lambda: [bots_engine_query(engine, s) for s in players])
+        print('%8d %10.1fms %10.1fms %7.1fx %10.1fms %10.1fms %7.1fx' % (n, old_tick * 1e3, new_tick * 1e3, old_tick / new_tick,
+              old_query * 1e3, new_query * 1e3, old_query / new_query))
+
+def rss():
+    # private memory, the pages of the mapped route files are shared
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) * 1024
+
+def load_routes_child(paths, mapped, queue):
+    start, memory = time.perf_counter(), rss()
+    routes = []
+    for path in paths:
+        if mapped:
+            routes.append(route_file.load_route(path))
+        else:
+            route = udp_node_msgs_pb2.Ghost()
+            with open(path, 'rb') as f:
+                route.ParseFromString(f.read())
+            routes.append(route)
+    load = time.perf_counter() - start
+    for route in routes: # bots go through all the states
+        for i in range(len(route.states)):
+            route.states[i]
+    queue.put((load, rss() - memory))
+
+def load_routes_time(paths, mapped):
+    context = multiprocessing.get_context('spawn') # nothing inherited from the benchmark process
+    queue = context.Queue()
+    process = context.Process(target=load_routes_child, args=(paths, mapped, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def bench_routes():
+    print('Loading 50 ghosts of 2000 states: Ghost protobuf vs route file (already converted)')
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for i, route in enumerate(bot_routes(50, 2000)):
+            route.player_id = 1
+            for s in route.states:
+                s.worldTime = random.randrange(1 << 40)
+                s.distance, s.speed, s.power, s.heading = (random.randrange(1 << 20) for _ in range(4))
+            paths.append(os.path.join(folder, '%s.bin' % i))
+            with open(paths[-1], 'wb') as f:
+                f.write(route.SerializeToString())
+        start = time.perf_counter()
+        for path in paths:
+            route_file.convert(path)
+        print('conversion %.1fms' % ((time.perf_counter() - start) * 1e3))
+        print('%10s %10s %10s' % ('', 'load', 'private'))
+        for name, mapped in (('protobuf', False), ('route', True)):
+            duration, memory = load_routes_time(paths, mapped)
+            print('%10s %8.1fms %8.1fMB' % (name, duration * 1e3, memory / 1e6))
+
+def load_ghosts_folder_parse(folder):
+    # previous load_ghosts_folder: every ghost file of the folder parsed at each ride start
+    routes = []
+    for f in os.listdir(folder):
+        if f.endswith('.bin'):
+            with open(os.path.join(folder, f), 'rb') as fd:
+                route = udp_node_msgs_pb2.Ghost()
+                route.ParseFromString(fd.read())
+                routes.append((route, route.states[0].worldTime))
+    return routes
+
+def load_ghosts_folder_index(index, cache):
+    return [(cache.get(g['path']), g['date']) for g in index.folder(1, '6/5')]
+
+def bench_ghosts():
+    print('Ride start with the ghosts of one road folder')
+    print('%8s %12s %12s %8s' % ('ghosts', 'parse', 'index', 'speedup'))
+    for n in (10, 100, 300):
+        with tempfile.TemporaryDirectory() as storage:
+            folder = '%s/1/ghosts/6/5' % storage
+            os.makedirs(folder)
+            for i, route in enumerate(bot_routes(n, 1000)):
+                route.player_id = 1
+                with open('%s/%s.bin' % (folder, i), 'wb') as f:
+                    f.write(route.SerializeToString())
+            cache = route_file.RouteCache()
+            index = GhostIndex(storage, cache)
+            assert len(load_ghosts_folder_index(index, cache)) == len(load_ghosts_folder_parse(folder)) == n
+            old = timeit(load_ghosts_folder_parse, folder)
+            new = timeit(load_ghosts_folder_index, index, cache)
+            print('%8d %10.1fms %10.1fms %7.1fx' % (n, old * 1e3, new * 1e3, old / new))
+
+def timeline_routes(folder, n, length=2000):
+    # mapped routes going over 5 roads in both directions, several laps
+    routes = []
+    for r in range(n):
+        route = udp_node_msgs_pb2.Ghost()
+        route.player_id = 1
+        for i in range(length):
+            s = route.states.add()
+            s.f19 = 0x60000 | (4 if (i // 100 + r) % 3 else 0)
+            s.aux3 = ((i // 100 + r) % 5) << 8
+            s.roadTime = (i % 100) * 10000 + random.randrange(1000)
+            s.distance = i * 10
+        path = os.path.join(folder, '%s.bin' % r)
+        with open(path, 'wb') as f:
+            f.write(route.SerializeToString())
+        routes.append(route_file.load_route(path))
+    return routes
+
+def nearest_scan(state, route):
+    # previous zwift_offline.nearest
+    road, forward = (state.aux3 & 0xff00) >> 8, (state.f19 & 4) != 0
+    f19, aux3, road_time, distance = (route_file.column(route, name) for name in ('f19', 'aux3', 'roadTime', 'distance'))
+    states = [i for i in range(len(f19)) if (aux3[i] & 0xff00) >> 8 == road and ((f19[i] & 4) != 0) == forward]
+    if not states:
+        return None
+    return min(states, key=lambda i: abs(state.roadTime - road_time[i]) + abs(state.distance - distance[i]))
+
+def group_scan(state, bots):
+    return {bot_id: nearest_scan(state, bot.route) for bot_id, bot in bots.items()}
+
+def group_timeline(state, bots):
+    # zwift_offline.group_bots: nearest once per route
+    positions = {}
+    found = {}
+    for bot_id, bot in bots.items():
+        if not id(bot.route) in positions:
+            positions[id(bot.route)] = route_file.road_timeline(bot.route).nearest((state.aux3 & 0xff00) >> 8, (state.f19 & 4) != 0, state.roadTime, state.distance)
+        found[bot_id] = positions[id(bot.route)]
+    return found
+
+def bench_group():
+    print('.group of every bot (100 routes of 2000 states): scan of the route vs road timeline')
+    print('%8s %12s %12s %12s %8s' % ('bots', 'scan', 'first', 'timeline', 'speedup'))
+    with tempfile.TemporaryDirectory() as folder:
+        routes = timeline_routes(folder, 100)
+        player = udp_node_msgs_pb2.PlayerState()
+        for _ in range(200):
+            route = random.choice(routes)
+            i = random.randrange(len(route.states))
+            player.f19, player.aux3 = route.columns['f19'][i], route.columns['aux3'][i]
+            player.roadTime = route.columns['roadTime'][i] + random.randrange(-20000, 20000)
+            player.distance = route.columns['distance'][i] + random.randrange(-5000, 5000)
+            for other in routes[:10]:
+                assert nearest_scan(player, other) == route_file.road_timeline(other).nearest(
+                    (player.aux3 & 0xff00) >> 8, (player.f19 & 4) != 0, player.roadTime, player.distance)
+        for n in (1000, 10000):
+            for route in routes:
+                route.timeline = None
+            bots = {}
+            for i in range(n):
+                bot = bots[1000000 + i] = Bot()
+                bot.route = routes[i % len(routes)]
+            start = time.perf_counter()
+            group_timeline(player, bots)
+            first = time.perf_counter() - start
+            old = timeit(group_scan, player, bots)
+            new = timeit(group_timeline, player, bots)
+            print('%8d %10.1fms %10.1fms %10.1fms %7.1fx' % (n, old * 1e3, first * 1e3, new * 1e3, old / new))
+
+def bot_profile(bot_id):
+    p = profile_pb2.PlayerProfile()
+    p.id = bot_id
+    p.first_name, p.last_name = 'First', 'Last'
+    p.bike_frame, p.ride_jersey, p.country_code = bot_id * 7919 % (1 << 31), bot_id * 104729 % (1 << 31), 100
+    return p
+
+def bots_dict(routes, n):
+    # previous global_bots: a BotVariables object with its PlayerProfile for every bot
+    bots = {}
+    for i in range(n):
+        bot = bots[1000000 + i] = Bot()
+        bot.route = routes[i % len(routes)]
+        bot.position = random.randrange(len(bot.route.states))
+        bot.profile = bot_profile(1000000 + i)
+    return bots
+
+def bots_table(routes, n):
+    table = BotTable()
+    for i in range(n):
+        route = routes[i % len(routes)]
+        table.population.add(1000000 + i, route, random.randrange(len(route.states)), bot_profile(1000000 + i))
+    return table
+
+def bots_size(f, *args):
+    # the PlayerProfile objects are not allocated by Python, the private memory of the process is measured
+    memory = rss()
+    bots = f(*args)
+    return bots, rss() - memory
+
+def bench_table():
+    print('Bots of a multiplier (100 routes): BotVariables and PlayerProfile objects vs BotTable, tick without NumPy')
+    print('%8s %12s %12s %12s %12s %8s' % ('bots', 'dict/bot', 'table/bot', 'dict tick', 'table tick', 'speedup'))
+    with tempfile.TemporaryDirectory() as folder:
+        routes = timeline_routes(folder, 100)
+        for n in (10000, 100000):
+            bots, dict_size = bots_size(bots_dict, routes, n)
+            table, table_size = bots_size(bots_table, routes, n)
+            dict_index, table_index = SpatialIndex(), SpatialIndex()
+            def dict_tick():
+                for bot_id, bot in bots.items():
+                    if bot.position < len(bot.route.states) - 1: bot.position += 1
+                    else: bot.position = 0
+                dict_index.update_many(((bot_id, (s.f19 & 0xff0000) >> 16, (s.aux3 & 0xff00) >> 8, s.x, s.z)
+                    for bot_id, s in ((bot_id, bot.route.states[bot.position]) for bot_id, bot in bots.items())))
+            def table_tick():
+                table.tick()
+                table_index.update_many(table.index_items())
+            for bot_id, slot in table.population.slots.items():
+                table.population.positions[slot] = bots[bot_id].position
+            dict_tick()
+            table_tick()
+            assert all(table[bot_id].position == bot.position for bot_id, bot in bots.items())
+            assert table[1000000].profile == bots[1000000].profile
+            old = timeit(dict_tick)
+            new = timeit(table_tick)
+            print('%8d %11dB %11dB %10.1fms %10.1fms %7.1fx' % (n, dict_size / n, table_size / n, old * 1e3, new * 1e3, old / new))
+
+def bench_snapshot():
+    print('Bot population of 100 ghosts: built (profiles drawn, no random_equipment) vs loaded from the snapshot')
+    print('%8s %12s %12s %12s %8s' % ('bots', 'build', 'save', 'load', 'speedup'))
+    with tempfile.TemporaryDirectory() as folder:
+        routes = timeline_routes(folder, 100)
+        paths = [os.path.join(folder, '%s.bin' % r) for r in range(len(routes))]
+        cache = {path: route for path, route in zip(paths, routes)}
+        snapshot = os.path.join(folder, 'bots.bin')
+        for multiplier in (10, 100):
+            def build():
+                population = BotPopulation()
+                for i, (path, route) in enumerate(zip(paths, routes)):
+                    for n in range(multiplier):
+                        bot_id = i + 1000000 + n * 10000
+                        population.add(bot_id, route, random.randrange(len(route.states)), bot_profile(bot_id), path)
+                return population
+            population = build()
+            key = bot_table.snapshot_key({'multiplier': multiplier})
+            start = time.perf_counter()
+            bot_table.save_snapshot(snapshot, key, population)
+            save = time.perf_counter() - start
+            loaded = bot_table.load_snapshot(snapshot, key, cache.get)
+            assert list(loaded.ids) == list(population.ids) and list(loaded.positions) == list(population.positions)
+            assert loaded.profiles == population.profiles and loaded.paths == population.paths
+            assert bot_table.load_snapshot(snapshot, bot_table.snapshot_key({'multiplier': 0}), cache.get) is None
+            old = timeit(build)
+            new = timeit(bot_table.load_snapshot, snapshot, key, cache.get)
+            print('%8d %10.1fms %10.1fms %10.1fms %7.1fx' % (len(population.ids), old * 1e3, save * 1e3, new * 1e3, old / new))
+
+def bench_interpolation():
+    print('Bot state sent: cached serialized state vs interpolated between two route states')
+    print('%8s %12s %12s' % ('states', 'cached', 'interpolated'))
+    with tempfile.TemporaryDirectory() as folder:
+        route = timeline_routes(folder, 1)[0]
+        encoded = [route_file.encoded_state(route, i) + relay_codec.encode_overrides(udp_node_msgs_pb2.PlayerState, id=1000000, groupId=0)
+                   for i in range(len(route.states))]
+        positions = [random.randrange(len(route.states) - 1) for _ in range(1000)]
+        def cached():
+            return [encoded[i] for i in positions]
+        def interpolated():
+            return [encoded[i] + relay_codec.encode_overrides(udp_node_msgs_pb2.PlayerState, **route_file.interpolation(route, i, 0.5)) for i in positions]
+        for data in interpolated():
+            udp_node_msgs_pb2.PlayerState.FromString(data)
+        old = timeit(cached)
+        new = timeit(interpolated)
+        print('%8d %10.1fus %10.1fus' % (len(positions), old * 1e6, new * 1e6))
+
+def record_memory(riders, states, recorders):
+    memory = rss()
+    recordings = []
+    for r in range(riders):
+        if recorders:
+            recording = GhostRecorder(os.path.join(recorders, str(r)), r)
+            for s in states:
+                recording.append(s)
+        else:
+            recording = udp_node_msgs_pb2.Ghost()
+            for s in states:
+                recording.states.append(s)
+        recordings.append(recording)
+    return rss() - memory
+
+def bench_recorder():
+    print('Ghost recording of 2 hour rides (2400 states): Ghost in memory vs GhostRecorder file')
+    print('%8s %12s %12s %12s %12s' % ('riders', 'Ghost memory', 'file memory', 'Ghost append', 'file append'))
+    states = [random_state(i) for i in range(2400)]
+    with tempfile.TemporaryDirectory() as folder:
+        recording = GhostRecorder(os.path.join(folder, 'timeit'), 1)
+        old = timeit(lambda: udp_node_msgs_pb2.Ghost().states.append(states[0]))
+        new = timeit(recording.append, states[0])
+        for riders in (10, 100):
+            memory = record_memory(riders, states, None)
+            recorder = record_memory(riders, states, folder)
+            print('%8d %10.1fMB %10.1fMB %10.1fus %10.1fus' % (riders, memory / 1e6, recorder / 1e6, old * 1e6, new * 1e6))
+
+def ride_ghost(length):
+    # ghost of a ride on a winding road, a state per second
+    ghost = udp_node_msgs_pb2.Ghost()
+    ghost.player_id = 1
+    x, z, heading, speed = 0.0, 0.0, 0.0, 10.0
+    for i in range(length):
+        heading += random.uniform(-0.02, 0.02) if i % 300 < 250 else 0.2
+        speed = min(max(speed + random.uniform(-0.5, 0.5), 5), 15)
+        x += math.cos(heading) * speed * 100
+        z += math.sin(heading) * speed * 100
+        s = ghost.states.add()
+        s.id = 1
+        s.worldTime = (1 << 40) + i * 1000
+        s.distance = i * 10
+        s.roadTime = 5000 + (i * 500) % 990000
+        s.speed = round(speed * 3600000)
+        s.power = 200 + random.randrange(-20, 20)
+        s.heading = round(heading * 1000000) % route_file.HEADING_TURN
+        s.cadenceUHz = 1500000
+        s.f19 = 0x60004
+        s.aux3 = (5 + (i * 500) // 990000 % 3) << 8
+        s.x = x
+        s.y_altitude = 9000 + math.sin(i / 200) * 2000
+        s.z = z
+    return ghost
+
+def bench_compact():
+    print('Ghost files of 2 hour rides (7200 states): Ghost protobuf vs compact (ghost_file)')
+    print('%10s %10s %10s %10s %10s %10s %10s' % ('tolerance', 'protobuf', 'compact', 'write', 'read', 'convert', 'max error'))
+    ghost = ride_ghost(7200)
+    data = ghost.SerializeToString()
+    with tempfile.TemporaryDirectory() as folder:
+        def convert(data):
+            # route file conversion, done when a ghost is first loaded
+            path = os.path.join(folder, 'ghost.bin')
+            with open(path, 'wb') as f:
+                f.write(data)
+            return timeit(route_file.convert, path)
+        for tolerance in (0, 10, 50):
+            compacted = ghost_file.compact(ghost, tolerance)
+            expanded = ghost_file.expand(compacted)
+            assert len(expanded.states) == len(ghost.states)
+            error = max(math.dist((a.x, a.y_altitude, a.z), (b.x, b.y_altitude, b.z)) for a, b in zip(ghost.states, expanded.states))
+            if tolerance == 0:
+                assert error < 0.1 and all(a.speed == b.speed and a.roadTime == b.roadTime and a.heading == b.heading for a, b in zip(ghost.states, expanded.states))
+            write = timeit(ghost_file.compact, ghost, tolerance)
+            read = timeit(ghost_file.parse_ghost, compacted)
+            print('%8dcm %8.1fKB %8.1fKB %8.1fms %8.1fms %8.1fms %8.1fcm' % (tolerance, len(data) / 1e3, len(compacted) / 1e3, write * 1e3, read * 1e3, convert(compacted) * 1e3, error))
+        print('%10s %10s %10s %10s %8.1fms %8.1fms' % ('protobuf', '', '', '', timeit(ghost_file.parse_ghost, data) * 1e3, convert(data) * 1e3))
+
+BENCHMARKS = {'packer': bench_packer, 'crypto': bench_crypto, 'push': bench_push, 'frames': bench_frames, 'fanout': bench_fanout, 'bots': bench_bots, 'routes': bench_routes, 'ghosts': bench_ghosts, 'group': bench_group, 'table': bench_table, 'snapshot': bench_snapshot, 'interpolation': bench_interpolation, 'recorder': bench_recorder, 'compact': bench_compact}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS.keys():
+        BENCHMARKS[name]()
@@ -9,8 +9,9 @@ import os
 import sys
 import csv
 sys.path.insert(0, '../protobuf')
+sys.path.insert(0, '..')
 import profile_pb2
-import udp_node_msgs_pb2
+import ghost_file
 
 try:
     input = raw_input
@@ -53,9 +54,7 @@ if file_exists(PROFILE_FILE):
 
 ROUTE_FILE = 'route.bin'
 if file_exists(ROUTE_FILE):
-    g = udp_node_msgs_pb2.Ghost()
-    with open(ROUTE_FILE, 'rb') as f:
-        g.ParseFromString(f.read())
+    g = ghost_file.read_ghost(ROUTE_FILE) # compact ghosts are written back as a Ghost
     start_road = int(input("Start road: "))
     start_rt = int(input("Start roadTime: "))
     print('Deleted records:\n')
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+# Rewrites the recorded ghosts (storage/<player id>/ghosts) in the compact format of ghost_file, or
+# back as Ghost protobuf files with --expand for the tools that only read this format. The server
+# reads both, new ghosts are saved compact if storage/compact_ghosts.txt exists.
+#
+# Usage: python compact_ghosts.py [--tolerance 10] [--expand] [--storage ../storage]
+#
+# --tolerance (cm, default 0) also drops the states within tolerance of the line between the states
+# kept around them, they are rebuilt on load by interpolation. 0 keeps every state.
+
+import argparse
+import os
+import sys
+sys.path.insert(0, '../protobuf')
+sys.path.insert(0, '..')
+import ghost_file
+
+def ghost_files(storage):
+    for player in sorted(os.listdir(storage)):
+        for (root, dirs, files) in os.walk(os.path.join(storage, player, 'ghosts')):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith('.bin'):
+                    yield os.path.join(root, name)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact or expand the recorded ghosts')
+    parser.add_argument('--tolerance', type=float, default=0, help='simplification tolerance (cm)')
+    parser.add_argument('--expand', action='store_true', help='write Ghost protobuf files')
+    parser.add_argument('--storage', default='../storage', help='storage folder')
+    args = parser.parse_args()
+
+    total = [0, 0]
+    for path in ghost_files(args.storage):
+        try:
+            if args.expand:
+                before, after = ghost_file.expand_file(path)
+            else:
+                before, after = ghost_file.compact_file(path, args.tolerance)
+        except Exception as exc:
+            print('%s: %s' % (path, repr(exc)))
+            continue
+        if before != after:
+            print('%s: %s -> %s bytes' % (path, before, after))
+        total[0] += before
+        total[1] += after
+    print('%s -> %s bytes' % tuple(total))
+
+if __name__ == '__main__':
+    main()
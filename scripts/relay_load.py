@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+# Synthetic relay load: fake players do the TCP hello on 3025 and stream encrypted ClientToServer
+# packets on 3024 while moving along recorded ghosts. For each number of players, reports the
+# server-to-client latency (p50/p99), packet loss and the CPU used by the server process(es).
+#
+# Usage: python relay_load.py --players 10,50,100,200 [--duration 30] [--server-pid PID[,PID...]]
+#
+# By default the relay keys are written to storage/<player id>/encryption_key.bin, so the load
+# generator must run on the server machine. When it exits, it waits for the server to log the fake
+# players out (it saves their bookmarks) and deletes the player folders it created. With --login
+# (multiplayer, accounts must exist), players log in through /api/users/login instead, e.g.
+# --login 'load{}:password' for load0, load1...
+
+import argparse
+import multiprocessing
+import os
+import random
+import selectors
+import shutil
+import socket
+import struct
+import sys
+import time
+import requests
+import urllib3
+sys.path.insert(0, '../protobuf')
+sys.path.insert(0, '..')
+import udp_node_msgs_pb2
+import login_pb2
+import relay_codec
+import ghost_file
+from relay_codec import ChannelType
+
+def world_time():
+    return int((time.time() - 1414016075) * 1000)
+
+def load_routes(storage, limit):
+    # Recorded ghosts, like load_bots in standalone.py
+    routes = []
+    if os.path.isdir(storage):
+        for name in os.listdir(storage):
+            path = os.path.join(storage, name, 'ghosts')
+            if os.path.isdir(path):
+                for (root, dirs, files) in os.walk(path):
+                    for f in files:
+                        if f.endswith('.bin') and len(routes) < limit:
+                            try:
+                                ghost = ghost_file.read_ghost(os.path.join(root, f))
+                            except Exception:
+                                continue
+                            if len(ghost.states) > 10:
+                                routes.append(ghost.states)
+    return routes
+
+def synthetic_route():
+    # Straight line on Watopia when there are no ghosts
+    x, z = random.uniform(-100000, 100000), random.uniform(-100000, 100000)
+    states = []
+    for i in range(200):
+        s = udp_node_msgs_pb2.PlayerState()
+        s.x = x + i * 2500
+        s.z = z
+        s.y_altitude = 10000
+        s.roadTime = 5000 + i * 1000
+        s.distance = i * 25
+        s.speed = 30000000
+        s.power = 200
+        s.f19 = (6 << 16) | 4
+        s.aux3 = 5 << 8
+        states.append(s)
+    return states
+
+def get_key(storage, player_id, login, host, api_port, created):
+    if login:
+        username, password = login
+        urllib3.disable_warnings()
+        key = os.urandom(16)
+        with requests.session() as session:
+            r = session.post('https://%s:%s/auth/realms/zwift/protocol/openid-connect/token' % (host, api_port),
+                data={'username': username, 'password': password, 'client_id': 'Zwift_Mobile_Link', 'grant_type': 'password'}, verify=False)
+            r.raise_for_status()
+            headers = {'Authorization': 'Bearer %s' % r.json()['access_token'], 'Content-Type': 'application/x-protobuf-lite'}
+            r = session.post('https://%s:%s/api/users/login' % (host, api_port), headers=headers,
+                data=login_pb2.LoginRequest(key=key).SerializeToString(), verify=False)
+            r.raise_for_status()
+            response = login_pb2.LoginResponse()
+            response.ParseFromString(r.content)
+        return response.relay_session_id, key
+    # the server keeps the first key it loaded for a player id, so reuse the file if there is one
+    key_file = os.path.join(storage, str(player_id), 'encryption_key.bin')
+    if os.path.isfile(key_file):
+        with open(key_file, 'rb') as f:
+            return player_id, f.read()
+    key = os.urandom(16)
+    player_dir = os.path.dirname(key_file)
+    if not os.path.isdir(player_dir):
+        os.makedirs(player_dir)
+        created.append(player_dir)
+    with open(key_file, 'wb') as f:
+        f.write(key)
+    return player_id, key
+
+def remove_players(created, wait):
+    # the player folders created by get_key, once the server has logged the fake players out: its
+    # remove_inactive saves a bookmark in them 30 seconds after their last state
+    if not created:
+        return
+    print('waiting %ds for the server to log the fake players out' % wait)
+    try:
+        time.sleep(wait)
+    finally:
+        for player_dir in created:
+            shutil.rmtree(player_dir, ignore_errors=True)
+        del created[:]
+
+class FakePlayer:
+    def __init__(self, player_id, key, route, host, tcp_port, udp_port):
+        self.player_id = player_id
+        self.crypto = relay_codec.CryptoSession(key)
+        self.route = route
+        self.offset = random.randrange(len(route))
+        self.udp_address = (host, udp_port)
+        self.sn = 0
+        self.last_wt = 0
+        self.pending = {} # world_time sent -> perf_counter
+        self.latencies = []
+        self.answered = 0
+        self.tcp = socket.create_connection((host, tcp_port), timeout=10)
+        hello = udp_node_msgs_pb2.ClientToServer(server_realm=1, player_id=player_id, world_time=0, state=self.state(), last_update=0, last_player_update=0)
+        r = self.crypto.seal(b'\x01\x00' + hello.SerializeToString(), ChannelType.TcpClient, 0, 0, header_ri=player_id, header_ci=0)
+        self.tcp.sendall(struct.pack('!h', len(r)) + r)
+        decoder = relay_codec.FrameDecoder()
+        frames = []
+        while not frames:
+            if not decoder.recv_into(self.tcp):
+                raise ConnectionError('TCP hello refused for player %s' % player_id)
+            frames = decoder.frames()
+        reply = udp_node_msgs_pb2.ServerToClient()
+        reply.ParseFromString(self.crypto.open(frames[0], ChannelType.TcpServer, 0, 0).payload[:-4])
+        self.tcp.setblocking(False)
+        self.udp = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.setblocking(False)
+
+    def state(self):
+        # ghosts are recorded every 3 seconds
+        s = udp_node_msgs_pb2.PlayerState()
+        s.CopyFrom(self.route[(self.offset + int(time.time() / 3)) % len(self.route)])
+        s.id = self.player_id
+        s.watchingRiderId = self.player_id
+        s.worldTime = world_time()
+        s.roadTime = s.roadTime or 1
+        return s
+
+    def send(self):
+        # world_time identifies the packet, the server replies with world_time - cts_latency = our world_time
+        wt = max(world_time(), self.last_wt + 1)
+        self.last_wt = wt
+        cts = udp_node_msgs_pb2.ClientToServer(server_realm=1, player_id=self.player_id, world_time=wt, state=self.state(), last_update=0, last_player_update=0)
+        if self.sn == 0:
+            r = self.crypto.seal(b'\x01' + cts.SerializeToString(), ChannelType.UdpClient, 0, 0, header_ri=self.player_id, header_ci=0, header_sn=0)
+        else:
+            r = self.crypto.seal(b'\x01' + cts.SerializeToString(), ChannelType.UdpClient, 0, self.sn, header_sn=self.sn)
+        self.sn += 1
+        self.pending[wt] = time.perf_counter()
+        self.udp.sendto(r, self.udp_address)
+
+    def receive(self):
+        while True:
+            try:
+                data = self.udp.recv(65536)
+            except BlockingIOError:
+                return
+            message = udp_node_msgs_pb2.ServerToClient()
+            try:
+                message.ParseFromString(self.crypto.open(data, ChannelType.UdpServer, 0, 0).payload[:-4])
+            except Exception:
+                continue
+            sent = self.pending.pop(message.world_time - message.cts_latency, None)
+            if sent is not None:
+                self.latencies.append(time.perf_counter() - sent)
+                self.answered += 1
+
+    def drain_tcp(self):
+        try:
+            while self.tcp.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        self.udp.close()
+        self.tcp.close()
+
+def run_players(players, args, routes, barrier, results):
+    # players: list of (player id, key)
+    fake = []
+    failed = 0
+    for player_id, key in players:
+        try:
+            fake.append(FakePlayer(player_id, key, random.choice(routes) if routes else synthetic_route(), args.host, args.tcp_port, args.udp_port))
+        except Exception as exc:
+            print('player %s: %s' % (player_id, repr(exc)))
+            failed += 1
+    selector = selectors.DefaultSelector()
+    for p in fake:
+        selector.register(p.udp, selectors.EVENT_READ, p.receive)
+        selector.register(p.tcp, selectors.EVENT_READ, p.drain_tcp)
+    barrier.wait()
+    start = time.perf_counter()
+    interval = 1 / args.rate
+    next_send = [start + random.uniform(0, interval) for p in fake]
+    end = start + args.duration
+    while True:
+        now = time.perf_counter()
+        if now >= end + args.grace:
+            break
+        if now < end:
+            for i, p in enumerate(fake):
+                if now >= next_send[i]:
+                    p.send()
+                    next_send[i] += interval
+        timeout = min(next_send + [end + args.grace]) - now if fake else end + args.grace - now
+        for key, events in selector.select(max(0, min(timeout, 0.05))):
+            key.data()
+    latencies = [l for p in fake for l in p.latencies]
+    sent = sum(p.sn for p in fake)
+    answered = sum(p.answered for p in fake)
+    for p in fake:
+        p.close()
+    results.put((latencies, sent, answered, failed))
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/%s/stat' % pid) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        except (OSError, ValueError, IndexError):
+            return None
+    return total
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def run_step(n, args, routes, created):
+    players = []
+    for i in range(n):
+        login = (args.login.split(':', 1)[0].format(i), args.login.split(':', 1)[1]) if args.login else None
+        players.append(get_key(args.storage, args.first_id + i, login, args.host, args.api_port, created))
+    processes = max(1, min(args.processes, n))
+    barrier = multiprocessing.Barrier(processes + 1)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run_players, args=(players[i::processes], args, routes, barrier, results)) for i in range(processes)]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    cpu_start = cpu_seconds(args.server_pid)
+    wall_start = time.perf_counter()
+    time.sleep(args.duration)
+    cpu_end = cpu_seconds(args.server_pid)
+    wall = time.perf_counter() - wall_start
+    latencies, sent, answered, failed = [], 0, 0, 0
+    for w in workers:
+        l, s, a, f = results.get()
+        latencies += l
+        sent += s
+        answered += a
+        failed += f
+    for w in workers:
+        w.join()
+    latencies.sort()
+    cpu = '%7.1f%%' % ((cpu_end - cpu_start) / wall * 100) if cpu_start is not None and cpu_end is not None else '%8s' % 'n/a'
+    print('%8d %8d %8d %7.2f%% %8.2fms %8.2fms %s' % (n - failed, sent, answered, (sent - answered) / sent * 100 if sent else 0,
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, cpu))
+    sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic load for the zoffline relay')
+    parser.add_argument('--players', default='10,50,100', help='comma separated numbers of players, one step each (default: 10,50,100)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds per step (default: 30)')
+    parser.add_argument('--rate', type=float, default=1, help='UDP packets per second per player (default: 1)')
+    parser.add_argument('--grace', type=float, default=2, help='seconds to wait for late replies at the end of a step (default: 2)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--tcp-port', type=int, default=3025)
+    parser.add_argument('--udp-port', type=int, default=3024)
+    parser.add_argument('--api-port', type=int, default=443)
+    parser.add_argument('--storage', default='../storage', help='server storage folder, for keys and ghosts (default: ../storage)')
+    parser.add_argument('--login', help="log in as 'username{}:password' ({} is replaced by the player number) instead of writing keys")
+    parser.add_argument('--first-id', type=int, default=500000, help='player id of the first fake player when writing keys (default: 500000)')
+    parser.add_argument('--routes', type=int, default=100, help='maximum number of ghosts to load (default: 100)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() // 2 or 1, help='load generator processes')
+    parser.add_argument('--server-pid', default='', help='comma separated pids of the server processes, for CPU usage (Linux)')
+    parser.add_argument('--logout-wait', type=float, default=40, help='seconds to wait for the server to log the fake players out before deleting their folders (default: 40)')
+    args = parser.parse_args()
+    args.server_pid = [int(pid) for pid in args.server_pid.split(',') if pid]
+    routes = load_routes(args.storage, args.routes)
+    print('%d ghosts loaded, %s' % (len(routes), 'players log in' if args.login else 'writing keys to %s' % args.storage))
+    print('%8s %8s %8s %8s %10s %10s %8s' % ('players', 'sent', 'answered', 'loss', 'p50', 'p99', 'cpu'))
+    created = []
+    try:
+        for n in args.players.split(','):
+            run_step(int(n), args, routes, created)
+    finally:
+        remove_players(created, args.logout_wait)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Replays relay captures (storage/capture.txt, see relay_capture.py) into an in-process relay:
+# the received UDP packets and TCP frames go through handle_udp_packet and TCPSession like on the
+# server, with zo.world_time() returning the world time of the capture, so the same capture gives
+# the same replies on every run. Reports the CPU used per packet to compare relay versions.
+#
+# Usage: python relay_replay.py ../storage/capture-20240101-120000.bin [capture.1 ...] [--speed 0]
+#
+# --speed 0 (default) replays as fast as possible, 1 at the captured speed, 2 twice as fast...
+# The relay configuration (world_tick.txt, interest.txt) is read from storage like the server does,
+# pace partners and bots are not started.
+
+import argparse
+import heapq
+import os
+import sys
+import tempfile
+import threading
+import time
+sys.path.insert(0, '../protobuf')
+sys.path.insert(0, '..')
+import zwift_offline as zo
+import standalone
+import relay_capture
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay relay captures')
+    parser.add_argument('captures', nargs='+', help='capture files, the files of the UDP workers are merged')
+    parser.add_argument('--speed', type=float, default=0, help='0 = as fast as possible, 1 = captured speed')
+    parser.add_argument('--world-tick', action='store_true', help='start the world tick thread if world_tick.txt exists')
+    args = parser.parse_args()
+
+    clock = [0]
+    zo.world_time = lambda: clock[0]
+    #TCPSession.hello saves the relay keys, keep them out of the real storage
+    standalone.STORAGE_DIR = tempfile.mkdtemp(prefix='relay_replay')
+    if standalone.world_tick_rate:
+        if args.world_tick:
+            wt = threading.Thread(target=standalone.world_tick)
+            wt.daemon = True
+            wt.start()
+        else:
+            standalone.world_tick_rate = 0
+
+    sent = [0, 0]
+    def sendto(data, address):
+        sent[0] += 1
+        sent[1] += len(data)
+
+    records = heapq.merge(*[relay_capture.read_capture(path) for path in args.captures], key=lambda r: r[1])
+    tcp_sessions = {}
+    counts = {relay_capture.UDP: 0, relay_capture.TCP: 0}
+    cpu = {relay_capture.UDP: 0, relay_capture.TCP: 0}
+    errors = 0
+    first = None
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    for kind, t, world_time, address, payload in records:
+        if first is None:
+            first = t
+        if args.speed:
+            pause = (t - first) / args.speed - (time.perf_counter() - start_wall)
+            if pause > 0:
+                time.sleep(pause)
+        clock[0] = world_time
+        if kind == relay_capture.KEY:
+            relay_id = int.from_bytes(payload[:4], 'big')
+            os.makedirs('%s/%s' % (standalone.STORAGE_DIR, relay_id), exist_ok=True)
+            standalone.global_relay[relay_id] = zo.Relay(payload[4:])
+            continue
+        if kind == relay_capture.TCP_CLOSE:
+            session = tcp_sessions.pop(address, None)
+            if session:
+                session.close()
+            continue
+        c = time.thread_time()
+        try:
+            if kind == relay_capture.UDP:
+                standalone.handle_udp_packet(payload, address, sendto)
+            elif kind == relay_capture.TCP:
+                session = tcp_sessions.get(address)
+                if session is None:
+                    session = tcp_sessions[address] = standalone.TCPSession(address)
+                    replies = [session.hello(payload)]
+                    if replies[0] is None:
+                        tcp_sessions.pop(address)
+                        replies = []
+                else:
+                    replies = session.client_packets([payload])
+                if address in tcp_sessions:
+                    replies += session.server_packets()
+                for r in replies:
+                    sendto(r, address)
+        except Exception as exc:
+            print('Replay exception: %s' % repr(exc))
+            errors += 1
+        cpu[kind] += time.thread_time() - c
+        counts[kind] += 1
+    wall = time.perf_counter() - start_wall
+    total_cpu = time.process_time() - start_cpu
+    for session in tcp_sessions.values():
+        session.close()
+
+    packets = counts[relay_capture.UDP] + counts[relay_capture.TCP]
+    print('%8s %8s %8s %8s %10s %8s %8s %10s %10s %10s' % ('udp', 'tcp', 'sent', 'errors', 'bytes out', 'wall s', 'cpu s', 'us/packet', 'us/udp', 'us/tcp'))
+    print('%8d %8d %8d %8d %10d %8.2f %8.2f %10.1f %10.1f %10.1f' % (counts[relay_capture.UDP], counts[relay_capture.TCP], sent[0],
+        errors + standalone.udp_decode_errors.value, sent[1], wall, total_cpu, total_cpu * 1e6 / max(packets, 1),
+        cpu[relay_capture.UDP] * 1e6 / max(counts[relay_capture.UDP], 1), cpu[relay_capture.TCP] * 1e6 / max(counts[relay_capture.TCP], 1)))
+    sys.stdout.flush()
+    os._exit(0) #zwift_offline and standalone may have started threads
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import threading
+
+# Uniform x/z grid per course with a road side table, used to find riders close to a position
+# without checking every rider, bot and pace partner in the world
+class SpatialIndex:
+    def __init__(self, cell_size=100000):
+        self.cell_size = cell_size
+        self.cells = {} # course -> (cell x, cell z) -> set of ids
+        self.roads = {} # course -> road id -> set of ids
+        self.entries = {} # id -> (course, cell, road)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def cell(self, x, z):
+        return int(x // self.cell_size), int(z // self.cell_size)
+
+    def _add(self, id, course, cell, road):
+        self.cells.setdefault(course, {}).setdefault(cell, set()).add(id)
+        self.roads.setdefault(course, {}).setdefault(road, set()).add(id)
+        self.entries[id] = (course, cell, road)
+
+    def _remove(self, id):
+        entry = self.entries.pop(id, None)
+        if entry is None:
+            return
+        course, cell, road = entry
+        ids = self.cells[course][cell]
+        ids.discard(id)
+        if not ids:
+            del self.cells[course][cell]
+        ids = self.roads[course][road]
+        ids.discard(id)
+        if not ids:
+            del self.roads[course][road]
+
+    def _update(self, id, course, road, x, z):
+        cell = self.cell(x, z)
+        if self.entries.get(id) != (course, cell, road):
+            self._remove(id)
+            self._add(id, course, cell, road)
+
+    def update(self, id, course, road, x, z):
+        with self.lock:
+            self._update(id, course, road, x, z)
+
+    def update_many(self, items):
+        # items: iterable of (id, course, road, x, z)
+        with self.lock:
+            for item in items:
+                self._update(*item)
+
+    def remove(self, id):
+        with self.lock:
+            self._remove(id)
+
+    def clear(self):
+        with self.lock:
+            self.cells.clear()
+            self.roads.clear()
+            self.entries.clear()
+
+    def query(self, course, road, x, z, radius=100000):
+        # Candidates within radius (whole cells) plus everyone on the same road, caller checks actual distance
+        cx, cz = self.cell(x, z)
+        r = max(1, -(-radius // self.cell_size))
+        found = set()
+        with self.lock:
+            cells = self.cells.get(course)
+            if cells:
+                for i in range(cx - r, cx + r + 1):
+                    for j in range(cz - r, cz + r + 1):
+                        ids = cells.get((i, j))
+                        if ids:
+                            found.update(ids)
+            roads = self.roads.get(course)
+            if roads and road in roads:
+                found.update(roads[road])
+        return found
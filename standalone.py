@@ -2,6 +2,8 @@
 
 import os
 import signal
+import socket
+import select
 import struct
 import sys
 import threading
@@ -9,14 +11,29 @@ import time
 import json
 import math
 import random
-import itertools
+import heapq
 import socketserver
+import asyncio
+import concurrent.futures
 from urllib3 import PoolManager
 from http.server import SimpleHTTPRequestHandler
 from datetime import datetime, timedelta
-from Crypto.Cipher import AES
 
 import zwift_offline as zo
+import relay_codec
+from relay_codec import ChannelType
+from spatial_index import SpatialIndex
+from world_table import WorldTable
+from notifier import Notifier
+from relay_sessions import RelaySessions
+from bot_engine import BotEngine
+from bot_table import BotTable, BotPopulation, TickClock
+from ghost_recorder import GhostRecorder
+import bot_table
+import bot_engine
+import route_file
+import relay_capture
+import metrics
 import udp_node_msgs_pb2
 import tcp_node_msgs_pb2
 import profile_pb2
@@ -62,44 +79,85 @@ if not CDN_PROXY and not os.path.isfile('%s/disable_proxy.txt' % STORAGE_DIR):
 PACE_PARTNERS_DIR = "%s/robopacers" % STORAGE_DIR
 FAKE_DNS_FILE = "%s/fake-dns.txt" % STORAGE_DIR
 ENABLE_BOTS_FILE = "%s/enable_bots.txt" % STORAGE_DIR
+BOTS_SNAPSHOT_FILE = "%s/bots.bin" % STORAGE_DIR
+WORLD_TICK_FILE = "%s/world_tick.txt" % STORAGE_DIR
+BOTS_TICK_FILE = "%s/bots_tick.txt" % STORAGE_DIR
+INTEREST_FILE = "%s/interest.txt" % STORAGE_DIR
+CAPTURE_FILE = "%s/capture.txt" % STORAGE_DIR
 DISCORD_CONFIG_FILE = "%s/discord.cfg" % STORAGE_DIR
+class DummyDiscord():
+    def send_message(self, msg, sender_id=None):
+        pass
+    def change_presence(self, n):
+        pass
+    announce = False
 if os.path.isfile(DISCORD_CONFIG_FILE):
     from discord_bot import DiscordThread
     discord = DiscordThread(DISCORD_CONFIG_FILE)
 else:
-    class DummyDiscord():
-        def send_message(self, msg, sender_id=None):
-            pass
-        def change_presence(self, n):
-            pass
-        announce = False
     discord = DummyDiscord()
 
 bot_update_freq = 3
 pacer_update_freq = 1
+bot_max_speed = 3000 #cm/s, to find the bots that rode into range since the SpatialIndex was updated
 simulated_latency = 300 #makes bots animation smoother than using current time
-last_pp_updates = {}
-last_bot_updates = {}
-last_bookmark_updates = {}
 global_ghosts = {}
 online = {}
 global_pace_partners = {}
-global_bots = {}
-global_news = {} #player id to dictionary of peer_player_id->worldTime
+global_bots = BotTable()
 global_relay = {}
-global_clients = {}
+sessions = RelaySessions() #client addresses and per-player relay state
+
+udp_packets_in = metrics.counter('zoffline_udp_packets_received_total', 'UDP packets received')
+udp_bytes_in = metrics.counter('zoffline_udp_bytes_received_total', 'UDP bytes received')
+udp_packets_out = metrics.counter('zoffline_udp_packets_sent_total', 'UDP packets sent')
+udp_bytes_out = metrics.counter('zoffline_udp_bytes_sent_total', 'UDP bytes sent')
+udp_decode_errors = metrics.counter('zoffline_udp_decode_errors_total', 'UDP packets that could not be decoded')
+nearby_riders = metrics.histogram('zoffline_nearby_riders', 'Riders states sent in a reply to a UDP packet', (0, 1, 2, 5, 10, 20, 50, 100, 200))
+tcp_connections = metrics.gauge('zoffline_tcp_connections', 'TCP relay connections')
+tick_duration = metrics.histogram('zoffline_tick_duration_seconds', 'Duration of the bots, pace partners and world ticks', (.001, .005, .01, .05, .1, .5, 1, 5), ('thread',))
+tick_interval = metrics.gauge('zoffline_tick_interval_seconds', 'Interval of the bots, pace partners and world ticks', ('thread',))
+for name in ['clients', 'players', 'news', 'bytes']:
+    metrics.gauge('zoffline_relay_sessions_%s' % name, 'Relay sessions %s' % name).set_function(lambda name=name: sessions.counters()[name])
+metrics.gauge('zoffline_online_riders', 'Riders online').set_function(lambda: len(online))
+world_tick_rate = 0 #world ticks per second, 0 = compute nearby riders for every received packet
+world_tick_lock = threading.Lock()
+ghosts_lock = threading.Lock()
+bots_tick = 0 #seconds between the bots and pace partners ticks if BOTS_TICK_FILE exists, 0 = a tick per recorded state
+bots_clock = TickClock(bot_update_freq) #time of the current bots positions, the states sent are interpolated from there
+pace_partners_clock = TickClock(pacer_update_freq)
+interest = {'max_riders': 100} #nearby riders sent to a player, distance tiers if INTEREST_FILE exists
+player_states = {} #player id to last state received from the client
+new_states = set() #players whose last state was not used by world_tick yet
+nearby_found = {} #player id to the riders found nearby by world_tick for the last state of the player
+visible_states = {} #player id to states of the riders found nearby at the last world_tick, not sent yet
+online_index = SpatialIndex()
+pace_partners_index = SpatialIndex()
+bots_index = SpatialIndex()
+bots_engine = None #BotEngine of the bots and pace partners if NumPy is installed, replaces their SpatialIndex
+pace_partners_engine = None
+world_table = None #riders shared by the UDP worker processes (ZOFFLINE_UDP_WORKERS)
+udp_worker = 0 #number of this UDP worker process, 0 = main process
+udp_worker_pids = []
+capture = None #RelayCapture of the received packets if CAPTURE_FILE exists
 
 def sigint_handler(num, frame):
     httpd.shutdown()
     httpd.server_close()
-    tcpserver.shutdown()
-    tcpserver.server_close()
-    udpserver.shutdown()
-    udpserver.server_close()
+    if relay_transport == 'asyncio':
+        relay_loop.call_soon_threadsafe(relay_loop.stop)
+    else:
+        tcpserver.shutdown()
+        tcpserver.server_close()
+        if not udp_workers:
+            udpserver.shutdown()
+            udpserver.server_close()
+    for pid in udp_worker_pids:
+        os.kill(pid, signal.SIGTERM)
+    if capture:
+        capture.flush()
     os._exit(0)
 
-signal.signal(signal.SIGINT, sigint_handler)
-
 class CDNHandler(SimpleHTTPRequestHandler):
     def translate_path(self, path):
         path = SimpleHTTPRequestHandler.translate_path(self, path)
@@ -138,100 +196,26 @@ class CDNHandler(SimpleHTTPRequestHandler):
 
         SimpleHTTPRequestHandler.do_GET(self)
 
-class DeviceType:
-    Relay = 1
-    Zc = 2
-
-class ChannelType:
-    UdpClient = 1
-    UdpServer = 2
-    TcpClient = 3
-    TcpServer = 4
-
-class Packet:
-    flags = None
-    ri = None
-    ci = None
-    sn = None
-    payload = None
-
-class InitializationVector:
-    def __init__(self, dt = 0, ct = 0, ci = 0, sn = 0):
-        self._dt = struct.pack('!h', dt)
-        self._ct = struct.pack('!h', ct)
-        self._ci = struct.pack('!h', ci)
-        self._sn = struct.pack('!i', sn)
-    @property
-    def dt(self):
-        return self._dt
-    @dt.setter
-    def dt(self, v):
-        self._dt = struct.pack('!h', v)
-    @property
-    def ct(self):
-        return self._ct
-    @ct.setter
-    def ct(self, v):
-        self._ct = struct.pack('!h', v)
-    @property
-    def ci(self):
-        return self._ci
-    @ci.setter
-    def ci(self, v):
-        self._ci = struct.pack('!h', v)
-    @property
-    def sn(self):
-        return self._sn
-    @sn.setter
-    def sn(self, v):
-        self._sn = struct.pack('!i', v)
-    @property
-    def data(self):
-        return bytearray(2) + self._dt + self._ct + self._ci + self._sn
-
-def decode_packet(data, key, iv):
-    p = Packet()
-    s = 1
-    p.flags = data[0]
-    if p.flags & 4:
-        p.ri = int.from_bytes(data[s:s+4], "big")
-        s += 4
-    if p.flags & 2:
-        p.ci = int.from_bytes(data[s:s+2], "big")
-        iv.ci = p.ci
-        s += 2
-    if p.flags & 1:
-        p.sn = int.from_bytes(data[s:s+4], "big")
-        iv.sn = p.sn
-        s += 4
-    aesgcm = AES.new(key, AES.MODE_GCM, iv.data)
-    p.payload = aesgcm.decrypt(data[s:])
-    return p
-
-def encode_packet(payload, key, iv, ri, ci, sn):
-    flags = 0
-    header = b''
-    if ri is not None:
-        flags = flags | 4
-        header += struct.pack('!i', ri)
-    if ci is not None:
-        flags = flags | 2
-        header += struct.pack('!h', ci)
-    if sn is not None:
-        flags = flags | 1
-        header += struct.pack('!i', sn)
-    aesgcm = AES.new(key, AES.MODE_GCM, iv.data)
-    header = struct.pack('b', flags) + header
-    aesgcm.update(header)
-    ep, tag = aesgcm.encrypt_and_digest(payload)
-    return header + ep + tag[:4]
+def tcp_frame(r):
+    return struct.pack('!h', len(r)) + r
 
-class TCPHandler(socketserver.BaseRequestHandler):
-    def handle(self):
-        self.data = self.request.recv(1024)
-        ip = self.client_address[0] + str(self.client_address[1])
-        if not ip in global_clients.keys():
-            relay_id = int.from_bytes(self.data[3:7], "big")
+class TCPSession:
+    #Relay side of a TCP connection, used by both the threaded and the asyncio servers
+    def __init__(self, client_address, wake=None):
+        self.client_address = client_address
+        self.wake = wake #called by the notifier from any thread instead of making it readable
+        self.relay = None
+        self.ci = 0
+        self.player_id = None
+        self.msg = None
+        self.notifier = None
+
+    def hello(self, frame):
+        #Returns the framed reply to the hello packet or None if the connection must be closed
+        address = self.client_address[:2] + ('tcp',) #not the UDP client using the same port number
+        client = sessions.client(address)
+        if client is None or frame[0] & 4: #with the relay id, the address may have been used by another player before
+            relay_id = int.from_bytes(frame[1:5], "big")
             ENCRYPTION_KEY_FILE = "%s/%s/encryption_key.bin" % (STORAGE_DIR, relay_id)
             if relay_id in global_relay.keys():
                 with open(ENCRYPTION_KEY_FILE, 'wb') as f:
@@ -241,42 +225,43 @@ class TCPHandler(socketserver.BaseRequestHandler):
                     global_relay[relay_id] = zo.Relay(f.read())
             else:
                 print('No encryption key for relay ID %s' % relay_id)
-                return
-            global_clients[ip] = global_relay[relay_id]
-        if int.from_bytes(self.data[0:2], "big") != len(self.data) - 2:
-            print("Wrong packet size")
-            return
-        relay = global_clients[ip]
-        iv = InitializationVector(DeviceType.Relay, ChannelType.TcpClient, relay.tcp_ci, 0)
-        p = decode_packet(self.data[2:], relay.key, iv)
+                return None
+            client = sessions.add_client(address, global_relay[relay_id])
+            if capture:
+                capture.key(zo.world_time(), relay_id, global_relay[relay_id].key)
+        if capture:
+            capture.write(relay_capture.TCP, zo.world_time(), self.client_address, frame)
+        relay = self.relay = client.relay
+        p = relay.crypto.open(frame, ChannelType.TcpClient, relay.tcp_ci, 0)
         if p.ci is not None:
             relay.tcp_ci = p.ci
             relay.tcp_r_sn = 1
             relay.tcp_t_sn = 0
-            iv.ci = p.ci
+        self.ci = relay.tcp_ci
         if len(p.payload) > 1 and p.payload[1] != 0:
             print("TCPHandler hello(0) expected, got %s" % p.payload[1])
-            return
+            return None
         hello = udp_node_msgs_pb2.ClientToServer()
         try:
             hello.ParseFromString(p.payload[2:-4]) #2 bytes: payload length, 1 byte: =0x1 (TcpClient::sendClientToServer) 1 byte: type; payload; 4 bytes: hash
             #type: TcpClient::sayHello(=0x0), TcpClient::sendSubscribeToSegment(=0x1), TcpClient::processSegmentUnsubscription(=0x1)
         except Exception as exc:
             print('TCPHandler ParseFromString exception: %s' % repr(exc))
-            return
+            return None
         # send packet containing UDP server (127.0.0.1)
-        msg = udp_node_msgs_pb2.ServerToClient()
+        peer_ip = self.client_address[0]
+        msg = self.msg = udp_node_msgs_pb2.ServerToClient()
         msg.player_id = hello.player_id
         msg.world_time = 0
         details1 = msg.udp_config.relay_addresses.add()
         details1.lb_realm = udp_node_msgs_pb2.ZofflineConstants.RealmID
         details1.lb_course = 6 # watopia crowd
-        details1.ip = self.request.getpeername()[0] if self.request.getpeername()[0] in ['127.0.0.1', '::1'] else zo.server_ip
+        details1.ip = peer_ip if peer_ip in ['127.0.0.1', '::1'] else zo.server_ip
         details1.port = 3022
         details2 = msg.udp_config.relay_addresses.add()
         details2.lb_realm = 0 #generic load balancing realm
         details2.lb_course = 0 #generic load balancing course
-        details2.ip = self.request.getpeername()[0] if self.request.getpeername()[0] in ['127.0.0.1', '::1'] else zo.server_ip
+        details2.ip = peer_ip if peer_ip in ['127.0.0.1', '::1'] else zo.server_ip
         details2.port = 3022
         msg.udp_config.uc_f2 = 10
         msg.udp_config.uc_f3 = 30
@@ -291,103 +276,184 @@ class TCPHandler(socketserver.BaseRequestHandler):
         wdetails2.relay_addresses.append(details2)
         msg.udp_config_vod_1.port = 3022
         payload = msg.SerializeToString()
-        iv.ct = ChannelType.TcpServer
-        r = encode_packet(payload, relay.key, iv, None, None, None)
+        r = relay.crypto.seal(payload, ChannelType.TcpServer, self.ci, 0)
         relay.tcp_t_sn += 1
-        self.request.sendall(struct.pack('!h', len(r)) + r)
+        self.player_id = hello.player_id
+        self.notifier = Notifier(self.wake)
+        zo.world_updates.subscribe(self.player_id, self.notifier)
+        tcp_connections.inc()
+        return tcp_frame(r)
 
-        player_id = hello.player_id
-        self.request.settimeout(1) #make recv non-blocking
-        while True:
-            self.data = b''
-            try:
-                self.data = self.request.recv(1024)
-                i = 0
-                while i < len(self.data):
-                    size = int.from_bytes(self.data[i:i+2], "big")
-                    packet = self.data[i:i+size+2]
-                    iv.ct = ChannelType.TcpClient
-                    iv.sn = relay.tcp_r_sn
-                    p = decode_packet(packet[2:], relay.key, iv)
-                    relay.tcp_r_sn += 1
-                    if len(p.payload) > 1 and p.payload[1] == 1:
-                        subscr = udp_node_msgs_pb2.ClientToServer()
-                        try:
-                            subscr.ParseFromString(p.payload[2:-4])
-                        except Exception as exc:
-                            print('TCPHandler ParseFromString exception: %s' % repr(exc))
-                        if subscr.subsSegments:
-                            msg1 = udp_node_msgs_pb2.ServerToClient()
-                            msg1.server_realm = udp_node_msgs_pb2.ZofflineConstants.RealmID
-                            msg1.player_id = subscr.player_id
-                            msg1.world_time = zo.world_time()
-                            msg1.ackSubsSegm.extend(subscr.subsSegments)
-                            payload1 = msg1.SerializeToString()
-                            iv.ct = ChannelType.TcpServer
-                            iv.sn = relay.tcp_t_sn
-                            r = encode_packet(payload1, relay.key, iv, None, None, None)
-                            relay.tcp_t_sn += 1
-                            self.request.sendall(struct.pack('!h', len(r)) + r)
-                    i += size + 2
-            except:
-                pass #timeout is ok here
+    def close(self):
+        if capture and self.relay:
+            capture.write(relay_capture.TCP_CLOSE, zo.world_time(), self.client_address)
+        if self.notifier:
+            zo.world_updates.unsubscribe(self.player_id, self.notifier)
+            self.notifier.close()
+            tcp_connections.dec()
+            self.notifier = None
 
-            try:
-                #if ZC need to be registered
-                if player_id in zo.zc_connect_queue:
-                    zc_params = udp_node_msgs_pb2.ServerToClient()
-                    zc_params.player_id = player_id
-                    zc_params.world_time = 0
-                    zc_params.zc_local_ip = zo.zc_connect_queue[player_id][0]
-                    zc_params.zc_local_port = zo.zc_connect_queue[player_id][1] #simple:21587, secure:21588
-                    if zo.zc_connect_queue[player_id][2] != "None":
-                        zc_params.zc_key = zo.zc_connect_queue[player_id][2]
-                    zc_params.zc_protocol = udp_node_msgs_pb2.IPProtocol.TCP #=2
-                    zc_params_payload = zc_params.SerializeToString()
-                    iv.ct = ChannelType.TcpServer
-                    iv.sn = relay.tcp_t_sn
-                    r = encode_packet(zc_params_payload, relay.key, iv, None, None, None)
-                    relay.tcp_t_sn += 1
-                    self.request.sendall(struct.pack('!h', len(r)) + r)
-                    zo.zc_connect_queue.pop(player_id)
-
-                messages = []
-
-                #PlayerUpdate
-                if player_id in zo.player_update_queue and len(zo.player_update_queue[player_id]) > 0:
-                    message = udp_node_msgs_pb2.ServerToClient()
-                    message.server_realm = udp_node_msgs_pb2.ZofflineConstants.RealmID
-                    message.player_id = player_id
-                    message.world_time = zo.world_time()
-                    for player_update_proto in list(zo.player_update_queue[player_id]):
-                        if len(message.SerializeToString()) + len(player_update_proto) > 1400:
-                            new_msg = udp_node_msgs_pb2.ServerToClient()
-                            new_msg.CopyFrom(message)
-                            messages.append(new_msg)
-                            del message.updates[:]
-                        player_update = message.updates.add()
-                        player_update.ParseFromString(player_update_proto)
-                        zo.player_update_queue[player_id].remove(player_update_proto)
-                    messages.append(message)
-                else: #keepalive
-                    messages.append(msg)
-
-                for message in messages:
-                    message_payload = message.SerializeToString()
-                    iv.ct = ChannelType.TcpServer
-                    iv.sn = relay.tcp_t_sn
-                    r = encode_packet(message_payload, relay.key, iv, None, None, None)
+    def client_packets(self, frames):
+        #Handles the frames received from the client, returns the framed replies
+        relay = self.relay
+        replies = []
+        for frame in frames:
+            if capture:
+                capture.write(relay_capture.TCP, zo.world_time(), self.client_address, frame)
+            p = relay.crypto.open(frame, ChannelType.TcpClient, self.ci, relay.tcp_r_sn)
+            if p.ci is not None:
+                self.ci = p.ci
+            relay.tcp_r_sn += 1
+            if len(p.payload) > 1 and p.payload[1] == 1:
+                subscr = udp_node_msgs_pb2.ClientToServer()
+                try:
+                    subscr.ParseFromString(p.payload[2:-4])
+                except Exception as exc:
+                    print('TCPHandler ParseFromString exception: %s' % repr(exc))
+                if subscr.subsSegments:
+                    msg1 = udp_node_msgs_pb2.ServerToClient()
+                    msg1.server_realm = udp_node_msgs_pb2.ZofflineConstants.RealmID
+                    msg1.player_id = subscr.player_id
+                    msg1.world_time = zo.world_time()
+                    msg1.ackSubsSegm.extend(subscr.subsSegments)
+                    payload1 = msg1.SerializeToString()
+                    r = relay.crypto.seal(payload1, ChannelType.TcpServer, self.ci, relay.tcp_t_sn)
                     relay.tcp_t_sn += 1
-                    self.request.sendall(struct.pack('!h', len(r)) + r)
-            except Exception as exc:
-                print('TCPHandler loop exception: %s' % repr(exc))
-                break
+                    replies.append(tcp_frame(r))
+        return replies
+
+    def server_packets(self):
+        #ZC registration, pending player updates or keepalive, returns the framed packets
+        relay = self.relay
+        player_id = self.player_id
+        payloads = []
+        #if ZC need to be registered
+        if player_id in zo.zc_connect_queue:
+            zc_params = udp_node_msgs_pb2.ServerToClient()
+            zc_params.player_id = player_id
+            zc_params.world_time = 0
+            zc_params.zc_local_ip = zo.zc_connect_queue[player_id][0]
+            zc_params.zc_local_port = zo.zc_connect_queue[player_id][1] #simple:21587, secure:21588
+            if zo.zc_connect_queue[player_id][2] != "None":
+                zc_params.zc_key = zo.zc_connect_queue[player_id][2]
+            zc_params.zc_protocol = udp_node_msgs_pb2.IPProtocol.TCP #=2
+            payloads.append(zc_params.SerializeToString())
+            zo.zc_connect_queue.pop(player_id)
+
+        #PlayerUpdate
+        world_time = zo.world_time()
+        player_updates = zo.world_updates.pop(player_id, world_time)
+        if player_updates:
+            message = udp_node_msgs_pb2.ServerToClient()
+            message.server_realm = udp_node_msgs_pb2.ZofflineConstants.RealmID
+            message.player_id = player_id
+            message.world_time = world_time
+            payloads += relay_codec.pack_messages(message, 'updates', player_updates)
+        else: #keepalive
+            payloads.append(self.msg.SerializeToString())
+
+        packets = [tcp_frame(r) for r in relay.crypto.seal_many(payloads, ChannelType.TcpServer, self.ci, relay.tcp_t_sn)]
+        relay.tcp_t_sn += len(packets)
+        return packets
+
+class TCPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        session = TCPSession(self.client_address)
+        decoder = relay_codec.FrameDecoder()
+        frames = []
+        while not frames:
+            if not decoder.recv_into(self.request):
+                return
+            frames = decoder.frames()
+        reply = session.hello(frames[0])
+        if reply is None:
+            return
+        self.request.sendall(reply)
+        for r in session.client_packets(frames[1:]):
+            self.request.sendall(r)
+
+        try:
+            while True:
+                #wake up for client packets, queued updates (session.notifier) or keepalive after 1 second
+                readable = select.select([self.request, session.notifier], [], [], 1)[0]
+                if session.notifier in readable:
+                    session.notifier.clear()
+                if self.request in readable:
+                    try:
+                        if not decoder.recv_into(self.request):
+                            break
+                    except OSError:
+                        break
+                    try:
+                        for r in session.client_packets(decoder.frames()):
+                            self.request.sendall(r)
+                    except Exception as exc:
+                        print('TCPHandler data exception: %s' % repr(exc))
+
+                try:
+                    for r in session.server_packets():
+                        self.request.sendall(r)
+                except Exception as exc:
+                    print('TCPHandler loop exception: %s' % repr(exc))
+                    break
+        finally:
+            session.close()
+
+class TCPProtocol(asyncio.Protocol):
+    #asyncio version of TCPHandler: no thread per client, the 1 second keepalive is a timer
+    def connection_made(self, transport):
+        self.transport = transport
+        loop = asyncio.get_running_loop()
+        #woken with call_soon_threadsafe, ProactorEventLoop (Windows) has no add_reader
+        self.session = TCPSession(transport.get_extra_info('peername'), lambda: loop.call_soon_threadsafe(self.notified))
+        self.decoder = relay_codec.FrameDecoder()
+        self.timer = None
+
+    def connection_lost(self, exc):
+        if self.timer:
+            self.timer.cancel()
+        self.session.close()
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+        frames = self.decoder.frames()
+        if not frames:
+            return
+        if self.session.relay is None:
+            reply = self.session.hello(frames.pop(0))
+            if reply is None:
+                self.transport.close()
+                return
+            self.transport.write(reply)
+        try:
+            self.transport.writelines(self.session.client_packets(frames))
+        except Exception as exc:
+            print('TCPProtocol data exception: %s' % repr(exc))
+        self.send_updates()
+
+    def notified(self):
+        if self.session.notifier is None: #closed since it was scheduled
+            return
+        self.session.notifier.clear()
+        self.send_updates()
+
+    def send_updates(self):
+        if self.timer:
+            self.timer.cancel()
+        try:
+            self.transport.writelines(self.session.server_packets())
+        except Exception as exc:
+            print('TCPProtocol loop exception: %s' % repr(exc))
+            self.transport.close()
+            return
+        self.timer = asyncio.get_running_loop().call_later(1, self.send_updates)
 
 class BotVariables:
     profile = None
     route = None
     date = 0
     position = 0
+    encoded = None #(position, serialized state), encoded by encoded_bot_state when a player sees the bot
 
 class GhostsVariables:
     loaded = False
@@ -410,24 +476,24 @@ def get_route_name(state):
         return routes[state.route]['name']
     return zo.courses_lookup[zo.get_course(state)]
 
-def load_ghosts_folder(folder, ghosts):
-    if os.path.isdir(folder):
-        for f in os.listdir(folder):
-            if f.endswith('.bin'):
-                with open(os.path.join(folder, f), 'rb') as fd:
-                    g = BotVariables()
-                    g.route = udp_node_msgs_pb2.Ghost()
-                    g.route.ParseFromString(fd.read())
-                    g.date = g.route.states[0].worldTime
-                    ghosts.play.append(g)
+def load_ghosts_folder(player_id, folder, ghosts):
+    for entry in zo.ghost_index.folder(player_id, folder):
+        g = BotVariables()
+        try:
+            g.route = zo.route_cache.get(entry['path'])
+        except Exception as exc:
+            print('load_ghosts_folder %s: %s' % (entry['path'], repr(exc)))
+            continue
+        g.date = entry['date']
+        ghosts.play.append(g)
 
 def load_ghosts(player_id, state, ghosts):
-    folder = '%s/%s/ghosts/%s' % (STORAGE_DIR, player_id, zo.get_course(state))
+    folder = str(zo.get_course(state))
     road_folder = '%s/%s' % (folder, zo.road_id(state))
     if not zo.is_forward(state): road_folder += '/reverse'
-    load_ghosts_folder(road_folder, ghosts)
+    load_ghosts_folder(player_id, road_folder, ghosts)
     if state.route:
-        load_ghosts_folder('%s/%s' % (folder, state.route), ghosts)
+        load_ghosts_folder(player_id, '%s/%s' % (folder, state.route), ghosts)
     ghosts.start_road = zo.road_id(state)
     ghosts.start_rt = state.roadTime
     sl = get_routes()
@@ -463,22 +529,53 @@ def load_pace_partners():
                     global_pace_partners[p.id] = BotVariables()
                     pp = global_pace_partners[p.id]
                     pp.profile = p
-                with open(route, 'rb') as fd:
-                    pp.route = udp_node_msgs_pb2.Ghost()
-                    pp.route.ParseFromString(fd.read())
-                    pp.position = 0
+                pp.route = zo.route_cache.get(route)
+                pp.position = 0
 
 def play_pace_partners():
+    global pace_partners_engine
+    if bot_engine.np:
+        pace_partners_engine = BotEngine(global_pace_partners)
     while True:
         start = time.perf_counter()
-        for pp_id in global_pace_partners.keys():
-            pp = global_pace_partners[pp_id]
-            if pp.position < len(pp.route.states) - 1: pp.position += 1
-            else: pp.position = 0
-            pp.route.states[pp.position].id = pp_id
-        pause = pacer_update_freq - (time.perf_counter() - start)
+        with pace_partners_clock.lock:
+            steps = pace_partners_clock.offset()[0]
+            if pace_partners_engine:
+                pace_partners_engine.tick(steps)
+            else:
+                for pp_id in global_pace_partners.keys():
+                    pp = global_pace_partners[pp_id]
+                    pp.position = (pp.position + steps) % max(len(pp.route.states), 1)
+            pace_partners_clock.tick_time += steps * pacer_update_freq
+        if not pace_partners_engine:
+            pace_partners_index.update_many(index_item(pp_id, pp.route.states[pp.position]) for pp_id, pp in list(global_pace_partners.items()))
+        duration = time.perf_counter() - start
+        tick_duration.labels('pace_partners').observe(duration)
+        pause = max(bots_tick, pacer_update_freq) - duration
         if pause > 0: time.sleep(pause)
 
+def bot_overrides(bot_id):
+    # groupId = 0 fixes bots in event only routes
+    return relay_codec.encode_overrides(udp_node_msgs_pb2.PlayerState, id=bot_id, groupId=0)
+
+def encode_bot_state(bot_id, state):
+    return state.SerializeToString() + bot_overrides(bot_id)
+
+def encode_route_state(bot_id, route, position):
+    return route_file.encoded_state(route, position) + bot_overrides(bot_id)
+
+def encoded_bot_state(bot_id, bot, clock):
+    # only the bots seen by a player are encoded, once per position. The clock of the bot moves it to
+    # where it is when the state is sent
+    position, fraction = clock.position(bot)
+    encoded = bot.encoded
+    if encoded is None or encoded[0] != position:
+        encoded = bot.encoded = (position, encode_route_state(bot_id, bot.route, position))
+    interpolated = route_file.interpolation(bot.route, position, fraction)
+    if interpolated:
+        return encoded[1] + relay_codec.encode_overrides(udp_node_msgs_pb2.PlayerState, **interpolated)
+    return encoded[1]
+
 def get_names():
     bots_file = '%s/bot.txt' % STORAGE_DIR
     if os.path.isfile(bots_file):
@@ -493,88 +590,121 @@ def get_names():
             'last_name': random.choice(data['last_names']), 'is_male': is_male, 'country_code': random.choice(zo.GD['country_codes'])})
     return riders
 
+def file_mtime(path):
+    return os.stat(path).st_mtime_ns if os.path.isfile(path) else 0
+
 def load_bots():
+    # BotPopulation of the ghosts of every player, from BOTS_SNAPSHOT_FILE if nothing changed since it was saved
     multiplier = 1
     with open(ENABLE_BOTS_FILE) as f:
         try:
             multiplier = min(int(f.readline().rstrip('\r\n')), 100)
         except ValueError:
             pass
-    i = 1
-    loop_riders = []
+    ghosts = []
     for name in os.listdir(STORAGE_DIR):
         path = '%s/%s/ghosts' % (STORAGE_DIR, name)
         if os.path.isdir(path):
-            for (root, dirs, files) in os.walk(path):
-                for f in files:
-                    if f.endswith('.bin'):
-                        positions = []
-                        for n in range(0, multiplier):
-                            p = profile_pb2.PlayerProfile()
-                            zo.random_equipment(p)
-                            p.id = i + 1000000 + n * 10000
-                            global_bots[p.id] = BotVariables()
-                            bot = global_bots[p.id]
-                            if n == 0:
-                                bot.route = udp_node_msgs_pb2.Ghost()
-                                with open(os.path.join(root, f), 'rb') as fd:
-                                    bot.route.ParseFromString(fd.read())
-                            else:
-                                bot.route = global_bots[i + 1000000].route
-                            if not positions:
-                                positions = list(range(len(bot.route.states)))
-                                random.shuffle(positions)
-                            bot.position = positions.pop()
-                            if not loop_riders:
-                                loop_riders = get_names()
-                                random.shuffle(loop_riders)
-                            rider = loop_riders.pop()
-                            for item in ['first_name', 'last_name', 'is_male', 'country_code', 'bike_frame', 'bike_frame_colour', 'bike_wheel_front', 'bike_wheel_rear',
-                              'glasses_type', 'ride_jersey', 'ride_helmet_type', 'ride_shoes_type', 'ride_socks_type', 'run_shirt_type', 'run_shorts_type', 'run_shoes_type']:
-                                if item in rider:
-                                    setattr(p, item, rider[item])
-                            zo.random_body(p)
-                            bot.profile = p
-                        i += 1
+            ghosts += zo.ghost_index.all(name)
+    key = bot_table.snapshot_key({'multiplier': multiplier, 'enable_bots': file_mtime(ENABLE_BOTS_FILE),
+        'bot.txt': file_mtime('%s/bot.txt' % STORAGE_DIR), 'ghosts': [[g['path'], g['size'], g['mtime']] for g in ghosts]})
+    population = bot_table.load_snapshot(BOTS_SNAPSHOT_FILE, key, zo.route_cache.get)
+    if population is not None:
+        return population
+    population = BotPopulation()
+    i = 1
+    loop_riders = []
+    for entry in ghosts:
+        route = zo.route_cache.get(entry['path'])
+        positions = []
+        for n in range(0, multiplier):
+            p = profile_pb2.PlayerProfile()
+            zo.random_equipment(p)
+            p.id = i + 1000000 + n * 10000
+            if not positions:
+                positions = list(range(len(route.states)))
+                random.shuffle(positions)
+            position = positions.pop()
+            if not loop_riders:
+                loop_riders = get_names()
+                random.shuffle(loop_riders)
+            rider = loop_riders.pop()
+            for item in ['first_name', 'last_name', 'is_male', 'country_code', 'bike_frame', 'bike_frame_colour', 'bike_wheel_front', 'bike_wheel_rear',
+              'glasses_type', 'ride_jersey', 'ride_helmet_type', 'ride_shoes_type', 'ride_socks_type', 'run_shirt_type', 'run_shorts_type', 'run_shoes_type']:
+                if item in rider:
+                    setattr(p, item, rider[item])
+            zo.random_body(p)
+            population.add(p.id, route, position, p, entry['path'])
+        i += 1
+    bot_table.save_snapshot(BOTS_SNAPSHOT_FILE, key, population)
+    return population
+
+def reload_bots(reloaded):
+    try:
+        reloaded.append(load_bots())
+    except Exception as exc:
+        print('reload_bots: %s' % repr(exc))
+        reloaded.append(None)
 
 def play_bots():
+    global bots_engine
+    if bot_engine.np:
+        bots_engine = BotEngine(global_bots)
+    reloaded = None #filled by the reload_bots thread, the bots keep moving while the new ones are loaded
     while True:
         start = time.perf_counter()
         if zo.reload_pacer_bots:
             zo.reload_pacer_bots = False
-            if os.path.isfile(ENABLE_BOTS_FILE):
-                global_bots.clear()
-                load_bots()
-        for bot_id in global_bots.keys():
-            bot = global_bots[bot_id]
-            if bot.position < len(bot.route.states) - 1: bot.position += 1
-            else: bot.position = 0
-            bot.route.states[bot.position].id = bot_id
-        pause = bot_update_freq - (time.perf_counter() - start)
+            if os.path.isfile(ENABLE_BOTS_FILE) and reloaded is None:
+                reloaded = []
+                threading.Thread(target=reload_bots, args=(reloaded,), daemon=True).start()
+        with bots_clock.lock:
+            if reloaded:
+                population = reloaded.pop()
+                reloaded = None
+                if population is not None:
+                    global_bots.replace(population)
+                    bots_index.clear()
+                    if bot_engine.np:
+                        bots_engine = BotEngine(global_bots)
+            steps = bots_clock.offset()[0]
+            if bots_engine:
+                bots_engine.tick(steps)
+            else:
+                global_bots.tick(steps)
+            bots_clock.tick_time += steps * bot_update_freq
+        if not bots_engine:
+            bots_index.update_many(global_bots.index_items())
+        duration = time.perf_counter() - start
+        tick_duration.labels('bots').observe(duration)
+        pause = max(bots_tick, bot_update_freq) - duration
         if pause > 0: time.sleep(pause)
 
+def remove_player_states(p_id):
+    player_states.pop(p_id, None)
+    with world_tick_lock:
+        new_states.discard(p_id)
+        visible_states.pop(p_id, None)
+    nearby_found.pop(p_id, None)
+
 def remove_inactive():
     while True:
         for p_id in list(online.keys()):
             if zo.world_time() > online[p_id].worldTime + 30000:
                 zo.save_bookmark(online[p_id], 'Last ' + ('run' if online[p_id].sport == profile_pb2.Sport.RUNNING else 'ride'))
                 online.pop(p_id)
+                online_index.remove(p_id)
                 discord.change_presence(len(online))
                 if discord.announce:
                     discord.send_message("Leaving", p_id)
                 zo.logout_player(p_id)
+        for p_id in list(player_states.keys()):
+            if zo.world_time() > player_states[p_id].worldTime + 30000:
+                remove_player_states(p_id)
+        zo.world_updates.expire(zo.world_time())
+        sessions.evict(zo.world_time())
         time.sleep(5)
 
-def is_state_new_for(peer_player_state, player_id):
-    if not player_id in global_news.keys():
-        global_news[player_id] = {}
-    for_news = global_news[player_id]
-    if peer_player_state.id in for_news.keys():
-        if for_news[peer_player_state.id] == peer_player_state.worldTime:
-            return False #already sent
-    for_news[peer_player_state.id] = peer_player_state.worldTime
-    return True
-
 def nearby_distance(s1, s2):
     if s1 is None or s2 is None:
         return False, None
@@ -584,6 +714,37 @@ def nearby_distance(s1, s2):
             return True, dist
     return False, None
 
+def index_item(p_id, state):
+    return p_id, zo.get_course(state), zo.road_id(state), state.x, state.z
+
+def nearby_candidates(index, state):
+    if state is None:
+        return ()
+    return index.query(zo.get_course(state), zo.road_id(state), state.x, state.z)
+
+def nearby_bots(engine, index, bots, clock, state):
+    #(id, distance) of the nearby bots or pace partners where they are now (clock), from the BotEngine or the SpatialIndex candidates
+    if state is None:
+        return ()
+    course, road = zo.get_course(state), zo.road_id(state)
+    if engine:
+        with clock.lock:
+            return engine.query(course, road, state.x, state.y_altitude, state.z, steps=clock.offset()[0])
+    #the index has the positions of the last tick (or the one before while it is updated), widen the search by
+    #the distance a bot can ride since then
+    elapsed = time.monotonic() - clock.tick_time + max(bots_tick, clock.interval)
+    found = []
+    with clock.lock:
+        steps = clock.offset()[0]
+        for p_id in index.query(course, road, state.x, state.z, int(100000 + bot_max_speed * elapsed)):
+            bot = bots.get(p_id)
+            if bot is not None:
+                position = (bot.position + steps) % max(len(bot.route.states), 1)
+                is_nearby, distance = nearby_distance(state, bot.route.states[position])
+                if is_nearby:
+                    found.append((p_id, distance))
+    return found
+
 def is_ahead(state, roadTime):
     if zo.is_forward(state):
         if state.roadTime > roadTime and abs(state.roadTime - roadTime) < 500000:
@@ -593,237 +754,500 @@ def is_ahead(state, roadTime):
             return True
     return False
 
-class UDPHandler(socketserver.BaseRequestHandler):
-    def handle(self):
-        data = self.request[0]
-        socket = self.request[1]
-        ip = self.client_address[0] + str(self.client_address[1])
-        if not ip in global_clients.keys():
-            relay_id = int.from_bytes(data[1:5], "big")
-            if relay_id in global_relay.keys():
-                global_clients[ip] = global_relay[relay_id]
-            else:
-                return
-        relay = global_clients[ip]
-        iv = InitializationVector(DeviceType.Relay, ChannelType.UdpClient, relay.udp_ci, relay.udp_r_sn)
-        p = decode_packet(data, relay.key, iv)
-        relay.udp_r_sn += 1
-        if p.ci is not None:
-            relay.udp_ci = p.ci
-            relay.udp_t_sn = 0
-            iv.ci = p.ci
-        if p.sn is not None:
-            relay.udp_r_sn = p.sn
+def get_watching_state(player_id, state, bookmarks, ghosts):
+    if state.watchingRiderId == player_id:
+        return state
+    elif state.watchingRiderId in online.keys():
+        return online[state.watchingRiderId]
+    elif state.watchingRiderId in global_pace_partners.keys():
+        pp = global_pace_partners[state.watchingRiderId]
+        return pp.route.states[pace_partners_clock.position(pp)[0]]
+    elif state.watchingRiderId in global_bots.keys():
+        bot = global_bots[state.watchingRiderId]
+        return bot.route.states[bots_clock.position(bot)[0]]
+    elif state.watchingRiderId in bookmarks.keys():
+        return bookmarks[state.watchingRiderId].state
+    elif state.watchingRiderId > 10000000:
+        ghost = ghosts.play[math.floor(state.watchingRiderId / 10000000) - 1]
+        if len(ghost.route.states) > ghost.position:
+            return ghost.route.states[ghost.position]
+    return None
 
-        recv = udp_node_msgs_pb2.ClientToServer()
+def interest_tier(watching_state, player, distance):
+    #0: sent with every packet, 1: every mid_every packets, 2: with the bots
+    if not 'near' in interest or distance <= interest['near'] or (player.groupId and player.groupId == watching_state.groupId):
+        return 0
+    if distance <= interest['mid']:
+        return 1
+    return 2
 
-        try:
-            recv.ParseFromString(p.payload[1:-4])
-        except Exception as exc:
-            print('UDPHandler ParseFromString exception: %s' % repr(exc))
-            return
+def get_nearby(player_id, watching_state, bookmarks, ghosts, t):
+    nearby = {}
+    session = sessions.player(player_id)
+    session.packets += 1
+    send_tiers = [True, False, False]
+    if 'near' in interest:
+        send_tiers[1] = session.packets % interest['mid_every'] == 0
+        if t >= session.last_far_update + bot_update_freq:
+            session.last_far_update = t
+            send_tiers[2] = True
+    for p_id in nearby_candidates(online_index, watching_state):
+        player = online.get(p_id)
+        if player is not None and player.id != player_id and zo.world_time() < player.worldTime + 10000:
+            is_nearby, distance = nearby_distance(watching_state, player)
+            if is_nearby and send_tiers[interest_tier(watching_state, player, distance)] and sessions.is_state_new(player_id, player):
+                nearby[p_id] = distance
+    if t >= session.last_pp_update + pacer_update_freq:
+        session.last_pp_update = t
+        nearby.update(nearby_bots(pace_partners_engine, pace_partners_index, global_pace_partners, pace_partners_clock, watching_state))
+    if t >= session.last_bot_update + bot_update_freq:
+        session.last_bot_update = t
+        nearby.update(nearby_bots(bots_engine, bots_index, global_bots, bots_clock, watching_state))
+    if t >= session.last_bookmark_update + 10:
+        session.last_bookmark_update = t
+        for p_id in bookmarks.keys():
+            is_nearby, distance = nearby_distance(watching_state, bookmarks[p_id].state)
+            if is_nearby:
+                nearby[p_id] = distance
+    if ghosts.started and t >= ghosts.last_play + bot_update_freq:
+        ghosts.last_play = t
+        for i, g in enumerate(ghosts.play):
+            if len(g.route.states) > g.position:
+                is_nearby, distance = nearby_distance(watching_state, g.route.states[g.position])
+                if is_nearby:
+                    nearby[player_id + (i + 1) * 10000000] = distance
+                g.position += 1
+    return nearby
+
+def get_nearby_states(nearby, bookmarks, ghosts):
+    if len(nearby) > interest['max_riders']:
+        nearby = dict(heapq.nsmallest(interest['max_riders'], nearby.items(), key=lambda item: item[1]))
+    states = {}
+    for p_id in nearby:
+        encoded_state = None
+        if p_id in online.keys():
+            encoded_state = online[p_id].SerializeToString()
+        elif p_id in global_pace_partners.keys():
+            encoded_state = encoded_bot_state(p_id, global_pace_partners[p_id], pace_partners_clock)
+        elif p_id in global_bots.keys():
+            encoded_state = encoded_bot_state(p_id, global_bots[p_id], bots_clock)
+        elif p_id in bookmarks.keys():
+            encoded_state = encode_bot_state(p_id, bookmarks[p_id].state)
+        elif p_id > 10000000:
+            ghost = ghosts.play[math.floor(p_id / 10000000) - 1]
+            encoded_state = encode_route_state(p_id, ghost.route, ghost.position - 1)
+        if encoded_state != None:
+            states[p_id] = encoded_state
+    return states
+
+def world_tick():
+    while True:
+        start = time.perf_counter()
+        t = time.monotonic()
+        for player_id, state in list(player_states.items()):
+            ghosts = global_ghosts.get(player_id)
+            if ghosts is None:
+                continue
+            bookmarks = zo.global_bookmarks.get(player_id, {})
+            try:
+                with world_tick_lock:
+                    is_new = player_id in new_states
+                    new_states.discard(player_id)
+                if is_new:
+                    #the riders are looked up once per received state, like without world tick
+                    watching_state = get_watching_state(player_id, state, bookmarks, ghosts)
+                    nearby_found[player_id] = get_nearby(player_id, watching_state, bookmarks, ghosts, t)
+                #their states are encoded again at each tick until the next state, the last ones are sent
+                states = get_nearby_states(nearby_found.get(player_id, {}), bookmarks, ghosts)
+                with world_tick_lock:
+                    visible_states[player_id] = states
+            except Exception as exc:
+                print('world_tick exception: %s' % repr(exc))
+        duration = time.perf_counter() - start
+        tick_duration.labels('world').observe(duration)
+        pause = 1 / world_tick_rate - duration
+        if pause > 0: time.sleep(pause)
 
-        client_address = self.client_address
-        player_id = recv.player_id
-        state = recv.state
-
-        #Add last updates for player if missing
-        if not player_id in last_pp_updates.keys():
-            last_pp_updates[player_id] = 0
-        if not player_id in last_bot_updates.keys():
-            last_bot_updates[player_id] = 0
-        if not player_id in last_bookmark_updates.keys():
-            last_bookmark_updates[player_id] = 0
-
-        #Add bookmarks for player if missing
-        if not player_id in zo.global_bookmarks.keys():
-            zo.global_bookmarks[player_id] = {}
-        bookmarks = zo.global_bookmarks[player_id]
-
-        #Update player online state
-        if state.roadTime:
-            if player_id in online.keys():
-                if online[player_id].worldTime > state.worldTime:
-                    return #udp is unordered -> drop old state
-                online[player_id] = state
-            elif zo.world_time() < state.worldTime + 10000:
-                online[player_id] = state
+def update_online(player_id, state):
+    online[player_id] = state
+    online_index.update(*index_item(player_id, state))
+    zo.world_updates.track(player_id, zo.get_course(state), state.groupId, state.watchingRiderId)
+    if world_table:
+        world_table.write(player_id, state.SerializeToString())
+
+def sync_world_table():
+    #Merges the riders written to world_table by the other processes into online
+    parent = os.getppid()
+    next_evict = 0
+    while True:
+        for player_id, data in world_table.read_changes():
+            state = udp_node_msgs_pb2.PlayerState()
+            state.ParseFromString(data)
+            current = online.get(player_id)
+            if current is not None and current.worldTime >= state.worldTime:
+                continue
+            online[player_id] = state
+            online_index.update(*index_item(player_id, state))
+            zo.world_updates.track(player_id, zo.get_course(state), state.groupId, state.watchingRiderId)
+            if current is None and not udp_worker:
                 discord.change_presence(len(online))
                 if discord.announce:
                     discord.send_message("%s in %s" % (('Running' if state.sport == profile_pb2.Sport.RUNNING else 'Riding'), get_route_name(state)), player_id)
+        if udp_worker:
+            #logout and bookmarks are handled by remove_inactive of the main process, the worker only
+            #drops what it holds for the player, like logout_player
+            for p_id in list(online.keys()):
+                if zo.world_time() > online[p_id].worldTime + 30000:
+                    online.pop(p_id)
+                    online_index.remove(p_id)
+                    zo.world_updates.remove(p_id)
+                    remove_player_states(p_id)
+                    ghosts = global_ghosts.pop(p_id, None)
+                    if ghosts is not None:
+                        ghosts.rec.discard()
+                        ghosts.play.clear()
+                    zo.global_bookmarks.pop(p_id, None)
+            if time.monotonic() >= next_evict:
+                sessions.evict(zo.world_time())
+                next_evict = time.monotonic() + 5
+            if os.getppid() != parent:
+                os._exit(0)
+        time.sleep(0.1)
 
-        #Add handling of ghosts for player if it's missing
-        if not player_id in global_ghosts.keys():
-            global_ghosts[player_id] = GhostsVariables()
-            global_ghosts[player_id].rec = udp_node_msgs_pb2.Ghost()
-            global_ghosts[player_id].play = []
-        ghosts = global_ghosts[player_id]
+def update_ghosts(player_id, state, ghosts, t):
+    #Loads, records and starts the ghosts of a moving player, reads and writes files
+    try:
+        #Load ghosts when start moving (as of version 1.39 player sometimes enters course 6 road 0 at home screen)
+        if not ghosts.loaded:
+            ghosts.loaded = True
+            load_ghosts(player_id, state, ghosts)
+        #Save player state as ghost
+        if t >= ghosts.last_rec + bot_update_freq:
+            ghosts.rec.append(state)
+            ghosts.last_rec = t
+        #Start loaded ghosts
+        if not ghosts.started and ghosts.play and zo.road_id(state) == ghosts.start_road and is_ahead(state, ghosts.start_rt):
+            regroup_ghosts(player_id)
+    except Exception as exc:
+        print('update_ghosts exception: %s' % repr(exc))
 
-        t = time.monotonic()
+def handle_udp_packet(data, client_address, sendto, run_blocking=None):
+    #run_blocking(function, *args): runs the file I/O out of an event loop thread
+    udp_packets_in.inc()
+    udp_bytes_in.inc(len(data))
+    address = client_address[:2]
+    client = sessions.client(address)
+    if client is None or data[0] & 4: #with the relay id, the address may have been used by another player before
+        relay_id = int.from_bytes(data[1:5], "big")
+        if not relay_id in global_relay.keys() and udp_worker:
+            #the key of a player who logged in after the worker started was saved by TCPSession.hello
+            ENCRYPTION_KEY_FILE = "%s/%s/encryption_key.bin" % (STORAGE_DIR, relay_id)
+            if os.path.isfile(ENCRYPTION_KEY_FILE):
+                with open(ENCRYPTION_KEY_FILE, 'rb') as f:
+                    global_relay[relay_id] = zo.Relay(f.read())
+        if relay_id in global_relay.keys():
+            if client is None or client.relay is not global_relay[relay_id]:
+                client = sessions.add_client(address, global_relay[relay_id])
+            if capture:
+                capture.key(zo.world_time(), relay_id, global_relay[relay_id].key)
+        elif client is None:
+            return
+    if capture:
+        capture.write(relay_capture.UDP, zo.world_time(), client_address, data)
+    relay = client.relay
+    p = relay.crypto.open(data, ChannelType.UdpClient, relay.udp_ci, relay.udp_r_sn)
+    relay.udp_r_sn += 1
+    if p.ci is not None:
+        relay.udp_ci = p.ci
+        relay.udp_t_sn = 0
+    if p.sn is not None:
+        relay.udp_r_sn = p.sn
+
+    recv = udp_node_msgs_pb2.ClientToServer()
 
-        if player_id in zo.ghosts_enabled and zo.ghosts_enabled[player_id]:
-            if state.roadTime and ghosts.last_rt and state.roadTime != ghosts.last_rt:
-                #Load ghosts when start moving (as of version 1.39 player sometimes enters course 6 road 0 at home screen)
-                if not ghosts.loaded:
-                    ghosts.loaded = True
-                    load_ghosts(player_id, state, ghosts)
-                #Save player state as ghost
-                if t >= ghosts.last_rec + bot_update_freq:
-                    ghosts.rec.states.append(state)
-                    ghosts.last_rec = t
-                #Start loaded ghosts
-                if not ghosts.started and ghosts.play and zo.road_id(state) == ghosts.start_road and is_ahead(state, ghosts.start_rt):
-                    regroup_ghosts(player_id)
-            ghosts.last_rt = state.roadTime
-
-        #Set state of player being watched
-        watching_state = None
-        if state.watchingRiderId == player_id:
-            watching_state = state
-        elif state.watchingRiderId in online.keys():
-            watching_state = online[state.watchingRiderId]
-        elif state.watchingRiderId in global_pace_partners.keys():
-            pp = global_pace_partners[state.watchingRiderId]
-            watching_state = pp.route.states[pp.position]
-        elif state.watchingRiderId in global_bots.keys():
-            bot = global_bots[state.watchingRiderId]
-            watching_state = bot.route.states[bot.position]
-        elif state.watchingRiderId in bookmarks.keys():
-            watching_state = bookmarks[state.watchingRiderId].state
-        elif state.watchingRiderId > 10000000:
-            ghost = ghosts.play[math.floor(state.watchingRiderId / 10000000) - 1]
-            if len(ghost.route.states) > ghost.position:
-                watching_state = ghost.route.states[ghost.position]
+    try:
+        recv.ParseFromString(p.payload[1:-4])
+    except Exception as exc:
+        print('UDPHandler ParseFromString exception: %s' % repr(exc))
+        udp_decode_errors.inc()
+        if udp_worker:
+            #probably a new key after logging in again, reload it with the next packet
+            sessions.remove_client(address)
+            if p.ri is not None:
+                global_relay.pop(p.ri, None)
+        return
+
+    player_id = recv.player_id
+    state = recv.state
+
+    #Add bookmarks for player if missing
+    if not player_id in zo.global_bookmarks.keys():
+        zo.global_bookmarks[player_id] = {}
+    bookmarks = zo.global_bookmarks[player_id]
+
+    #Update player online state
+    if state.roadTime:
+        if player_id in online.keys():
+            if online[player_id].worldTime > state.worldTime:
+                return #udp is unordered -> drop old state
+            update_online(player_id, state)
+        elif zo.world_time() < state.worldTime + 10000:
+            update_online(player_id, state)
+            discord.change_presence(len(online))
+            if discord.announce:
+                discord.send_message("%s in %s" % (('Running' if state.sport == profile_pb2.Sport.RUNNING else 'Riding'), get_route_name(state)), player_id)
+
+    #Add handling of ghosts for player if it's missing
+    ghosts = global_ghosts.get(player_id)
+    if ghosts is None:
+        with ghosts_lock: #another packet of the player may be handled at the same time
+            ghosts = global_ghosts.get(player_id)
+            if ghosts is None:
+                ghosts = GhostsVariables()
+                ghosts.rec = GhostRecorder(zo.recording_dir(player_id), player_id)
+                ghosts.play = []
+                global_ghosts[player_id] = ghosts
 
+    t = time.monotonic()
+
+    if player_id in zo.ghosts_enabled and zo.ghosts_enabled[player_id]:
+        if state.roadTime and ghosts.last_rt and state.roadTime != ghosts.last_rt:
+            if run_blocking:
+                run_blocking(update_ghosts, player_id, state, ghosts, t)
+            else:
+                update_ghosts(player_id, state, ghosts, t)
+        ghosts.last_rt = state.roadTime
+
+    if world_tick_rate:
+        #Nearby riders are computed by world_tick, just pick up what it left for this player
+        with world_tick_lock:
+            if not player_id in player_states or player_states[player_id].worldTime <= state.worldTime: #udp is unordered
+                player_states[player_id] = state
+                new_states.add(player_id)
+            nearby_states = visible_states.pop(player_id, {})
+    else:
         #Check if online players, pace partners, bots and ghosts are nearby
-        nearby = {}
-        for p_id in online.keys():
-            player = online[p_id]
-            if player.id != player_id and zo.world_time() < player.worldTime + 10000:
-                is_nearby, distance = nearby_distance(watching_state, player)
-                if is_nearby and is_state_new_for(player, player_id):
-                    nearby[p_id] = distance
-        if t >= last_pp_updates[player_id] + pacer_update_freq:
-            last_pp_updates[player_id] = t
-            for p_id in global_pace_partners.keys():
-                pp = global_pace_partners[p_id]
-                is_nearby, distance = nearby_distance(watching_state, pp.route.states[pp.position])
-                if is_nearby:
-                    nearby[p_id] = distance
-        if t >= last_bot_updates[player_id] + bot_update_freq:
-            last_bot_updates[player_id] = t
-            for p_id in global_bots.keys():
-                bot = global_bots[p_id]
-                is_nearby, distance = nearby_distance(watching_state, bot.route.states[bot.position])
-                if is_nearby:
-                    nearby[p_id] = distance
-        if t >= last_bookmark_updates[player_id] + 10:
-            last_bookmark_updates[player_id] = t
-            for p_id in bookmarks.keys():
-                is_nearby, distance = nearby_distance(watching_state, bookmarks[p_id].state)
-                if is_nearby:
-                    nearby[p_id] = distance
-        if ghosts.started and t >= ghosts.last_play + bot_update_freq:
-            ghosts.last_play = t
-            for i, g in enumerate(ghosts.play):
-                if len(g.route.states) > g.position:
-                    is_nearby, distance = nearby_distance(watching_state, g.route.states[g.position])
-                    if is_nearby:
-                        nearby[player_id + (i + 1) * 10000000] = distance
-                    g.position += 1
-
-        #Send nearby riders states or empty message
-        messages = []
-        message = udp_node_msgs_pb2.ServerToClient()
-        message.server_realm = udp_node_msgs_pb2.ZofflineConstants.RealmID
-        message.player_id = player_id
-        message.world_time = zo.world_time()
-        message.cts_latency = message.world_time - recv.world_time
-        if len(nearby) > 100:
-            nearby = dict(sorted(nearby.items(), key=lambda item: item[1]))
-            nearby = dict(itertools.islice(nearby.items(), 100))
-        for p_id in nearby:
-            player = None
-            if p_id in online.keys():
-                player = online[p_id]
-            elif p_id in global_pace_partners.keys():
-                pp = global_pace_partners[p_id]
-                player = pp.route.states[pp.position]
-            elif p_id in global_bots.keys():
-                bot = global_bots[p_id]
-                player = bot.route.states[bot.position]
-            elif p_id in bookmarks.keys():
-                player = bookmarks[p_id].state
-            elif p_id > 10000000:
-                ghost = ghosts.play[math.floor(p_id / 10000000) - 1]
-                player = ghost.route.states[ghost.position - 1]
-                player.id = p_id
-            if player != None:
-                if not p_id in online.keys():
-                    player.worldTime = message.world_time - simulated_latency
-                    player.groupId = 0 # fix bots in event only routes
-                if len(message.SerializeToString()) + len(player.SerializeToString()) > 1400:
-                    new_msg = udp_node_msgs_pb2.ServerToClient()
-                    new_msg.CopyFrom(message)
-                    messages.append(new_msg)
-                    del message.states[:]
-                message.states.append(player)
-        messages.append(message)
-        for i, msg in enumerate(messages):
-            msg.num_msgs = len(messages)
-            msg.msgnum = i + 1
-            iv.ct = ChannelType.UdpServer
-            iv.sn = relay.udp_t_sn
-            r = encode_packet(msg.SerializeToString(), relay.key, iv, None, None, relay.udp_t_sn)
-            relay.udp_t_sn += 1
-            socket.sendto(r, client_address)
-
-if os.path.isdir(PACE_PARTNERS_DIR):
-    load_pace_partners()
-    pp = threading.Thread(target=play_pace_partners)
-    pp.start()
-
-if os.path.isfile(ENABLE_BOTS_FILE):
-    load_bots()
-    bot = threading.Thread(target=play_bots)
-    bot.start()
+        watching_state = get_watching_state(player_id, state, bookmarks, ghosts)
+        nearby = get_nearby(player_id, watching_state, bookmarks, ghosts, t)
+        nearby_states = get_nearby_states(nearby, bookmarks, ghosts)
+
+    #Send nearby riders states or empty message
+    message = udp_node_msgs_pb2.ServerToClient()
+    message.server_realm = udp_node_msgs_pb2.ZofflineConstants.RealmID
+    message.player_id = player_id
+    message.world_time = zo.world_time()
+    message.cts_latency = message.world_time - recv.world_time
+    world_time_override = relay_codec.encode_overrides(udp_node_msgs_pb2.PlayerState, worldTime=message.world_time - simulated_latency)
+    states = []
+    for p_id, encoded_state in nearby_states.items():
+        if not p_id in online.keys():
+            encoded_state += world_time_override
+        states.append(encoded_state)
+    payloads = relay_codec.pack_messages(message, 'states', states, numbered=True)
+    packets = relay.crypto.seal_many(payloads, ChannelType.UdpServer, relay.udp_ci, relay.udp_t_sn, with_sn=True)
+    relay.udp_t_sn += len(packets)
+    nearby_riders.observe(len(states))
+    for r in packets:
+        sendto(r, client_address)
+        udp_packets_out.inc()
+        udp_bytes_out.inc(len(r))
+
+class UDPHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        handle_udp_packet(self.request[0], self.client_address, self.request[1].sendto)
+
+class UDPProtocol(asyncio.DatagramProtocol):
+    #asyncio version of UDPHandler: datagrams are handled in the event loop thread instead of a new thread each,
+    #the ghosts files are read and written by one executor thread, in the order of the packets
+    def connection_made(self, transport):
+        self.transport = transport
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    def connection_lost(self, exc):
+        self.executor.shutdown(wait=False)
+
+    def run_blocking(self, function, *args):
+        asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def datagram_received(self, data, addr):
+        try:
+            handle_udp_packet(data, addr, self.transport.sendto, self.run_blocking)
+        except Exception as exc:
+            print('UDPProtocol exception: %s' % repr(exc))
+
+
+def start_relay_threads():
+    tick_interval.labels('pace_partners').set(max(bots_tick, pacer_update_freq))
+    tick_interval.labels('bots').set(max(bots_tick, bot_update_freq))
+    if world_tick_rate:
+        tick_interval.labels('world').set(1 / world_tick_rate)
+
+    if os.path.isdir(PACE_PARTNERS_DIR):
+        pp = threading.Thread(target=play_pace_partners)
+        pp.start()
+
+    if os.path.isfile(ENABLE_BOTS_FILE):
+        bot = threading.Thread(target=play_bots)
+        bot.start()
+
+    if world_tick_rate and (udp_worker or not udp_workers):
+        wt = threading.Thread(target=world_tick)
+        wt.start()
+
+class ReusePortUDPServer(socketserver.ThreadingUDPServer):
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        socketserver.ThreadingUDPServer.server_bind(self)
+
+def run_udp_worker(n):
+    #Forked process serving the UDP port along with the other workers, the kernel keeps each client on the same worker
+    global udp_worker
+    global discord
+    global capture
+    udp_worker = n
+    discord = DummyDiscord()
+    if capture:
+        #each worker writes its own capture, relay_replay.py merges them
+        capture = relay_capture.RelayCapture('%s.%s' % (capture.path, n))
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    start_relay_threads()
+    sync = threading.Thread(target=sync_world_table)
+    sync.daemon = True
+    sync.start()
+    if relay_transport == 'asyncio':
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(loop.create_datagram_endpoint(UDPProtocol, local_addr=(udp_host or '0.0.0.0', udp_port), reuse_port=True))
+        loop.run_forever()
+    else:
+        udpserver = ReusePortUDPServer((udp_host, udp_port), UDPHandler)
+        udpserver.serve_forever()
+    os._exit(0)
+
+if os.path.isfile(WORLD_TICK_FILE):
+    world_tick_rate = 10
+    with open(WORLD_TICK_FILE) as f:
+        try:
+            world_tick_rate = min(max(int(f.readline().rstrip('\r\n')), 1), 100)
+        except ValueError:
+            pass
+
+if os.path.isfile(BOTS_TICK_FILE):
+    bots_tick = 10
+    with open(BOTS_TICK_FILE) as f:
+        try:
+            bots_tick = min(max(float(f.readline().rstrip('\r\n')), 1), 60)
+        except ValueError:
+            pass
+
+if os.path.isfile(INTEREST_FILE):
+    interest.update({'near': 20000, 'mid': 50000, 'mid_every': 3})
+    with open(INTEREST_FILE) as f:
+        try:
+            settings = json.load(f)
+        except ValueError as exc:
+            print('Invalid %s: %s' % (INTEREST_FILE, repr(exc)))
+            settings = {}
+    if not isinstance(settings, dict):
+        print('Invalid %s: not an object' % INTEREST_FILE)
+        settings = {}
+    for key, minimum in (('near', 0), ('mid', 0), ('mid_every', 1), ('max_riders', 0)):
+        if key in settings:
+            try:
+                interest[key] = max(int(settings[key]), minimum)
+            except (TypeError, ValueError, OverflowError):
+                print('Invalid %s in %s: %s' % (key, INTEREST_FILE, settings[key])) #the default is kept
 
 SERVER_HOST = os.environ.get('ZOFFLINE_SERVER_HOST', '')
 if ':' in SERVER_HOST:
-    import socket
     socketserver.ThreadingTCPServer.address_family = socket.AF_INET6
     socketserver.ThreadingUDPServer.address_family = socket.AF_INET6
 
 socketserver.ThreadingTCPServer.allow_reuse_address = True
 socketserver.ThreadingUDPServer.allow_reuse_address = True
 
-cdn_host = os.environ.get('ZOFFLINE_CDN_HOST', SERVER_HOST)
-cdn_port = int(os.environ.get('ZOFFLINE_CDN_PORT', 80))
-httpd = socketserver.ThreadingTCPServer((cdn_host, cdn_port), CDNHandler)
-zoffline_thread = threading.Thread(target=httpd.serve_forever)
-zoffline_thread.daemon = True
-zoffline_thread.start()
-
 tcp_host = os.environ.get('ZOFFLINE_TCP_HOST', SERVER_HOST)
 tcp_port = int(os.environ.get('ZOFFLINE_TCP_PORT', 3025))
-tcpserver = socketserver.ThreadingTCPServer((tcp_host, tcp_port), TCPHandler)
-tcpserver_thread = threading.Thread(target=tcpserver.serve_forever)
-tcpserver_thread.daemon = True
-tcpserver_thread.start()
-
 udp_host = os.environ.get('ZOFFLINE_UDP_HOST', SERVER_HOST)
 udp_port = int(os.environ.get('ZOFFLINE_UDP_PORT', 3024))
-udpserver = socketserver.ThreadingUDPServer((udp_host, udp_port), UDPHandler)
-udpserver_thread = threading.Thread(target=udpserver.serve_forever)
-udpserver_thread.daemon = True
-udpserver_thread.start()
+relay_transport = os.environ.get('ZOFFLINE_RELAY_TRANSPORT', 'threads')
+udp_workers = int(os.environ.get('ZOFFLINE_UDP_WORKERS', 0))
+if udp_workers and not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+    print('ZOFFLINE_UDP_WORKERS is not supported on this platform')
+    udp_workers = 0
+
+def main():
+    #Starts the relay and the servers, standalone.py can be imported without it (scripts/relay_replay.py)
+    global capture
+    global world_table
+    global httpd
+    global tcpserver
+    global udpserver
+    global relay_loop
+    signal.signal(signal.SIGINT, sigint_handler)
+
+    if os.path.isfile(CAPTURE_FILE):
+        capture = relay_capture.RelayCapture('%s/capture-%s.bin' % (STORAGE_DIR, datetime.now().strftime('%Y%m%d-%H%M%S')))
+        print('Capturing relay packets to %s' % capture.path)
+
+    if os.path.isdir(PACE_PARTNERS_DIR):
+        load_pace_partners()
+
+    if os.path.isfile(ENABLE_BOTS_FILE):
+        global_bots.replace(load_bots())
+    #set before forking, the UDP workers tick their own copy of the bots to the same positions
+    pace_partners_clock.tick_time = bots_clock.tick_time = time.monotonic()
+
+    if udp_workers:
+        #Workers are forked before any thread is started, they share the riders through world_table
+        world_table = WorldTable()
+        sys.stdout.flush()
+        for n in range(1, udp_workers + 1):
+            pid = os.fork()
+            if pid == 0:
+                run_udp_worker(n)
+            udp_worker_pids.append(pid)
+        sync = threading.Thread(target=sync_world_table)
+        sync.daemon = True
+        sync.start()
+
+    start_relay_threads()
+
+    cdn_host = os.environ.get('ZOFFLINE_CDN_HOST', SERVER_HOST)
+    cdn_port = int(os.environ.get('ZOFFLINE_CDN_PORT', 80))
+    httpd = socketserver.ThreadingTCPServer((cdn_host, cdn_port), CDNHandler)
+    zoffline_thread = threading.Thread(target=httpd.serve_forever)
+    zoffline_thread.daemon = True
+    zoffline_thread.start()
+
+    if relay_transport == 'asyncio':
+        relay_loop = asyncio.new_event_loop()
+        relay_loop.run_until_complete(relay_loop.create_server(TCPProtocol, tcp_host or '0.0.0.0', tcp_port, reuse_address=True))
+        if not udp_workers:
+            relay_loop.run_until_complete(relay_loop.create_datagram_endpoint(UDPProtocol, local_addr=(udp_host or '0.0.0.0', udp_port)))
+        relay_loop_thread = threading.Thread(target=relay_loop.run_forever)
+        relay_loop_thread.daemon = True
+        relay_loop_thread.start()
+    else:
+        tcpserver = socketserver.ThreadingTCPServer((tcp_host, tcp_port), TCPHandler)
+        tcpserver_thread = threading.Thread(target=tcpserver.serve_forever)
+        tcpserver_thread.daemon = True
+        tcpserver_thread.start()
+
+        if not udp_workers:
+            udpserver = socketserver.ThreadingUDPServer((udp_host, udp_port), UDPHandler)
+            udpserver_thread = threading.Thread(target=udpserver.serve_forever)
+            udpserver_thread.daemon = True
+            udpserver_thread.start()
+
+    ri = threading.Thread(target=remove_inactive)
+    ri.start()
 
-ri = threading.Thread(target=remove_inactive)
-ri.start()
+    if os.path.exists(FAKE_DNS_FILE):
+        from fake_dns import fake_dns
+        dns = threading.Thread(target=fake_dns, args=(zo.server_ip,))
+        dns.start()
 
-if os.path.exists(FAKE_DNS_FILE):
-    from fake_dns import fake_dns
-    dns = threading.Thread(target=fake_dns, args=(zo.server_ip,))
-    dns.start()
+    zo.run_standalone(online, global_relay, global_pace_partners, global_bots, global_ghosts, regroup_ghosts, discord, pace_partners_clock, bots_clock)
 
-zo.run_standalone(online, global_relay, global_pace_partners, global_bots, global_ghosts, regroup_ghosts, discord)
+if __name__ == '__main__':
+    main()
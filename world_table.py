@@ -0,0 +1,82 @@
+import mmap
+import struct
+import time
+import multiprocessing
+
+SLOT = struct.Struct('=IqdH') # sequence number, player id, time of last write, state size
+SEQ = struct.Struct('=I')
+SLOT_SIZE = 1024
+SLOT_EXPIRE = 60 # seconds without writes before a slot can be reused by another player
+WRITE_LOCKS = 64
+
+# Fixed-slot table of serialized PlayerState in shared memory, created before forking the UDP workers.
+# The sequence number of a slot is odd while it's being written, so readers don't need any lock
+# (they skip the slot and pick it up on the next read). A slot can be written by two threads or
+# processes at once (two packets of a player, or a player whose address moved to another worker),
+# so the writers of a slot take one of the write locks. The lock serializes slot allocation.
+class WorldTable:
+    def __init__(self, slots=2048):
+        self.slots = slots
+        self.mm = mmap.mmap(-1, slots * SLOT_SIZE)
+        self.lock = multiprocessing.Lock()
+        self.write_locks = [multiprocessing.Lock() for _ in range(WRITE_LOCKS)]
+        self.owned = {} # player id -> slot, in this process
+        self.seen = [0] * slots # sequence number of each slot at the last read_changes, in this process
+
+    def _write(self, i, player_id, data):
+        offset = i * SLOT_SIZE
+        with self.write_locks[i % WRITE_LOCKS]:
+            seq = SEQ.unpack_from(self.mm, offset)[0]
+            seq = (seq + 1) & 0xffffffff
+            SEQ.pack_into(self.mm, offset, seq)
+            SLOT.pack_into(self.mm, offset, seq, player_id, time.time(), len(data))
+            self.mm[offset + SLOT.size:offset + SLOT.size + len(data)] = data
+            SEQ.pack_into(self.mm, offset, (seq + 1) & 0xffffffff)
+
+    def _claim(self, player_id):
+        # Linear probing from player_id, slots keep their player id when expired so probe chains stay intact
+        now = time.time()
+        free = None
+        with self.lock:
+            for n in range(self.slots):
+                i = (player_id + n) % self.slots
+                seq, p_id, updated, size = SLOT.unpack_from(self.mm, i * SLOT_SIZE)
+                if p_id == player_id:
+                    return i
+                if free is None and (p_id == 0 or now - updated > SLOT_EXPIRE):
+                    free = i
+                if p_id == 0:
+                    break
+            if free is not None:
+                self._write(free, player_id, b'')
+            return free
+
+    def write(self, player_id, data):
+        if len(data) > SLOT_SIZE - SLOT.size:
+            return False
+        i = self.owned.get(player_id)
+        if i is None or SLOT.unpack_from(self.mm, i * SLOT_SIZE)[1] != player_id:
+            i = self._claim(player_id)
+            if i is None:
+                return False
+            self.owned[player_id] = i
+        self._write(i, player_id, data)
+        return True
+
+    def read_changes(self):
+        # (player id, serialized state) of the slots written since the last call
+        changes = []
+        now = time.time()
+        for i in range(self.slots):
+            offset = i * SLOT_SIZE
+            seq = SEQ.unpack_from(self.mm, offset)[0]
+            if seq == self.seen[i] or seq & 1:
+                continue
+            seq, player_id, updated, size = SLOT.unpack_from(self.mm, offset)
+            data = self.mm[offset + SLOT.size:offset + SLOT.size + size]
+            if SEQ.unpack_from(self.mm, offset)[0] != seq:
+                continue
+            self.seen[i] = seq
+            if size and now - updated < SLOT_EXPIRE:
+                changes.append((player_id, data))
+        return changes
@@ -0,0 +1,146 @@
+import threading
+from collections import deque
+
+ALL = ('all',) # topic of every player tracked from the UDP states
+
+def course_topic(course):
+    return ('course', course)
+
+def group_topic(group_id):
+    return ('group', group_id) # event group (PlayerState.groupId)
+
+def watching_topic(player_id):
+    return ('watching', player_id) # players watching player_id
+
+# Pending WorldAttribute updates of each player until the TCP relay sends them. A player queue keeps
+# at most maxlen updates (the oldest is dropped) and updates past their world_time_expire are not sent.
+# publish() serializes an update once and shares the bytes between the queues of the members of topics,
+# the membership of each player is updated by track() with the UDP states.
+class WorldUpdates:
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        self.queues = {} # player id -> deque of (world_time_expire, serialized WorldAttribute)
+        self.notifiers = {} # player id -> set of Notifier of the player's TCP connections
+        self.topics = {} # topic -> set of player ids
+        self.memberships = {} # player id -> (course, group id, watching rider id)
+        self.lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.expired = 0
+
+    def enqueue(self, player_id, wa_bytes, expire=0):
+        self.enqueue_many((player_id,), wa_bytes, expire)
+
+    def enqueue_many(self, player_ids, wa_bytes, expire=0):
+        item = (expire, wa_bytes)
+        with self.lock:
+            for player_id in player_ids:
+                queue = self.queues.get(player_id)
+                if queue is None:
+                    queue = self.queues[player_id] = deque(maxlen=self.maxlen)
+                if len(queue) == self.maxlen:
+                    self.dropped += 1
+                queue.append(item)
+            self.enqueued += len(player_ids)
+        for player_id in player_ids:
+            self.notify(player_id)
+
+    def publish(self, player_update, topics=(), recipients=(), exclude=None):
+        # Queues player_update for the members of topics and the recipients, returns the number of players
+        players = self.members(*topics)
+        players.update(recipients)
+        players.discard(exclude)
+        if players:
+            self.enqueue_many(players, player_update.SerializeToString(), player_update.world_time_expire)
+        return len(players)
+
+    def members(self, *topics):
+        with self.lock:
+            return set().union(*[self.topics.get(topic, ()) for topic in topics])
+
+    def track(self, player_id, course, group_id=0, watching=0):
+        # Called for every UDP state, the topics only change when the player changes course, group or watched rider
+        membership = (course, group_id, watching)
+        if self.memberships.get(player_id) == membership:
+            return
+        with self.lock:
+            self._untrack(player_id)
+            self.memberships[player_id] = membership
+            topics = [ALL, course_topic(course)]
+            if group_id:
+                topics.append(group_topic(group_id))
+            if watching and watching != player_id:
+                topics.append(watching_topic(watching))
+            for topic in topics:
+                self.topics.setdefault(topic, set()).add(player_id)
+
+    def _untrack(self, player_id):
+        membership = self.memberships.pop(player_id, None)
+        if membership is None:
+            return
+        course, group_id, watching = membership
+        for topic in (ALL, course_topic(course), group_topic(group_id), watching_topic(watching)):
+            players = self.topics.get(topic)
+            if players is not None:
+                players.discard(player_id)
+                if not players:
+                    del self.topics[topic]
+
+    def notify(self, player_id):
+        with self.lock:
+            notifiers = list(self.notifiers.get(player_id, ()))
+        for notifier in notifiers:
+            notifier.set()
+
+    def subscribe(self, player_id, notifier):
+        with self.lock:
+            self.notifiers.setdefault(player_id, set()).add(notifier)
+
+    def unsubscribe(self, player_id, notifier):
+        with self.lock:
+            notifiers = self.notifiers.get(player_id)
+            if notifiers:
+                notifiers.discard(notifier)
+                if not notifiers:
+                    del self.notifiers[player_id]
+
+    def pop(self, player_id, world_time):
+        # All pending updates of the player that did not expire yet
+        with self.lock:
+            queue = self.queues.get(player_id)
+            if not queue:
+                return []
+            items = list(queue)
+            queue.clear()
+            updates = [wa_bytes for expire, wa_bytes in items if not expire or expire > world_time]
+            self.expired += len(items) - len(updates)
+        return updates
+
+    def expire(self, world_time):
+        # Drops expired updates and empty queues of players who are not connected
+        with self.lock:
+            for player_id in list(self.queues.keys()):
+                queue = self.queues[player_id]
+                if any(expire and expire <= world_time for expire, wa_bytes in queue):
+                    items = [item for item in queue if not item[0] or item[0] > world_time]
+                    self.expired += len(queue) - len(items)
+                    queue.clear()
+                    queue.extend(items)
+                if not queue and not player_id in self.notifiers:
+                    del self.queues[player_id]
+
+    def remove(self, player_id):
+        with self.lock:
+            self.queues.pop(player_id, None)
+            self._untrack(player_id)
+
+    def depth(self, player_id=None):
+        with self.lock:
+            if player_id is not None:
+                return len(self.queues.get(player_id, ()))
+            return sum(len(queue) for queue in self.queues.values())
+
+    def counters(self):
+        with self.lock:
+            return {'players': len(self.queues), 'depth': sum(len(queue) for queue in self.queues.values()),
+                    'enqueued': self.enqueued, 'dropped': self.dropped, 'expired': self.expired, 'topics': len(self.topics)}
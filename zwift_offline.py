@@ -26,7 +26,7 @@ from copy import deepcopy
 from functools import wraps
 from io import BytesIO
 from shutil import copyfile
-from flask import Flask, request, jsonify, redirect, render_template, url_for, flash, session, make_response, send_file, send_from_directory
+from flask import Flask, request, jsonify, redirect, render_template, url_for, flash, session, make_response, send_file, send_from_directory, g
 from flask_login import UserMixin, AnonymousUserMixin, LoginManager, login_user, current_user, login_required, logout_user
 from gevent.pywsgi import WSGIServer
 from google.protobuf.json_format import MessageToDict, Parse
@@ -62,6 +62,13 @@ import fitness_pb2
 import structured_events_pb2
 
 import online_sync
+import ghost_recorder
+import ghost_file
+import relay_codec
+import metrics
+import route_file
+from ghost_index import GhostIndex
+from world_updates import WorldUpdates, ALL, course_topic, group_topic, watching_topic
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
 logger = logging.getLogger('zoffline')
@@ -111,8 +118,17 @@ GHOST_PROFILE_FILE = "%s/ghost_profile.txt" % STORAGE_DIR
 if os.path.exists(GHOST_PROFILE_FILE):
     with open(GHOST_PROFILE_FILE) as f:
         GHOST_PROFILE = json.load(f)
+COMPACT_GHOSTS = None # simplification tolerance (cm) of the ghosts saved in the compact format (ghost_file)
+COMPACT_GHOSTS_FILE = "%s/compact_ghosts.txt" % STORAGE_DIR
+if os.path.exists(COMPACT_GHOSTS_FILE):
+    with open(COMPACT_GHOSTS_FILE) as f:
+        try:
+            COMPACT_GHOSTS = max(float(f.readline().rstrip('\r\n')), 0)
+        except ValueError:
+            COMPACT_GHOSTS = 0
 ALL_TIME_LEADERBOARDS = os.path.exists("%s/all_time_leaderboards.txt" % STORAGE_DIR)
 MULTIPLAYER = os.path.exists("%s/multiplayer.txt" % STORAGE_DIR)
+METRICS = os.path.exists("%s/metrics.txt" % STORAGE_DIR)
 if MULTIPLAYER:
     if not make_dir(LOGS_DIR):
         sys.exit(1)
@@ -154,7 +170,17 @@ db.init_app(app)
 
 online = {}
 ghosts_enabled = {}
-player_update_queue = {}
+world_updates = WorldUpdates()
+route_cache = route_file.RouteCache() #routes of the bots, pace partners and played ghosts
+ghost_index = GhostIndex(STORAGE_DIR, route_cache)
+for name in ['enqueued', 'dropped', 'expired']:
+    metrics.counter('zoffline_world_updates_%s_total' % name, 'Player updates %s' % name).set_function(lambda name=name: world_updates.counters()[name])
+metrics.gauge('zoffline_world_updates_depth', 'Player updates waiting to be sent').set_function(lambda: world_updates.counters()['depth'])
+metrics.gauge('zoffline_world_updates_players', 'Players with a player updates queue').set_function(lambda: world_updates.counters()['players'])
+metrics.gauge('zoffline_route_cache_bytes', 'Size of the routes in the route cache').set_function(lambda: route_cache.counters()['bytes'])
+metrics.counter('zoffline_route_cache_hits_total', 'Route cache hits').set_function(lambda: route_cache.counters()['hits'])
+metrics.counter('zoffline_route_cache_misses_total', 'Route cache misses (route files loaded)').set_function(lambda: route_cache.counters()['misses'])
+http_duration = metrics.histogram('zoffline_http_request_duration_seconds', 'HTTP request duration', (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10), ('method', 'route'))
 zc_connect_queue = {}
 player_partial_profiles = {}
 map_override = {}
@@ -395,6 +421,7 @@ class Relay:
         self.udp_r_sn = 0
         self.udp_t_sn = 0
         self.key = key
+        self.crypto = relay_codec.CryptoSession(key)
 
 class PartialProfile:
     player_id = 0
@@ -562,6 +589,14 @@ def is_nearby(s1, s2):
             return True
     return False
 
+def nearby_players(state):
+    # Online players is_nearby state, the candidates are the players on its course or watching it
+    if state is None:
+        return []
+    candidates = world_updates.members(course_topic(get_course(state)), watching_topic(state.id))
+    candidates.add(state.watchingRiderId)
+    return [p_id for p_id in candidates if is_nearby(state, online.get(p_id))]
+
 
 # We store flask-login's cookie in the "fake" JWT that we give Zwift.
 # Make it a cookie again to reuse flask-login on API calls.
@@ -966,10 +1001,8 @@ def user_home(username):
     return render_template("user_home.html", username=current_user.username, enable_ghosts=bool(current_user.enable_ghosts), climbs=CLIMBS,
         online=get_online(), is_admin=current_user.is_admin, restarting=restarting, restarting_in_minutes=restarting_in_minutes)
 
-def enqueue_player_update(player_id, wa_bytes):
-    if not player_id in player_update_queue:
-        player_update_queue[player_id] = list()
-    player_update_queue[player_id].append(wa_bytes)
+def enqueue_player_update(player_id, wa_bytes, expire=0):
+    world_updates.enqueue(player_id, wa_bytes, expire)
 
 def send_message(message, sender='Server', recipients=None):
     player_update = udp_node_msgs_pb2.WorldAttribute()
@@ -990,11 +1023,10 @@ def send_message(message, sender='Server', recipients=None):
     chat_message.countryCode = 0
 
     player_update.payload = chat_message.SerializeToString()
-    player_update_s = player_update.SerializeToString()
-    if not recipients:
-        recipients = online.keys()
-    for receiving_player_id in recipients:
-        enqueue_player_update(receiving_player_id, player_update_s)
+    if recipients:
+        world_updates.publish(player_update, recipients=recipients)
+    else:
+        world_updates.publish(player_update, (ALL,))
 
 
 def send_restarting_message():
@@ -1408,6 +1440,7 @@ def api_users_login():
     player_id = current_user.player_id
     global_relay[player_id] = Relay(req.key)
     ghosts_enabled[player_id] = current_user.enable_ghosts
+    recover_ghosts(player_id)
 
     response = login_pb2.LoginResponse()
     response.session_state = 'abc'
@@ -1465,8 +1498,9 @@ def relay_session_refresh():
 
 
 def logout_player(player_id):
+    world_updates.remove(player_id)
     if player_id in global_ghosts:
-        del global_ghosts[player_id].rec.states[:]
+        global_ghosts[player_id].rec.discard()
         global_ghosts[player_id].play.clear()
         global_ghosts.pop(player_id)
     if player_id in global_bookmarks:
@@ -1602,13 +1636,7 @@ def create_event_wat(rel_id, wa_type, pe, dest_ids):
     pe.player_id = current_user.player_id
     #optional uint64 pje_f3/ple_f3 = 3;
     player_update.payload = pe.SerializeToString()
-    player_update_s = player_update.SerializeToString()
-
-    if not current_user.player_id in dest_ids:
-        dest_ids = list(dest_ids)
-        dest_ids.append(current_user.player_id)
-    for receiving_player_id in dest_ids:
-        enqueue_player_update(receiving_player_id, player_update_s)
+    world_updates.publish(player_update, recipients=list(dest_ids) + [current_user.player_id])
 
 @app.route('/api/events/subgroups/signup/<int:rel_id>', methods=['POST'])
 @app.route('/api/events/signup/<int:rel_id>', methods=['DELETE'])
@@ -2025,6 +2053,7 @@ def api_profiles_me_phone():
         phonePort = int(request.json['securePort'])
         phoneSecretKey = base64.b64decode(request.json['secret'])
     zc_connect_queue[current_user.player_id] = (phoneAddress, phonePort, phoneSecretKey)
+    world_updates.notify(current_user.player_id)
     #todo UDP scenario
     #logger.info("ZCompanion %d reg: %s:%d (key: %s)" % (current_user.player_id, phoneAddress, phonePort, phoneSecretKey.hex()))
     return '', 204
@@ -2452,22 +2481,54 @@ def create_power_curve(player_id, fit_file):
     except Exception as exc:
         logger.warning('create_power_curve: %s' % repr(exc))
 
+def ghost_folder(player_id, state):
+    folder = '%s/%s/ghosts/%s/' % (STORAGE_DIR, player_id, get_course(state))
+    if state.route: folder += str(state.route)
+    else:
+        folder += str(road_id(state))
+        if not is_forward(state): folder += '/reverse'
+    return folder
+
+def recording_dir(player_id):
+    return '%s/%s/recording' % (STORAGE_DIR, player_id)
+
+def compact_ghost(path):
+    if COMPACT_GHOSTS is not None:
+        try:
+            ghost_file.compact_file(path, COMPACT_GHOSTS)
+        except Exception as exc:
+            logger.warning('compact_ghost %s: %s' % (path, repr(exc)))
+
 def save_ghost(player_id, name):
     if not player_id in global_ghosts.keys(): return
-    ghosts = global_ghosts[player_id]
-    if len(ghosts.rec.states) > 0:
-        state = ghosts.rec.states[0]
-        folder = '%s/%s/ghosts/%s/' % (STORAGE_DIR, player_id, get_course(state))
-        if state.route: folder += str(state.route)
-        else:
-            folder += str(road_id(state))
-            if not is_forward(state): folder += '/reverse'
+    rec = global_ghosts[player_id].rec
+    if rec.first is not None:
+        folder = ghost_folder(player_id, rec.first)
         if not make_dir(folder):
             return
-        ghosts.rec.player_id = player_id
         f = '%s/%s-%s.bin' % (folder, datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d-%H-%M-%S"), name)
-        with open(f, 'wb') as fd:
-            fd.write(ghosts.rec.SerializeToString())
+        if rec.finish(f):
+            compact_ghost(f)
+            ghost_index.add(player_id, f, route_cache.get(f))
+
+def recover_ghosts(player_id):
+    # ghosts recorded by a session that ended without save_ghost (server stopped or crashed)
+    for path in ghost_recorder.orphans(recording_dir(player_id)):
+        try:
+            ghost = ghost_recorder.recover(path)
+            if ghost is not None:
+                folder = ghost_folder(player_id, ghost.states[0])
+                if make_dir(folder):
+                    mtime = datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc)
+                    f = '%s/%s-recovered.bin' % (folder, mtime.strftime("%Y-%m-%d-%H-%M-%S"))
+                    with open(f, 'wb') as fd:
+                        fd.write(ghost.SerializeToString())
+                    compact_ghost(f)
+                    ghost_index.add(player_id, f, route_cache.get(f))
+                    logger.info('Recovered ghost %s' % f)
+            os.remove(path)
+        except Exception as exc:
+            logger.warning('recover_ghosts %s: %s' % (path, repr(exc)))
 
 def activity_uploads(player_id, activity):
     strava_upload(player_id, activity)
@@ -2510,7 +2571,10 @@ def api_profiles_activities_id(player_id, activity_id):
     create_power_curve(player_id, BytesIO(activity.fit))
     save_fit(player_id, '%s - %s' % (activity_id, secure_filename(activity.fit_filename)), activity.fit)
     if current_user.enable_ghosts:
-        save_ghost(player_id, secure_filename(activity.name))
+        try:
+            save_ghost(player_id, secure_filename(activity.name))
+        except Exception as exc:
+            logger.warning('save_ghost: %s' % repr(exc))
     if activity.sport == profile_pb2.Sport.CYCLING and activity.distanceInMeters >= 2000:
         update_streaks(player_id, activity)
     # For using with upload_activity
@@ -2543,7 +2607,7 @@ def api_profiles_activities_rideon(receiving_player_id):
 
     player_update.payload = ride_on.SerializeToString()
 
-    enqueue_player_update(receiving_player_id, player_update.SerializeToString())
+    enqueue_player_update(receiving_player_id, player_update.SerializeToString(), player_update.world_time_expire)
 
     receiver = get_partial_profile(receiving_player_id)
     message = 'Ride on ' + receiver.first_name + ' ' + receiver.last_name + '!'
@@ -2670,7 +2734,7 @@ def api_private_event_edit(meetup_id):
         if not peer_id in newEventInviteeIds:
             create_zca_notification(peer_id, org_json_pe, newEventInvites[0]["invitedProfile"])
             player_update.rel_id = peer_id
-            enqueue_player_update(peer_id, player_update.SerializeToString())
+            enqueue_player_update(peer_id, player_update.SerializeToString(), player_update.world_time_expire)
             p_partial_profile = get_partial_profile(peer_id)
             newEventInvites.append({"invitedProfile": p_partial_profile.to_json(), "status": "PENDING"})
     org_json_pe['eventInvites'] = newEventInvites
@@ -2756,12 +2820,12 @@ def api_private_event_new(): #{"culling":true,"description":"mesg","distanceInMe
     create_event_wat(ev_sg_id, udp_node_msgs_pb2.WA_TYPE.WAT_JOIN_E, events_pb2.PlayerJoinedEvent(), online.keys())
 
     player_update = create_wa_event_invites(json_pe)
-    enqueue_player_update(current_user.player_id, player_update.SerializeToString())
+    enqueue_player_update(current_user.player_id, player_update.SerializeToString(), player_update.world_time_expire)
 
     for peer_id in json_pe['invitedProfileIds']:
         create_zca_notification(peer_id, json_pe, eventInvites[0]["invitedProfile"])
         player_update.rel_id = peer_id
-        enqueue_player_update(peer_id, player_update.SerializeToString())
+        enqueue_player_update(peer_id, player_update.SerializeToString(), player_update.world_time_expire)
         p_partial_profile = get_partial_profile(peer_id)
         eventInvites.append({"invitedProfile": p_partial_profile.to_json(), "status": "PENDING"})
     json_pe['eventInvites'] = eventInvites
@@ -2883,8 +2947,8 @@ def relay_events_subgroups_id_late_join(meetup_id):
         if event.organizerId in online and online[event.organizerId].groupId == meetup_id and event.organizerId != current_user.player_id:
             leader = event.organizerId
         else:
-            for player_id in online.keys():
-                if online[player_id].groupId == meetup_id and player_id != current_user.player_id:
+            for player_id in sorted(world_updates.members(group_topic(meetup_id))):
+                if player_id in online and online[player_id].groupId == meetup_id and player_id != current_user.player_id:
                     leader = player_id
                     break
         if leader is not None:
@@ -3167,11 +3231,11 @@ def relay_worlds_generic(server_realm=None, player_id=None):
             add_player_to_world(player, course_world)
         for p_id in global_pace_partners.keys():
             pace_partner_variables = global_pace_partners[p_id]
-            pace_partner = pace_partner_variables.route.states[pace_partner_variables.position]
+            pace_partner = route_file.route_state(pace_partner_variables.route, pace_partners_clock.position(pace_partner_variables)[0], p_id)
             add_player_to_world(pace_partner, course_world, is_pace_partner=True)
         for p_id in global_bots.keys():
             bot_variables = global_bots[p_id]
-            bot = bot_variables.route.states[bot_variables.position]
+            bot = route_file.route_state(bot_variables.route, bots_clock.position(bot_variables)[0], p_id)
             add_player_to_world(bot, course_world, is_bot=True)
         if player_id in global_bookmarks.keys():
             for bookmark in global_bookmarks[player_id].values():
@@ -3247,7 +3311,7 @@ def relay_teleport_targets():
     targets = world_pb2.TeleportTargets()
     for p_id in global_pace_partners.keys():
         pp = global_pace_partners[p_id]
-        pace_partner = pp.route.states[pp.position]
+        pace_partner = route_file.route_state(pp.route, pace_partners_clock.position(pp)[0], p_id)
         if get_course(pace_partner) == course:
             add_teleport_target(pace_partner, targets)
     for p_id in online.keys():
@@ -3355,13 +3419,13 @@ def relay_worlds_id_players_id(server_realm, player_id):
         return player.SerializeToString()
     if player_id in global_pace_partners.keys():
         pace_partner = global_pace_partners[player_id]
-        state = pace_partner.route.states[pace_partner.position]
+        state = route_file.route_state(pace_partner.route, pace_partners_clock.position(pace_partner)[0], player_id)
         state.world = get_course(state)
         state.route = get_partial_profile(player_id).route
         return state.SerializeToString()
     if player_id in global_bots.keys():
         bot = global_bots[player_id]
-        return bot.route.states[bot.position].SerializeToString()
+        return route_file.route_state(bot.route, bots_clock.position(bot)[0], player_id).SerializeToString()
     return '', 404
 
 
@@ -3384,25 +3448,23 @@ def save_bookmark(state, name):
         f.write(state.SerializeToString())
 
 def nearest(p, b):
-    i = None
-    states = [(s.roadTime, s.distance) for s in b.route.states if road_id(s) == road_id(p) and is_forward(s) == is_forward(p)]
-    if states:
-        i = 0
-        n = min(states, key=lambda x: sum(abs(r - d) for r, d in zip((p.roadTime, p.distance), x)))
-        while b.route.states[i].roadTime != n[0] or b.route.states[i].distance != n[1]:
-            i += 1
-    return i
+    # index of the state of b closest to p on the same road and direction
+    return route_file.road_timeline(b.route).nearest(road_id(p), is_forward(p), p.roadTime, p.distance)
 
 def group_bots(state, including_duplicates):
+    positions = {} # id(route) -> nearest state, the bots of an enable_bots.txt multiplier share their route
     for bot in global_bots.keys():
         if bot % 1000000 < 10000 or including_duplicates:
-            n = nearest(state, global_bots[bot])
+            route = global_bots[bot].route
+            if not id(route) in positions:
+                positions[id(route)] = nearest(state, global_bots[bot])
+            n = positions[id(route)]
             if n != None:
                 if including_duplicates:
                     n += bot % 1000000 // 10000
-                    if n >= len(global_bots[bot].route.states):
-                        n -= len(global_bots[bot].route.states)
-                global_bots[bot].position = n
+                    if n >= len(route.states):
+                        n -= len(route.states)
+                bots_clock.place(global_bots[bot], n)
 
 def auto_group_bots():
     while True:
@@ -3446,7 +3508,7 @@ def relay_worlds_attributes():
                     auto_group['id'] = None
                     if command == 'disperse':
                         for bot in global_bots.keys():
-                            global_bots[bot].position = random.randrange(len(global_bots[bot].route.states))
+                            bots_clock.place(global_bots[bot], random.randrange(len(global_bots[bot].route.states)))
                 elif command == 'position':
                     logger.info('course %s road %s isForward %s roadTime %s route %s' % (get_course(state), road_id(state), is_forward(state), state.roadTime, state.route))
                 elif command.startswith('bookmark') and len(command) > 9:
@@ -3456,17 +3518,15 @@ def relay_worlds_attributes():
                     send_message('Invalid command: %s' % command, recipients=[chat_message.player_id])
                 return '', 201
         discord.send_message(chat_message.message, chat_message.player_id)
-    for receiving_player_id in online.keys():
-        should_receive = False
-        # Chat message
-        if player_update.wa_type == udp_node_msgs_pb2.WA_TYPE.WAT_SPA:
-            if is_nearby(state, online[receiving_player_id]):
-                should_receive = True
-        # Other PlayerUpdate, send to all
+        if chat_message.eventSubgroup:
+            # Event group chat message, to the riders in the group
+            world_updates.publish(player_update, (group_topic(chat_message.eventSubgroup),), recipients=[chat_message.player_id])
         else:
-            should_receive = True
-        if should_receive:
-            enqueue_player_update(receiving_player_id, player_update.SerializeToString())
+            # Chat message
+            world_updates.publish(player_update, recipients=nearby_players(state))
+    # Other PlayerUpdate, send to all
+    else:
+        world_updates.publish(player_update, (ALL,))
     return '', 201
 
 
@@ -3497,11 +3557,7 @@ def api_segment_results():
     sending_player_id = result.player_id
     if sending_player_id in online:
         sending_player = online[sending_player_id]
-        for receiving_player_id in online.keys():
-            if receiving_player_id != sending_player_id:
-                receiving_player = online[receiving_player_id]
-                if get_course(sending_player) == get_course(receiving_player) or receiving_player.watchingRiderId == sending_player_id:
-                    enqueue_player_update(receiving_player_id, player_update.SerializeToString())
+        world_updates.publish(player_update, (course_topic(get_course(sending_player)), watching_topic(sending_player_id)), exclude=sending_player_id)
 
     return {"id": result.id}
 
@@ -4137,6 +4193,25 @@ def api_d_lock_service_device_authenticate():
     return '', 204
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not METRICS:
+        return '', 404
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.before_request
+def before_request():
+    g.start_time = time.perf_counter()
+
+
+@app.after_request
+def after_request(response):
+    if 'start_time' in g:
+        http_duration.labels(request.method, request.url_rule.rule if request.url_rule else 'unmatched').observe(time.perf_counter() - g.start_time)
+    return response
+
+
 @app.teardown_request
 def teardown_request(exception):
     db.session.close()
@@ -4449,11 +4524,13 @@ def start_zwift():
     return redirect("/ride", 302)
 
 
-def run_standalone(passed_online, passed_global_relay, passed_global_pace_partners, passed_global_bots, passed_global_ghosts, passed_regroup_ghosts, passed_discord):
+def run_standalone(passed_online, passed_global_relay, passed_global_pace_partners, passed_global_bots, passed_global_ghosts, passed_regroup_ghosts, passed_discord, passed_pace_partners_clock, passed_bots_clock):
     global online
     global global_relay
     global global_pace_partners
     global global_bots
+    global pace_partners_clock
+    global bots_clock
     global global_ghosts
     global regroup_ghosts
     global discord
@@ -4462,6 +4539,8 @@ def run_standalone(passed_online, passed_global_relay, passed_global_pace_partne
     global_relay = passed_global_relay
     global_pace_partners = passed_global_pace_partners
     global_bots = passed_global_bots
+    pace_partners_clock = passed_pace_partners_clock
+    bots_clock = passed_bots_clock
     global_ghosts = passed_global_ghosts
     regroup_ghosts = passed_regroup_ghosts
     discord = passed_discord